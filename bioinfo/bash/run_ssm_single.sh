@@ -214,20 +214,37 @@ function run_cromwell {
 
 
 function count_reads {
-    SAM_FILE=`find ${OUT_DIR} -name "*.fastq.gz.sam"`
+    SAM_FILE=`find $(readlink -m ${OUT_DIR}) -name "*.fastq.gz.sam"`
     echo ${SAM_FILE}
-    for sam in ${SAM_FILE};do
-	echo ${sam}
-	if [[ -f ${sam} ]];then
+    if [[ -z ${SAM_FILE} ]];then
+	logError "sam file did not generate"
+	return
+    fi
+    # One job per SAM file by default, so the samples of a plate are counted concurrently on the grid. With
+    # COUNTREADS_SAMPLES_PER_JOB > 1, each job counts a chunk of samples listed in a sample sheet instead (the target
+    # is built once per worker), COUNTREADS_WORKERS samples at a time.
+    PER_JOB=${COUNTREADS_SAMPLES_PER_JOB:-1}
+    if [[ ${PER_JOB} -le 1 ]];then
+	for sam in ${SAM_FILE};do
 	    logInfo "${sam} was generated"
-	    cmd="${QSUB} -N SSM_count ${COUNTREADS_MEM} -e ${OUT_DIR} -o ${OUT_DIR} ${PYTHON} ${COUNTREADS} -s ${sam} -c ${CHROM} -p ${POSITIONS} -b ${BASES} -r ${SEQUENCE} -z ${STRAND} -d ${CODON_DISTANCE_UP} -P ${TARGET_BOUNDS} -D ${CODON_DISTANCE_DOWN} -m ${CIGAR_MIN} -S ${START}"
+	    cmd="${QSUB} -N SSM_count ${COUNTREADS_MEM} -e ${OUT_DIR} -o ${OUT_DIR} ${PYTHON} ${COUNTREADS} -s ${sam} -c ${CHROM} -p ${POSITIONS} -b ${BASES} -r ${SEQUENCE} -z ${STRAND} -d ${CODON_DISTANCE_UP} -P ${TARGET_BOUNDS} -D ${CODON_DISTANCE_DOWN} -m ${CIGAR_MIN} -S ${START} -w ${COUNTREADS_WORKERS:-1}"
 	    logInfo "running ${cmd}"
-	    standAlone_cmd="${PYTHON} ${COUNTREADS} -s ${sam} -c ${CHROM} -p ${POSITIONS} -b ${BASES} -r ${SEQUENCE} -z ${STRAND} -d ${CODON_DISTANCE_UP} -P ${TARGET_BOUNDS} -D ${CODON_DISTANCE_DOWN} -m ${CIGAR_MIN} -S ${START}"
+	    standAlone_cmd="${PYTHON} ${COUNTREADS} -s ${sam} -c ${CHROM} -p ${POSITIONS} -b ${BASES} -r ${SEQUENCE} -z ${STRAND} -d ${CODON_DISTANCE_UP} -P ${TARGET_BOUNDS} -D ${CODON_DISTANCE_DOWN} -m ${CIGAR_MIN} -S ${START} -w ${COUNTREADS_WORKERS:-1}"
 	    echo ${cmd}
 	    eval ${cmd}
-	else
-	    logError "sam file did not generate"
-	fi
+	done
+	return
+    fi
+    rm -f ${OUT_DIR}/count_reads.samples.*.txt
+    echo "${SAM_FILE}" | tr ' ' '\n' | split -l ${PER_JOB} -d -a 3 --additional-suffix=.txt - ${OUT_DIR}/count_reads.samples.
+    for SAMPLE_SHEET in ${OUT_DIR}/count_reads.samples.*.txt;do
+	CHUNK=`basename ${SAMPLE_SHEET} .txt`
+	logInfo "Counting reads of `cat ${SAMPLE_SHEET} | wc -l` samples listed in ${SAMPLE_SHEET}"
+	cmd="${QSUB} -N SSM_count ${COUNTREADS_MEM} -e ${OUT_DIR} -o ${OUT_DIR} ${PYTHON} ${COUNTREADS} --sample_sheet ${SAMPLE_SHEET} --combined_metrics ${OUT_DIR}/${CHUNK} -c ${CHROM} -p ${POSITIONS} -b ${BASES} -r ${SEQUENCE} -z ${STRAND} -d ${CODON_DISTANCE_UP} -P ${TARGET_BOUNDS} -D ${CODON_DISTANCE_DOWN} -m ${CIGAR_MIN} -S ${START} -w ${COUNTREADS_WORKERS:-1}"
+	logInfo "running ${cmd}"
+	standAlone_cmd="${PYTHON} ${COUNTREADS} --sample_sheet ${SAMPLE_SHEET} --combined_metrics ${OUT_DIR}/${CHUNK} -c ${CHROM} -p ${POSITIONS} -b ${BASES} -r ${SEQUENCE} -z ${STRAND} -d ${CODON_DISTANCE_UP} -P ${TARGET_BOUNDS} -D ${CODON_DISTANCE_DOWN} -m ${CIGAR_MIN} -S ${START} -w ${COUNTREADS_WORKERS:-1}"
+	echo ${cmd}
+	eval ${cmd}
     done
 }
 
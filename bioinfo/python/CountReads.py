@@ -1,6 +1,29 @@
 import logging
-from Bio.Seq import Seq
-from dna_functions import position_wrapper
+from typing import NamedTuple
+
+from bitset import to_bits, from_bits
+from codon_counts import CodonCounts, AA_INDEX
+from dna_functions import position_wrapper, position_from_changes
+from target_context import TargetContext
+
+NONCODING_EVENTS = ('UpstreamNoncoding', 'PartialCodingAndUpstreamNoncoding',
+                    'PartialCodingUpStream', 'DownstreamNonCoding',
+                    'DownstreamNonCodingAndPartialCodingDownstream',
+                    'PartialCodingDownStream')
+
+# Usable event types and the SamParser counter they are tallied under
+USABLE_EVENTS = {'Synonymous': 'synonymous_count',
+                 'Missense': 'missense_count',
+                 'StopGain': 'stop_count'}
+
+# SamParser counter of every other event type
+EVENT_COUNTERS = dict(USABLE_EVENTS,
+                      Frameshift='frameshift_count',
+                      NoChanges='nochange_count',
+                      TooMany='mm_count',
+                      Mixed='mixed_count',
+                      MultipleSynonymous='multi_synonymous_count',
+                      **{e: 'noncoding_count' for e in NONCODING_EVENTS})
 
 
 class CountReads:
@@ -30,70 +53,26 @@ class CountReads:
     #   10. Quality
     ############################################################
 
-    def __init__(self, read, indicator_dict, target_dict):
+    def __init__(self, read, indicator_dict, target_dict, context=None):
         # super().__init__()
         self.read = read
         self.indicator_dict = indicator_dict
         self.target_dict = target_dict
         self.results_dict = {}
         self.read_start = read[3]
+        # The target context does not depend on the read, so callers counting many reads should build it once
+        # and pass it in.
+        if context is None:
+            context = TargetContext.build(target_dict, self.read_start)
+        self.context = context
+        self.classifier = ReadClassifier(context)
         self.reference_aa, self.reference_dna, self.other = self.get_aa()
-        self.aa_list = self.build_aa_ref_list()
+        # positions x amino acids (and codons), see `codon_counts.CodonCounts`
+        self.aa_counts = CodonCounts(context)
 
     def get_aa(self, reference=None):
-        strand = self.target_dict.get('strand')
         if reference is None:
-            read_start = int(self.read_start)
-            cds_full_start = int(self.target_dict['from']) - read_start
-            cds_full_stop = int(self.target_dict['to']) - read_start
-            reference = self.target_dict.get('seq')
-
-            # Get all upstream sequences (Left side)
-            """
-            Examples:
-                Assumption1:    upstream_seq = 'ATTTGTCCAG',            cds_up = 0
-                    Results:    upstream_noncoding_seq = 'ATTTGTCCAG',  cds_up_seq = ''
-                Assumption2:    upstream_seq = 'ATTTGTCCAG',            cds_up = 1
-                    Results:    upstream_noncoding_seq = 'ATTTGTCCA',  cds_up_seq = 'G'
-            """
-            cds_up = self.target_dict['codon_distance_up']
-            upstream_seq = reference[:cds_full_start]
-            upstream_noncoding_seq = upstream_seq[:upstream_seq.__len__() - cds_up]  # All non-coding
-            cds_up_seq = upstream_seq[upstream_seq.__len__() - cds_up:]  # Partial coding regions
-
-            # Get all downstream sequences (Right side)
-            """
-            Examples:
-                Assumption1:    downstream_seq = ''GTATGATGTAT'',         cds_down = 0
-                    Results:    downstream_noncoding_seq = 'GTATGATGTAT', cds_down_seq = ''
-                Assumption2:    downstream_seq = 'GTATGATGTAT',           cds_down = 1
-                    Results:    downstream_noncoding_seq = 'GTATGATGTAT', cds_down_seq = 'G'
-            """
-            cds_down = self.target_dict['codon_distance_down']
-            cds_down_seq = reference[cds_full_stop:cds_full_stop + cds_down]  # Partial coding regions
-            downstream_noncoding_seq = reference[cds_full_stop + cds_down + 1:]  # All non-coding
-
-            reference = reference[cds_full_start:cds_full_stop + 1]
-            reference = Seq(reference)
-            cds_down_seq = Seq(cds_down_seq)
-            downstream_noncoding_seq = Seq(downstream_noncoding_seq)
-            cds_up_seq = Seq(cds_up_seq)
-            upstream_noncoding_seq = Seq(upstream_noncoding_seq)
-            reference_seq_fstrand = reference
-            if reference.__len__() % 3 != 0:
-                raise Exception(f"reference: ({reference}) is not divisible by 3 ({reference.__len__() % 3})")
-            if strand == 'R':
-                reference_seq = reference.reverse_complement().transcribe().translate()
-            else:
-                reference_seq = reference.transcribe().translate()
-
-            other_seq_dict = {'downstream_noncoding_seq': downstream_noncoding_seq,
-                              'cds_down_seq': cds_down_seq,
-                              'reference_seq_fstrand': reference_seq_fstrand,
-                              'cds_up_seq': cds_up_seq,
-                              'upstream_noncoding_seq': upstream_noncoding_seq
-                              }
-            return reference_seq, reference.upper(), other_seq_dict
+            return self.context.reference_aa, self.context.reference_dna, self.context.other
 
     def validateSAMLine(self):
         """
@@ -132,23 +111,165 @@ class CountReads:
     def check_validity(mmc, target_dict, strict=True):
         """
         Checks whether all the required changes are present in the read
-        :param mmc: index position of mismatches
+        :param mmc: index position of mismatches (as strings), or their bitset (see `bitset.to_bits`)
         :param target_dict: target dictionary
         :param strict: require all inserted bases
         :return: bool
         """
+        if isinstance(mmc, int):
+            present = [(mmc >> x) & 1 if x >= 0 else 0 for x in target_dict['mmc']]
+        else:
+            found = set(mmc)
+            present = [str(x) in found for x in target_dict['mmc']]
         # There can be others, but we need to ensure that the exact changes are incorporated
         if strict:
-            if all(str(x) in mmc for x in target_dict['mmc']):
-                return True
-            else:
-                return False
+            return all(present)
 
         # Only used if strict is false
-        if any(str(x) in mmc for x in target_dict['mmc']):
-            return True
+        return any(present)
+
+    def get_mismatch_counts(self, full_read, aa=False):
+        """
+        full_read: unmodified read from SAM file
+        aa: False if DNA comparison is to be made, otherwise it goes into amino acid comp
+
+        See `ReadClassifier.get_mismatch_counts`
+        """
+        return self.classifier.get_mismatch_counts(full_read, aa=aa)
+
+    @staticmethod
+    def get_mismatch_bases(read, positions):
+        return [read[int(x)] for x in positions]
+
+    def add_to_dict(self, read, aln_start):
+
+        # Count every base in every read
+        a = self.target_dict['seq'].__len__()
+        b = read.__len__()
+        for i in range(min(a, b)):
+            seq_base = read[i]
+            ref_base = self.target_dict['seq'][i]
+            if str(i) not in self.results_dict.keys():
+                self.results_dict[str(i)] = {'POS': aln_start + i,
+                                             'REF': ref_base,
+                                             'A': 0, 'G': 0, 'T': 0, 'C': 0,
+                                             'N': 0}
+
+            self.results_dict[str(i)][seq_base] += 1
+
+    def add_aa_dict(self, aa_dict):
+        """
+        :param aa_dict: position, reference, and alternate amino acid
+
+        Example:
+               aa_dict = {'frameshift': False, 'event_type': 'Missense', 'pos': 8, 'ref': 'N', 'alt': 'H'}
+        """
+        aa = self.aa_counts.aa
+        if aa_dict['event_type'] == 'MultipleSynonymous':
+            for a in range(aa_dict['ref'].__len__()):
+                alt_aa = aa_dict['alt'][a].replace('*', "X")
+                aa[aa_dict['pos'] + a, AA_INDEX[alt_aa]] += 1
+            return
+
+        # Increment the alternate amino acid (the total is the sum of the row)
+        index = aa_dict['pos']
+        alt_aa = aa_dict['alt'].replace('*', "X")
+        if not 0 <= index < aa.shape[0]:
+            logging.warning(f"Index {index} exceeds the expected amino acid length.")
+            return
+        aa[index, AA_INDEX[alt_aa]] += 1
+
+
+class ReadClassification(NamedTuple):
+    """
+    Everything learned about a read by `ReadClassifier.classify`, in a single pass over the read.
+
+    Example (missense read):
+        counter = 'missense_count'
+        valid = True
+        dna_mismatches = (41, 50, 51)       -> all DNA mismatch indexes, including the expected ones
+        mismatch_bits = (1 << 41) | (1 << 50) | (1 << 51)
+        mismatches = ['8']                  -> amino acid mismatch indexes (DNA mismatches for invalid reads)
+        event = {'frameshift': False, 'event_type': 'Missense', 'pos': 8, 'ref': 'A', 'alt': 'H'}
+        dna_results = {'pos_ref_alt': [50, 51, 'CT', 'AC'], 'RefAA': 'A', 'AltAA': 'H', ...}
+    """
+    counter: str
+    valid: bool
+    dna_mismatches: tuple
+    # dna_mismatches as a bitset, see `bitset.to_bits`
+    mismatch_bits: int
+    mismatches: list
+    event: dict
+    # Output of `dna_functions.position_wrapper` for usable reads, None otherwise
+    dna_results: dict
+
+
+class ReadClassifier:
+    """
+    Classifies reads against a shared `TargetContext`.
+
+    Holds no per-read state, so a single instance is built per run and reused for every read.
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.target_dict = context.target_dict
+        self.other = context.other
+        self.expected_mask = to_bits(context.mmc)
+        # An expected position outside of the read can never be present
+        self.all_expected_in_range = all(0 <= x < context.seq.__len__() for x in context.mmc)
+
+    def classify(self, full_read, strict=True):
+        """
+        Classify a read that starts at `read_start` and passed the CIGAR filter
+
+        The read is compared with the target once: the same mismatches are used for the validity check (see
+        `CountReads.check_validity`), the amino acid comparison and the codingdna annotation.
+
+        :param full_read: SEQ field of the SAM record
+        :param strict: require all expected changes (otherwise any of them)
+
+        :return: ReadClassification
+        """
+        reference = self.context.seq
+        dna_mismatches = tuple([i for i in range(min(full_read.__len__(), reference.__len__()))
+                                if full_read[i] != reference[i]])
+        bits = to_bits(dna_mismatches)
+        expected = self.expected_mask
+        if strict:
+            valid = bits & expected == expected and self.all_expected_in_range
         else:
-            return False
+            valid = bits & expected != 0
+        if not valid:
+            # Not all the expected sequences were found
+            return ReadClassification('invalid_count', False, dna_mismatches, bits, [str(x) for x in dna_mismatches],
+                                      None, None)
+
+        # Remove the expected DNA mutations
+        extra_bits = bits & ~expected
+        if extra_bits == 0:
+            return ReadClassification('nochange_count', True, dna_mismatches, bits, [], self.no_changes(), None)
+        extra = from_bits(extra_bits)
+
+        changes = [{'pos': i, 'ref': reference[i], 'alt': full_read[i]} for i in extra]
+        tmp_dict = position_from_changes(changes, full_read, self.target_dict, self.context.read_start, self.other,
+                                         self.context.strand)
+        mismatches, event = self.classify_changes(full_read, extra, tmp_dict)
+        counter = EVENT_COUNTERS.get(event['event_type'])
+        if counter is None:
+            raise Exception(f"This should never be reached.\n"
+                            f"mmc: {dna_mismatches}, mmca: {mismatches}, mmca_dict: {event},\n"
+                            f"Read: {full_read}")
+        return ReadClassification(counter, True, dna_mismatches, bits, mismatches, event,
+                                  tmp_dict if event['event_type'] in USABLE_EVENTS else None)
+
+    @staticmethod
+    def no_changes():
+        return {'frameshift': False,
+                'event_type': 'NoChanges',
+                'pos': 0,
+                'ref': '0',
+                'alt': '0'}
 
     def get_mismatch_counts(self, full_read, aa=False):
         """
@@ -161,7 +282,7 @@ class CountReads:
             If aa=True, returns a Tuple ([mismatch indexes], {last variant})
         """
         alternate_dnaseq = full_read
-        reference_dnaseq = self.target_dict['seq']
+        reference_dnaseq = self.context.seq
 
         # These should always be the same length
         dna_min_val = min(alternate_dnaseq.__len__(), reference_dnaseq.__len__())
@@ -170,36 +291,28 @@ class CountReads:
         if aa is False:
             return dna_mismatches, {}
 
-        # Trim reference and alternate to be of the same length
-        strand = self.target_dict.get('strand')
+        strand = self.context.strand
 
-        reference_dnaseq = self.other['reference_seq_fstrand'].__str__()
-        fro = self.target_dict['from'] - int(self.read_start)
-        to = self.target_dict['to'] - int(self.read_start) + 1
-        alternate_dnaseq = Seq(full_read[fro:to]).__str__()
-
-        # All analyses below are relative to amino acids
-        if strand == 'F':
-            # Alt is set to false to indicate there is a stop codon
-            alt_AAseq = Seq(alternate_dnaseq).transcribe().translate(to_stop=False).__str__()
-            reference_AAseq = Seq(reference_dnaseq).transcribe().translate(to_stop=True).__str__()
-        else:
-            alt_AAseq = Seq(full_read[fro:to]).reverse_complement().transcribe().translate()
-            ref_AASeq = Seq(self.other['reference_seq_fstrand'].__str__()).reverse_complement().translate()
-
-        mm_dict = dict()
         # Remove the expected DNA mutations
-        for x in self.target_dict['mmc']:
-            if str(x) in dna_mismatches:
-                dna_mismatches.remove(str(x))
+        expected = self.expected_mask
+        dna_mismatches = [x for x in dna_mismatches if not (expected >> int(x)) & 1]
 
         if dna_mismatches.__len__() == 0:
-            return [], {'frameshift': False,
-                        'event_type': 'NoChanges',
-                        'pos': 0,
-                        'ref': '0',
-                        'alt': '0'}
-        tmp_dict = position_wrapper(full_read, self.target_dict, int(self.read_start), self.other, strand)
+            return [], self.no_changes()
+        tmp_dict = position_wrapper(full_read, self.target_dict, self.context.read_start, self.other, strand)
+        return self.classify_changes(full_read, dna_mismatches, tmp_dict)
+
+    def classify_changes(self, full_read, dna_mismatches, tmp_dict):
+        """
+        Amino acid comparison of a read with unexpected DNA changes
+
+        :param full_read: unmodified read from SAM file
+        :param dna_mismatches: indexes of the DNA mismatches besides the expected ones
+        :param tmp_dict: output of `dna_functions.position_wrapper` for the read
+
+        :return: ([mismatch indexes], {last variant}), see `get_mismatch_counts`
+        """
+        mm_dict = dict()
         # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
         """
         Overwrite variables
@@ -217,11 +330,10 @@ class CountReads:
             min_pos = min(dna_mismatches)
             max_pos = max(dna_mismatches)
 
-            ncd_len = self.other['downstream_noncoding_seq'].__str__().__len__()
-            cdd_len = self.other['cds_down_seq'].__str__().__len__()
-            c___len = self.other['reference_seq_fstrand'].__str__().__len__()
-            cdu_len = self.other['cds_up_seq'].__str__().__len__()
-            ncu_len = self.other['upstream_noncoding_seq'].__str__().__len__()
+            cdd_len = self.context.dsc_len
+            c___len = self.context.seq_len
+            cdu_len = self.context.usc_len
+            ncu_len = self.context.unc_len
 
             ref = self.target_dict['seq'][min_pos:max_pos + 1]
             alt = full_read[min_pos:max_pos + 1]
@@ -398,68 +510,3 @@ class CountReads:
                                    'pos': int(amino_acid_that_changed),
                                    'ref': tmp_dict['RefAA'][tmp_dict['AApos'] - int(amino_acid_that_changed)],
                                    'alt': tmp_dict['AltAA'][tmp_dict['AApos'] - int(amino_acid_that_changed)]}
-
-    @staticmethod
-    def get_mismatch_bases(read, positions):
-        return [read[int(x)] for x in positions]
-
-    def add_to_dict(self, read, aln_start):
-
-        # Count every base in every read
-        a = self.target_dict['seq'].__len__()
-        b = read.__len__()
-        for i in range(min(a, b)):
-            seq_base = read[i]
-            ref_base = self.target_dict['seq'][i]
-            if str(i) not in self.results_dict.keys():
-                self.results_dict[str(i)] = {'POS': aln_start + i,
-                                             'REF': ref_base,
-                                             'A': 0, 'G': 0, 'T': 0, 'C': 0,
-                                             'N': 0}
-
-            self.results_dict[str(i)][seq_base] += 1
-
-    def add_aa_dict(self, aa_dict):
-        """
-        :param aa_dict: position, reference, and alternate amino acid
-
-        Example:
-               aa_dict = {'frameshift': False, 'event_type': 'Missense', 'pos': 8, 'ref': 'N', 'alt': 'H'}
-        """
-        if aa_dict['event_type'] == 'MultipleSynonymous':
-            for a in range(aa_dict['ref'].__len__()):
-                index = aa_dict['pos'] + a
-                alt_aa = aa_dict['alt'][a]
-                alt_aa = alt_aa.replace('*', "X")
-                self.aa_list[index]['TOTAL'] += 1
-                self.aa_list[index]['changes'][alt_aa] += 1
-            return
-
-        # if aa_dict['event_type'] == 'Mixed':
-        #     "MIXED classes have a special field (other) that are synonymous. After which you treat them as WT"
-        #     for i in aa_dict['other']:
-        #         ref_aa = self.aa_list[int(i)]['REF']
-        #         self.aa_list[int(i)]['changes'][ref_aa] += 1
-        # Increment the total amino acid and the alternate
-        index = aa_dict['pos']
-        alt_aa = aa_dict['alt']
-        alt_aa = alt_aa.replace('*', "X")
-        try:
-            self.aa_list[index]['TOTAL'] += 1
-            self.aa_list[index]['changes'][alt_aa] += 1
-        except IndexError:
-            logging.warning(f"Index {index} exceeds the expected amino acid length.")
-
-    def build_aa_ref_list(self):
-        """ Initialize the reference dictionary with all possible amino acids"""
-        a, d, other = self.get_aa()
-        amino_acid_codes = ['A', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'K', 'L', 'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'V',
-                            'W', 'Y', 'X']
-        res = []
-
-        for i in range(a.__len__()):
-            p1 = {'POS': i, 'REF': a[i], 'TOTAL': 0, 'changes': dict()}
-            for j in amino_acid_codes:
-                p1['changes'][j] = 0
-            res.append(p1)
-        return res
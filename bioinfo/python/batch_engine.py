@@ -0,0 +1,92 @@
+import numpy as np
+
+from bitset import pack, row_bits
+
+# Pads reads that are shorter than the target. Never a valid SEQ character, so it is never a mismatch.
+PAD = 0
+
+
+class BatchScanner:
+    """
+    Vectorized DNA mismatch scan for chunks of reads.
+
+    Reads are encoded as rows of a uint8 matrix (their ASCII codes) and compared against the encoded target sequence
+    in one operation. This replaces the per-character comparison of `ReadClassifier.get_mismatch_counts(aa=False)`
+    and `CountReads.check_validity`; only reads with changes besides the expected ones need to be looked at
+    one by one.
+
+    Example:
+        scanner = BatchScanner(context, strict=True)
+        scan = scanner.scan(['CAGATT...', 'CAGTTT...'])
+        scan['valid']       -> array([ True, False])
+        scan['extra_count'] -> array([1, 0])
+    """
+
+    def __init__(self, context, strict=True):
+        self.width = context.seq.__len__()
+        self.reference = np.frombuffer(context.seq.encode('ascii'), dtype=np.uint8)
+        # An expected position that can't be in the read can never be present
+        self.expected = np.array([x for x in context.mmc if 0 <= x < self.width], dtype=np.intp)
+        self.all_expected_in_range = self.expected.__len__() == context.mmc.__len__()
+        self.strict = strict
+
+    def encode(self, seqs):
+        """
+        :param seqs: list of read sequences
+        :return: uint8 matrix (reads x target length), truncated or padded with PAD to the target length
+        """
+        width = self.width
+        buf = ''.join([s[:width].ljust(width, '\0') for s in seqs]).encode('latin-1')
+        return np.frombuffer(buf, dtype=np.uint8).reshape(seqs.__len__(), width)
+
+    def scan(self, seqs):
+        """
+        Compare a batch of reads with the target
+
+        :param seqs: list of read sequences
+
+        :return: dictionary of arrays with one entry per read
+            {
+                'encoded': uint8 matrix of the reads,
+                'mismatch': boolean matrix of DNA mismatches,
+                'mismatch_count': number of DNA mismatches,
+                'valid': whether the required changes are present (see `CountReads.check_validity`),
+                'extra': boolean matrix of DNA mismatches excluding the expected positions,
+                'extra_count': number of DNA mismatches excluding the expected positions,
+                'first': index of the first unexpected mismatch (-1 if none),
+                'last': index of the last unexpected mismatch (-1 if none),
+                'signature': DNA mismatches packed into uint64 words, see `bitset.pack`
+            }
+        """
+        encoded = self.encode(seqs)
+        mismatch = (encoded != self.reference) & (encoded != PAD)
+        present = mismatch[:, self.expected]
+        if self.strict:
+            valid = present.all(axis=1) & self.all_expected_in_range
+        else:
+            valid = present.any(axis=1)
+        extra = mismatch.copy()
+        extra[:, self.expected] = False
+        extra_count = extra.sum(axis=1)
+        has_extra = extra_count > 0
+        first = np.where(has_extra, extra.argmax(axis=1), -1)
+        last = np.where(has_extra, self.width - 1 - extra[:, ::-1].argmax(axis=1), -1)
+        return {'encoded': encoded,
+                'mismatch': mismatch,
+                'mismatch_count': mismatch.sum(axis=1),
+                'valid': valid,
+                'extra': extra,
+                'extra_count': extra_count,
+                'first': first,
+                'last': last,
+                'signature': pack(mismatch)}
+
+    @staticmethod
+    def read_key(scan, i):
+        """
+        :param scan: output of `scan`
+        :param i: index of a read in the batch
+        :return: (mismatch bitset, bases at the mismatches). Reads with the same key only differ beyond the end of
+            the target, so they get the same classification.
+        """
+        return row_bits(scan['signature'], i), scan['encoded'][i][scan['mismatch'][i]].tobytes()
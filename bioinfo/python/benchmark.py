@@ -0,0 +1,362 @@
+"""
+Benchmarks of the counting engine on synthetic SGE libraries.
+
+Synthetic targets are built for both strands, and SAM files are generated with a realistic mix of read outcomes
+(see EVENT_MIX): mostly designed codon substitutions, plus reads without changes, sequencing errors, reads missing the
+required changes, off-target reads and reads failing the CIGAR filter.
+
+`run` times `SamParser.process_sam` end to end (each run in a fresh process, so its peak RSS is its own) and the
+per-read building blocks on their own, and writes the results as JSON. `compare` checks a result file against a
+recorded baseline and exits with 1 if anything got slower (or bigger) than the tolerance.
+
+Example:
+    python python/benchmark.py run --reads 10000 1000000 -o benchmarks/current.json
+    python python/benchmark.py compare benchmarks/baseline.json benchmarks/current.json
+
+    {'host': 'node12', 'python': '3.11.7', 'date': '2026-10-18T10:12:03', 'results': {
+        'process_sam/F/10000': {'reads_per_second': 45000.1, 'seconds': 0.22, 'peak_rss_mb': 102.3},
+        'position_wrapper/R': {'calls_per_second': 31250.4}, ...}}
+"""
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(__file__))
+from CountReads import ReadClassifier
+from target_context import TargetContext
+import dna_functions as dnaf
+from deduper import add_to_dict, VariantTally
+from output import TSVWriter, VCFWriter
+from translate import reverse_complement, translate
+
+READ_START = 1000001
+CHROM = 'chr17'
+# Non-coding bases before and after the coding region of the synthetic targets
+UPSTREAM = 20
+DOWNSTREAM = 22
+CODONS = 36
+# Expected (required) change indexes, one upstream and one downstream of the coding region
+EXPECTED = (10, UPSTREAM + 3 * CODONS + 12)
+
+# Share of each kind of read in the synthetic libraries
+EVENT_MIX = (('off_target', 0.10),
+             ('cigar', 0.02),
+             ('invalid', 0.05),
+             ('nochange', 0.15),
+             ('codon', 0.55),
+             ('single_error', 0.08),
+             ('multi_error', 0.05))
+
+# Throughput metrics; for everything else (peak RSS, seconds) smaller is better
+HIGHER_IS_BETTER = ('reads_per_second', 'calls_per_second')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='benchmark.py',
+                                     description="Benchmark the counting engine and compare with recorded baselines")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run = sub.add_parser('run', help="Run the benchmarks and write the results as JSON")
+    run.add_argument("-n", "--reads",
+                     dest='reads',
+                     default=[10000, 1000000, 10000000],
+                     type=int,
+                     nargs='+',
+                     help="Sizes of the synthetic SAM files")
+    run.add_argument("-z", "--strands",
+                     dest='strands',
+                     default=['F', 'R'],
+                     choices=['F', 'R'],
+                     nargs='+',
+                     help="Strands of the synthetic targets")
+    run.add_argument("-k", "--calls",
+                     dest='calls',
+                     default=20000,
+                     type=int,
+                     help="Number of reads used for the benchmarks of the individual functions")
+    run.add_argument("-w", "--work_dir",
+                     dest='work_dir',
+                     default=None,
+                     help="Directory for the synthetic SAM files and the outputs (default: a temporary directory)")
+    run.add_argument("--keep",
+                     dest='keep',
+                     action='store_true',
+                     help="Keep the temporary directory with the outputs")
+    run.add_argument("-o", "--output",
+                     dest='output',
+                     required=True,
+                     help="JSON file receiving the results")
+
+    compare = sub.add_parser('compare', help="Compare results with a baseline")
+    compare.add_argument("baseline", help="JSON written by 'run'")
+    compare.add_argument("current", help="JSON written by 'run'")
+    compare.add_argument("-t", "--tolerance",
+                         dest='tolerance',
+                         default=0.1,
+                         type=float,
+                         help="Relative change that is reported as a regression")
+
+    parser.add_argument("-V", "--verbose",
+                        dest="logLevel",
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                        default="INFO",
+                        help="Set the logging level")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(stream=sys.stderr, level=args.logLevel,
+                        format='%(name)s (%(levelname)s): %(message)s')
+    logger = logging.getLogger(__name__)
+    logger.setLevel(args.logLevel)
+    return args, logger
+
+
+def synthetic_target(strand, seed=0):
+    """
+    Build a random target whose coding region has no stop codon on `strand`
+
+    :param strand: 'F' or 'R'
+    :param seed: random seed
+    :return: SamParser arguments (without 'samfile')
+    """
+    rng = random.Random(f'{strand}{seed}')
+    while True:
+        coding = ''.join(rng.choice('ACGT') for _ in range(3 * CODONS))
+        aa = translate(coding if strand == 'F' else reverse_complement(coding))
+        if '*' not in aa:
+            break
+    seq = ''.join(rng.choice('ACGT') for _ in range(UPSTREAM)) + coding + \
+        ''.join(rng.choice('ACGT') for _ in range(DOWNSTREAM))
+    bases = [rng.choice([b for b in 'ACGT' if b != seq[x]]) for x in EXPECTED]
+    return {'chrom': CHROM,
+            'positions': [READ_START + x for x in EXPECTED],
+            'bases': bases,
+            'seq': seq,
+            'target_bounds': [READ_START + UPSTREAM, READ_START + UPSTREAM + 3 * CODONS - 1],
+            'strand': strand,
+            'codon_distance_up': 0,
+            'codon_distance_down': 0,
+            'read_start': READ_START,
+            'cigar_min': 60,
+            'strict': True,
+            'checkpoint_interval': 0}
+
+
+def synthetic_reads(args, seed=0):
+    """
+    Endless generator of synthetic reads of a target, drawn from EVENT_MIX
+
+    :param args: output of `synthetic_target`
+    :param seed: random seed
+    :return: generator of (kind, POS, CIGAR, SEQ)
+    """
+    rng = random.Random(seed)
+    seq = args['seq']
+    expected = list(seq)
+    for x, b in zip(EXPECTED, args['bases']):
+        expected[x] = b
+    kinds = [k for k, _ in EVENT_MIX]
+    weights = [w for _, w in EVENT_MIX]
+    cigar = f'{seq.__len__()}M'
+    while True:
+        kind = rng.choices(kinds, weights)[0]
+        read = list(expected)
+        pos = READ_START
+        if kind == 'off_target':
+            pos = READ_START + rng.randint(1, 60)
+        elif kind == 'invalid':
+            read[EXPECTED[0]] = seq[EXPECTED[0]]
+        elif kind == 'codon':
+            c = UPSTREAM + 3 * rng.randrange(CODONS)
+            read[c:c + 3] = [rng.choice('ACGT') for _ in range(3)]
+        elif kind in ('single_error', 'multi_error'):
+            for _ in range(1 if kind == 'single_error' else rng.randint(2, 4)):
+                i = rng.randrange(read.__len__())
+                if i not in EXPECTED:
+                    read[i] = rng.choice('ACGTN')
+        yield kind, pos, '40M110S' if kind == 'cigar' else cigar, ''.join(read)
+
+
+def write_synthetic_sam(filename, args, reads, seed=0):
+    """
+    :param filename: SAM file to write
+    :param args: output of `synthetic_target`
+    :param reads: number of reads
+    :param seed: random seed
+    """
+    quality = 'I' * args['seq'].__len__()
+    with open(filename, 'w') as w:
+        w.write(f"@HD\tVN:1.6\tSO:unsorted\n@SQ\tSN:{CHROM}\tLN:83257441\n")
+        generator = synthetic_reads(args, seed)
+        for i in range(reads):
+            kind, pos, cigar, seq = next(generator)
+            w.write(f"SYN:{i}\t0\t{CHROM}\t{pos}\t60\t{cigar}\t*\t0\t0\t{seq}\t{quality}\n")
+
+
+def run_process_sam(args, work_dir):
+    """
+    Count a SAM file in this (fresh) process
+
+    :return: {'reads_per_second', 'seconds', 'peak_rss_mb'}
+    """
+    from main import SamParser
+    os.chdir(work_dir)
+    logging.disable(logging.INFO)
+    start = time.perf_counter()
+    res = SamParser(args).process_sam()
+    seconds = time.perf_counter() - start
+    return {'reads_per_second': round(res['total_count'] / seconds, 1),
+            'seconds': round(seconds, 3),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+
+def bench_process_sam(args, samfile, work_dir):
+    """
+    :return: output of `run_process_sam`, run in a new process so the peak RSS only covers this run
+    """
+    args = dict(args, samfile=samfile)
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(run_process_sam, args, work_dir).result()
+
+
+def calls_per_second(fn, items):
+    """
+    :param fn: function of one argument
+    :param items: arguments
+    :return: {'calls_per_second'}
+    """
+    start = time.perf_counter()
+    for x in items:
+        fn(x)
+    seconds = time.perf_counter() - start
+    return {'calls_per_second': round(items.__len__() / seconds, 1) if seconds > 0 else 0}
+
+
+def bench_functions(args, calls, work_dir, seed=0):
+    """
+    Benchmark the per-read building blocks on reads that have changes besides the expected ones
+
+    :return: dictionary of benchmark name -> {'calls_per_second'}
+    """
+    target_dict = {'chrom': args['chrom'], 'from': args['target_bounds'][0], 'to': args['target_bounds'][1],
+                   'size': args['seq'].__len__(), 'seq': args['seq'],
+                   'mmc': [x - args['read_start'] for x in args['positions']],
+                   'codon_distance_up': 0, 'codon_distance_down': 0, 'strand': args['strand']}
+    context = TargetContext.build(target_dict, args['read_start'])
+    classifier = ReadClassifier(context)
+    generator = synthetic_reads(args, seed)
+    seqs = []
+    while seqs.__len__() < calls:
+        kind, _, _, seq = next(generator)
+        if kind in ('codon', 'single_error', 'multi_error'):
+            seqs.append(seq)
+
+    strand = args['strand']
+    results = dict()
+    results['get_mismatch_counts'] = calls_per_second(lambda s: classifier.get_mismatch_counts(s, aa=True), seqs)
+    results['position_wrapper'] = calls_per_second(
+        lambda s: dnaf.position_wrapper(s, target_dict, args['read_start'], context.other, strand), seqs)
+
+    classified = []
+    for s in seqs:
+        dna_results_dict = dnaf.position_wrapper(s, target_dict, args['read_start'], context.other, strand)
+        if dna_results_dict['RefAA'] != '':
+            classified.append(({'event_type': 'Missense'}, dna_results_dict))
+    final_dict = VariantTally()
+    results['add_to_dict'] = calls_per_second(
+        lambda c: add_to_dict(final_dict, strand, c[0], dna_results_dict=c[1], chrom=args['chrom'],
+                              read_start=args['read_start']), classified)
+
+    prefix = os.path.join(work_dir, f'functions_{strand}')
+    dna_out = TSVWriter(prefix)
+    results['TSVWriter.write_result'] = calls_per_second(lambda c: dna_out.write_result(c[1]), classified)
+    dna_out.close()
+    vcf_out = VCFWriter(prefix)
+    start = time.perf_counter()
+    vcf_out.write(final_dict)
+    seconds = time.perf_counter() - start
+    vcf_out.close()
+    results['VCFWriter.write'] = {'calls_per_second': round(final_dict.__len__() / seconds, 1) if seconds > 0 else 0}
+    return results
+
+
+def run_suite(sizes, strands, calls, work_dir, logger):
+    """
+    :return: dictionary of benchmark name -> metrics
+    """
+    results = dict()
+    for strand in strands:
+        args = synthetic_target(strand)
+        for name, metrics in bench_functions(args, calls, work_dir).items():
+            results[f'{name}/{strand}'] = metrics
+            logger.info(f"{name}/{strand}: {metrics}")
+        for reads in sizes:
+            samfile = os.path.join(work_dir, f'synthetic_{strand}_{reads}.sam')
+            write_synthetic_sam(samfile, args, reads)
+            name = f'process_sam/{strand}/{reads}'
+            results[name] = bench_process_sam(args, samfile, work_dir)
+            logger.info(f"{name}: {results[name]}")
+            os.remove(samfile)
+    return results
+
+
+def compare(baseline, current, tolerance=0.1):
+    """
+    :param baseline: results written by `run`
+    :param current: results written by `run`
+    :param tolerance: relative change reported as a regression
+    :return: list of rows (name, metric, baseline value, current value, relative change, regression)
+    """
+    rows = []
+    for name, metrics in sorted(current['results'].items()):
+        for metric, value in sorted(metrics.items()):
+            base = baseline['results'].get(name, {}).get(metric)
+            if base is None or base == 0:
+                continue
+            change = (value - base) / base
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            rows.append((name, metric, base, value, change, worse > tolerance))
+    return rows
+
+
+def main(argv):
+    args, logger = parse_args(argv)
+    if args.command == 'compare':
+        with open(args.baseline, 'r') as r:
+            baseline = json.load(r)
+        with open(args.current, 'r') as r:
+            current = json.load(r)
+        rows = compare(baseline, current, args.tolerance)
+        for name, metric, base, value, change, regression in rows:
+            print(f"{name}\t{metric}\t{base}\t{value}\t{change * 100:+.1f}%" + ('\tREGRESSION' if regression else ''))
+        return 1 if any(r[5] for r in rows) else 0
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='ssm_benchmark.')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        results = run_suite(args.reads, args.strands, args.calls, os.path.abspath(work_dir), logger)
+    finally:
+        # Only a temporary directory is removed, a --work_dir may hold other files
+        if args.work_dir is None and not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    with open(args.output, 'w') as w:
+        json.dump({'host': platform.node(),
+                   'python': platform.python_version(),
+                   'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                   'results': results}, w, indent=2)
+    logger.info(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
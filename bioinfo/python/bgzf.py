@@ -0,0 +1,230 @@
+"""
+BGZF output with a tabix index built while it is written.
+
+A BGZF file is a series of gzip members (blocks) of at most 64 KiB of data, each with its compressed size in a 'BC'
+extra field, so readers can seek to any block. A virtual offset (compressed offset of a block << 16 | offset in its
+uncompressed data) addresses any byte of the file. `TabixIndex` is given the virtual offsets of every record as it is
+written, so the .tbi is written in the same pass as the data instead of re-reading the file with `tabix -p vcf`.
+
+Example:
+    w = BgzfWriter('A1.fastq.all.vcf.gz')
+    index = TabixIndex()
+    w.write(header)
+    for line, chrom, pos, ref in records:           # coordinate sorted
+        start = w.tell()
+        w.write(line)
+        index.add(chrom, pos - 1, pos - 1 + len(ref), start, w.tell())
+    w.close()
+    index.write('A1.fastq.all.vcf.gz.tbi')
+"""
+import gzip
+import struct
+import zlib
+
+# Uncompressed bytes per block (as in htslib, so that a deflated block always fits in 64 KiB)
+BLOCK_SIZE = 0xff00
+# Empty block marking the end of a BGZF file
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# Binning scheme of .tbi indexes: 16 KiB linear index windows and 5 levels of bins
+MIN_SHIFT = 14
+# Pseudo-bin holding the first/last offsets and the number of records of a reference (as written by htslib)
+META_BIN = 37450
+# Preset of `tabix -p vcf`: format, sequence/begin/end columns (1-based), comment character, lines to skip
+VCF_PRESET = (2, 1, 2, 0, '#', 0)
+
+
+class BgzfWriter:
+
+    def __init__(self, filename, level=6):
+        """
+        :param filename: output file
+        :param level: zlib compression level
+        """
+        self.filename = filename
+        self.level = level
+        self.fo = open(filename, 'wb')
+        # Compressed offset of the block being filled
+        self.address = 0
+        self.buffer = bytearray()
+
+    def tell(self):
+        """
+        :return: virtual offset of the next byte
+        """
+        return (self.address << 16) | self.buffer.__len__()
+
+    def write(self, data):
+        """
+        :param data: str or bytes
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        self.buffer += data
+        while self.buffer.__len__() >= BLOCK_SIZE:
+            self._write_block(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+
+    def _write_block(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        deflated = compressor.compress(data) + compressor.flush()
+        # gzip header with FEXTRA and the 'BC' subfield holding the block size - 1
+        header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2,
+                             deflated.__len__() + 25)
+        self.fo.write(header + deflated + struct.pack('<II', zlib.crc32(data), data.__len__()))
+        self.address += header.__len__() + deflated.__len__() + 8
+
+    def close(self):
+        if self.buffer:
+            self._write_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.fo.write(EOF_BLOCK)
+        self.fo.close()
+
+
+def reg2bin(beg, end):
+    """
+    :param beg: 0-based start
+    :param end: 0-based end (exclusive)
+    :return: smallest bin containing [beg, end)
+    """
+    end -= 1
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+    return 0
+
+
+class _Reference:
+    __slots__ = ('bins', 'linear', 'first', 'last', 'records', 'last_beg')
+
+    def __init__(self):
+        # bin -> list of [start, end] virtual offsets
+        self.bins = dict()
+        # window -> virtual offset of the first record overlapping it (None if none does)
+        self.linear = []
+        self.first = None
+        self.last = None
+        self.records = 0
+        self.last_beg = -1
+
+
+class TabixIndex:
+    """
+    .tbi index of a coordinate sorted, BGZF compressed text file (see `BgzfWriter`)
+    """
+
+    def __init__(self, preset=VCF_PRESET):
+        """
+        :param preset: format, sequence/begin/end columns, comment character and lines to skip (see VCF_PRESET)
+        """
+        self.preset = preset
+        self.names = []
+        self.refs = dict()
+
+    def add(self, name, beg, end, start, stop):
+        """
+        :param name: sequence name of the record
+        :param beg: 0-based start of the record
+        :param end: 0-based end (exclusive) of the record
+        :param start: virtual offset of the record
+        :param stop: virtual offset after the record
+        """
+        ref = self.refs.get(name)
+        if ref is None:
+            ref = self.refs[name] = _Reference()
+            self.names.append(name)
+        elif self.names[-1] != name:
+            raise ValueError(f"Records of {name} are not contiguous, the file can't be indexed")
+        if beg < ref.last_beg:
+            raise ValueError(f"Records of {name} are not sorted ({beg + 1} after {ref.last_beg + 1})")
+        ref.last_beg = beg
+
+        chunks = ref.bins.setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == start:
+            chunks[-1][1] = stop
+        else:
+            chunks.append([start, stop])
+
+        last_window = max(end - 1, beg) >> MIN_SHIFT
+        if ref.linear.__len__() <= last_window:
+            ref.linear.extend([None] * (last_window + 1 - ref.linear.__len__()))
+        for window in range(beg >> MIN_SHIFT, last_window + 1):
+            if ref.linear[window] is None:
+                ref.linear[window] = start
+
+        if ref.first is None:
+            ref.first = start
+        ref.last = stop
+        ref.records += 1
+
+    def write(self, filename):
+        """
+        :param filename: index file (<data file>.tbi)
+        """
+        fmt, col_seq, col_beg, col_end, meta, skip = self.preset
+        names = b''.join([n.encode() + b'\0' for n in self.names])
+        out = bytearray(b'TBI\1')
+        out += struct.pack('<8i', self.names.__len__(), fmt, col_seq, col_beg, col_end, ord(meta), skip,
+                           names.__len__())
+        out += names
+        for name in self.names:
+            ref = self.refs[name]
+            out += struct.pack('<i', ref.bins.__len__() + 1)
+            for b in sorted(ref.bins):
+                chunks = ref.bins[b]
+                out += struct.pack('<Ii', b, chunks.__len__())
+                for chunk in chunks:
+                    out += struct.pack('<QQ', *chunk)
+            out += struct.pack('<Ii4Q', META_BIN, 2, ref.first, ref.last, ref.records, 0)
+            # Windows without records point at the previous one (the first record before any)
+            linear = []
+            for offset in ref.linear:
+                linear.append(offset if offset is not None else (linear[-1] if linear else ref.first))
+            out += struct.pack(f'<i{linear.__len__()}Q', linear.__len__(), *linear)
+        # Records without coordinates
+        out += struct.pack('<Q', 0)
+        w = BgzfWriter(filename)
+        w.write(bytes(out))
+        w.close()
+
+
+def bin_start(b):
+    """
+    :param b: bin of the tabix binning scheme (see `reg2bin`)
+    :return: 0-based start of the bin
+    """
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if b >= offset:
+            return (b - offset) << shift
+    return 0
+
+
+def read_tabix_extents(filename):
+    """
+    :param filename: .tbi index
+    :return: list of (sequence name, start, end) in index order, 0-based: every record of the sequence starts in
+        [start, end), so it bounds the regions worth querying
+    """
+    with open(filename, 'rb') as r:
+        data = gzip.decompress(r.read())
+    if data[:4] != b'TBI\1':
+        raise ValueError(f"{filename} is not a tabix index")
+    n_ref, = struct.unpack_from('<i', data, 4)
+    l_nm, = struct.unpack_from('<i', data, 32)
+    names = data[36:36 + l_nm].split(b'\0')[:n_ref]
+    offset = 36 + l_nm
+    res = []
+    for name in names:
+        n_bin, = struct.unpack_from('<i', data, offset)
+        offset += 4
+        starts = []
+        for _ in range(n_bin):
+            b, n_chunk = struct.unpack_from('<Ii', data, offset)
+            offset += 8 + 16 * n_chunk
+            if b != META_BIN:
+                starts.append(bin_start(b))
+        n_intv, = struct.unpack_from('<i', data, offset)
+        offset += 4 + 8 * n_intv
+        res.append((name.decode(), min(starts) if starts else 0, n_intv << MIN_SHIFT))
+    return res
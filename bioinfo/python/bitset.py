@@ -0,0 +1,64 @@
+"""
+Mismatch sets as integer bitsets over the target.
+
+Bit i is set when the read differs from the target at index i. Checking that all expected changes are present,
+removing them and counting the others are then single integer operations, and a bitset together with the bases at
+its mismatches identifies everything about a read that its classification depends on.
+
+Example:
+    bits = to_bits([12, 41, 50])        -> (1 << 12) | (1 << 41) | (1 << 50)
+    mask = to_bits([50])
+    bits & mask == mask                 -> the expected change is present
+    from_bits(bits & ~mask)             -> [12, 41]
+    (bits & ~mask).bit_count()          -> 2
+
+Batches are packed into uint64 words (see `pack`), so reads can also be hashed and grouped with NumPy,
+e.g. np.unique(pack(mismatch), axis=0, return_counts=True).
+"""
+import numpy as np
+
+
+def to_bits(indexes):
+    """
+    :param indexes: mismatch indexes (negative indexes can't be in a read and are ignored)
+    :return: int
+    """
+    bits = 0
+    for i in indexes:
+        if i >= 0:
+            bits |= 1 << i
+    return bits
+
+
+def from_bits(bits):
+    """
+    :param bits: int
+    :return: list of the indexes of the set bits, in increasing order
+    """
+    indexes = []
+    while bits:
+        low = bits & -bits
+        indexes.append(low.bit_length() - 1)
+        bits ^= low
+    return indexes
+
+
+def pack(mismatch):
+    """
+    :param mismatch: boolean matrix (reads x target length)
+    :return: uint64 matrix (reads x words), bit i of a read is bit i % 64 of word i // 64
+    """
+    packed = np.packbits(mismatch, axis=1, bitorder='little')
+    pad = -packed.shape[1] % 8
+    if pad:
+        packed = np.pad(packed, ((0, 0), (0, pad)))
+    return np.ascontiguousarray(packed).view('<u8')
+
+
+def row_bits(packed, i):
+    """
+    :param packed: output of `pack`
+    :param i: row
+    :return: bitset of row `i` as an int
+    """
+    return int.from_bytes(packed[i].tobytes(), 'little')
@@ -0,0 +1,155 @@
+import json
+import os
+import time
+
+from deduper import dump_with_tally, read_rows, write_rows
+
+CHECKPOINT_VERSION = 2
+
+# Arguments that change how reads are classified; a checkpoint can only be resumed with the same values
+TARGET_ARGS = ('chrom', 'positions', 'bases', 'seq', 'target_bounds', 'strand', 'codon_distance_up',
+               'codon_distance_down', 'read_start', 'cigar_min', 'strict')
+
+
+def target_signature(args):
+    """
+    :param args: SamParser arguments
+    :return: dictionary of the arguments in TARGET_ARGS
+    """
+    # Round trip through JSON so lists/tuples compare equal to what is read back
+    return json.loads(json.dumps({k: args.get(k) for k in TARGET_ARGS}))
+
+
+def input_signature(args):
+    """
+    :param args: SamParser arguments
+    :return: dictionary identifying the input file and the target, stored with every checkpoint
+    """
+    stat = os.stat(args['samfile'])
+    signature = {'samfile': os.path.abspath(args['samfile']), 'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+    signature.update(target_signature(args))
+    # A checkpoint holds either the size of the codingdna file or its aggregated rows
+    signature['codingdna'] = args.get('codingdna', 'rows')
+    return signature
+
+
+def write_json(filename, content, final_dict=None):
+    """
+    Write a JSON file atomically: readers (and a resumed run) either see the previous file or the complete new one
+
+    :param final_dict: variant tally, written as content['final_dict'] (see `deduper.dump_with_tally`)
+    """
+    if final_dict is None:
+        write_atomic(filename, lambda w: json.dump(content, w))
+    else:
+        write_atomic(filename, lambda w: dump_with_tally(content, final_dict, w))
+
+
+def write_atomic(filename, write):
+    """
+    :param filename: output file, replaced once `write` has written and synced the whole content
+    :param write: function writing the content to a text file object
+    """
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as w:
+        write(w)
+        w.flush()
+        os.fsync(w.fileno())
+    os.replace(tmp, filename)
+
+
+def read_tally(filename):
+    """
+    :param filename: checkpoint file
+    :return: ('chr17:36:A:G', record) items of its variant tally, read one row at a time
+    """
+    with open(filename, 'r') as r:
+        r.readline()
+        yield from read_rows(r)
+
+
+class Checkpoint:
+    """
+    Periodic snapshots of a serial `SamParser` run over a plain SAM file.
+
+    A snapshot is only taken between two chunks of lines, after the pending batch has been classified, so the byte
+    offset, the counters, the variant tally and the size of the codingdna file always agree with each other.
+
+    The first line of the file holds everything but the variant tally, which follows one variant per line (the
+    format of the sorted runs of a spilled `VariantTally`), so neither saving nor resuming builds the whole tally in
+    memory: on resume the rows are merged into the tally one at a time and it spills within its `--tally_memory`
+    budget. Every snapshot still rewrites the whole tally, i.e. reads back the spilled runs and writes one line per
+    distinct variant, which is why snapshots are `interval` seconds apart.
+
+    Example:
+        {"version": 2, "signature": {"samfile": "/data/A1.fastq.gz.sam", "size": 8123456789, ...},
+         "offset": 1048576000, "codingdna_size": 52428800,
+         "counters": {"total_count": 3500000, "off_target": 410000, ...},
+         "pileup": {"total": [[3, 10234, 1, 0, 12], ...], "events": {}},
+         "codon_counts": {"aa": [[0, 0, 12, ...], ...], "codons": [[0, 3, 0, ...], ...]}}
+        ["chr17:36:A:G", {"chr": "chr17", "pos": 56772447, ..., "count": 1203}]
+        ...
+    """
+
+    def __init__(self, filename, interval, signature):
+        """
+        :param filename: checkpoint file
+        :param interval: minimum number of seconds between two snapshots
+        :param signature: output of `input_signature`
+        """
+        self.filename = filename
+        self.interval = interval
+        self.signature = signature
+        self.last = time.time()
+
+    def due(self):
+        return time.time() - self.last >= self.interval
+
+    def save(self, offset, counters, final_dict, dna_out, pileup=None, codon_counts=None):
+        """
+        :param offset: byte offset of the first line that has not been counted yet
+        :param counters: output of `SamParser.get_counters()`
+        :param final_dict: variant tally, see `deduper.add_to_dict`
+        :param dna_out: TSVWriter of the run (flushed, so its size on disk matches the tally, or its aggregated rows
+            are saved, see `TSVWriter.snapshot`)
+        :param pileup: output of `Pileup.to_dict()` (not saved if None)
+        :param codon_counts: output of `CodonCounts.to_dict()` (not saved if None)
+        """
+        content = {'version': CHECKPOINT_VERSION,
+                   'signature': self.signature,
+                   'offset': offset,
+                   'counters': counters}
+        content.update(dna_out.snapshot())
+        if pileup is not None:
+            content['pileup'] = pileup
+        if codon_counts is not None:
+            content['codon_counts'] = codon_counts
+
+        def write(w):
+            w.write(json.dumps(content) + '\n')
+            write_rows(final_dict.items(), w)
+
+        write_atomic(self.filename, write)
+        self.last = time.time()
+
+    def load(self):
+        """
+        :return: the last snapshot, None if there is none. Its 'final_dict' is an iterable of the variants that reads
+            them from the file while they are merged (see `read_tally`).
+        """
+        if not os.path.exists(self.filename):
+            return None
+        with open(self.filename, 'r') as r:
+            state = json.loads(r.readline())
+        if state.get('version') != CHECKPOINT_VERSION:
+            raise Exception(f"{self.filename} has checkpoint version {state.get('version')}, "
+                            f"expected {CHECKPOINT_VERSION}")
+        if state['signature'] != self.signature:
+            raise Exception(f"{self.filename} was written for a different SAM file or target, "
+                            f"remove it to start over")
+        state['final_dict'] = read_tally(self.filename)
+        return state
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
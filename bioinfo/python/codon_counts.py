@@ -0,0 +1,132 @@
+"""
+Amino acid and codon counts of the usable reads at every amino acid position of the target.
+
+Two integer matrices are kept: positions x 21 amino acids (`AMINO_ACID_CODES`, stops as 'X') and positions x 64
+codons (in `translate.CODON_TABLE` order, so column i codes for CODON_TABLE[i]). A batch of classified reads is
+added with one `np.add.at` per matrix, after collapsing identical changes.
+
+Example:
+    counts = CodonCounts(context)
+    counts.add([dna_results, ...])                  # outputs of `dna_functions.position_wrapper`
+    counts.aa[8, AA_INDEX['H']]                     -> 4100
+    counts.codons[8, codon_index('CAC')]            -> 3900
+"""
+from collections import Counter
+
+import numpy as np
+
+from target_context import AMINO_ACID_CODES
+from translate import BASES, CODON_TABLE, codon_index, reverse_complement
+
+AA_INDEX = {aa: i for i, aa in enumerate(AMINO_ACID_CODES)}
+
+# Codon of every column of the codon matrix
+CODON_NAMES = tuple(BASES[i // 16] + BASES[i // 4 % 4] + BASES[i % 4] for i in range(64))
+
+
+class CodonCounts:
+
+    def __init__(self, context):
+        """
+        :param context: TargetContext
+        """
+        self.strand = context.strand
+        self.reference_aa = context.reference_aa
+        coding = context.reference_dna_rc if context.strand == 'R' else context.reference_dna
+        self.reference_codons = [coding[3 * i:3 * i + 3] for i in range(context.reference_aa.__len__())]
+        self.aa = np.zeros((self.reference_aa.__len__(), AMINO_ACID_CODES.__len__()), dtype=np.int64)
+        self.codons = np.zeros((self.reference_aa.__len__(), CODON_NAMES.__len__()), dtype=np.int64)
+        # (AApos, AltAA, altDNA) -> matrix cells of the change, see `cells`
+        self._cells = dict()
+
+    def cells(self, aa_pos, alt_aa, alt_dna):
+        """
+        :param aa_pos: AApos reported by `position_wrapper`
+        :param alt_aa: AltAA reported by `position_wrapper`
+        :param alt_dna: altDNA (forward strand codons) reported by `position_wrapper`
+        :return: list of (row, amino acid column, codon column), codon column is -1 for codons with an N
+        """
+        codons = alt_dna.upper()
+        # AApos is the amino acid of the left-most forward strand base, which is the last one on the reverse strand
+        first = aa_pos
+        if self.strand == 'R':
+            codons = reverse_complement(codons)
+            first = aa_pos - alt_aa.__len__() + 1
+        res = []
+        for k, aa in enumerate(alt_aa):
+            row = first + k
+            if not 0 <= row < self.aa.shape[0]:
+                continue
+            res.append((row, AA_INDEX.get(aa.replace('*', 'X'), AA_INDEX['X']), codon_index(codons[3 * k:3 * k + 3])))
+        return res
+
+    def add(self, results):
+        """
+        :param results: `ReadClassification.dna_results` of the usable reads of a batch
+        """
+        changes = Counter([(r['AApos'], r['AltAA'], r['altDNA']) for r in results])
+        rows, aas, codons, counts = [], [], [], []
+        for key, count in changes.items():
+            cells = self._cells.get(key)
+            if cells is None:
+                cells = self._cells[key] = self.cells(*key)
+            for row, aa, codon in cells:
+                rows.append(row)
+                aas.append(aa)
+                codons.append(codon)
+                counts.append(count)
+        if rows.__len__() == 0:
+            return
+        rows = np.array(rows, dtype=np.intp)
+        codons = np.array(codons, dtype=np.intp)
+        counts = np.array(counts, dtype=np.int64)
+        np.add.at(self.aa, (rows, np.array(aas, dtype=np.intp)), counts)
+        known = codons >= 0
+        np.add.at(self.codons, (rows[known], codons[known]), counts[known])
+
+    def merge(self, other):
+        """
+        Add the counts of another CodonCounts of the same target (e.g. of a shard counted in another process)
+        """
+        self.aa += other.aa
+        self.codons += other.codons
+
+    def to_dict(self):
+        """
+        :return: JSON serializable counts (for checkpoints and counts files)
+        """
+        return {'aa': self.aa.tolist(), 'codons': self.codons.tolist()}
+
+    @classmethod
+    def from_dict(cls, context, content):
+        """
+        :param content: output of `to_dict`
+        """
+        counts = cls(context)
+        counts.aa += np.array(content['aa'], dtype=np.int64)
+        counts.codons += np.array(content['codons'], dtype=np.int64)
+        return counts
+
+    def write(self, prefix):
+        """
+        Write `<prefix>.aa_counts.tsv` (one row per position, one column per amino acid), `<prefix>.codon_counts.tsv`
+        (one row per position and codon, including the codons that were never seen) and `<prefix>.codon_counts.npz`
+        (both matrices). AApos is 0-based, like in the codingdna file.
+        """
+        with open(prefix + '.aa_counts.tsv', 'w') as w:
+            w.write('AApos\tRefAA\t' + '\t'.join(AMINO_ACID_CODES) + '\tTotal\n')
+            for i, row in enumerate(self.aa.tolist()):
+                w.write(f"{i}\t{self.reference_aa[i]}\t" + '\t'.join([str(x) for x in row]) + f"\t{sum(row)}\n")
+        with open(prefix + '.codon_counts.tsv', 'w') as w:
+            w.write('AApos\tRefCodon\tRefAA\tAltCodon\tAltAA\tCount\n')
+            for i, row in enumerate(self.codons.tolist()):
+                for j, count in enumerate(row):
+                    w.write(f"{i}\t{self.reference_codons[i]}\t{self.reference_aa[i]}\t{CODON_NAMES[j]}\t"
+                            f"{CODON_TABLE[j]}\t{count}\n")
+        np.savez_compressed(prefix + '.codon_counts.npz',
+                            aa=self.aa,
+                            codons=self.codons,
+                            aa_codes=np.array(AMINO_ACID_CODES),
+                            codon_names=np.array(CODON_NAMES),
+                            ref_aa=np.array(list(self.reference_aa)),
+                            ref_codons=np.array(self.reference_codons))
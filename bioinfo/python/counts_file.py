@@ -0,0 +1,85 @@
+"""
+Mergeable per-run intermediate of `SamParser.process_sam`.
+
+`.all.vcf`, `.metrics.tsv` and `.codingdna.tsv` are reports and can't be summed, so every run also writes
+`<sample>.counts.json.gz` with the raw counters and the variant tally. Runs over different reads of the same target
+(lanes, top-up sequencing) are combined with `main.py merge`, which regenerates the reports.
+
+Example:
+    {'format': 'ssm-counts', 'version': 1,
+     'target': {'chrom': 'chr17', 'positions': [56772452], 'bases': ['A'], ...},
+     'counters': {'total_count': 3500000, 'off_target': 410000, ..., 'cache_hits': 3100000, 'cache_misses': 12000},
+     'final_dict': {'chr17:36:A:G': {'chr': 'chr17', 'pos': 56772447, ..., 'count': 1203}, ...},
+     'codingdna': 'A1.fastq.codingdna.tsv',
+     'pileup': {'total': [[3, 10234, 1, 0, 12], ...], 'events': {'missense_count': [[0, 4100, 0, 0, 3], ...], ...}},
+     'codon_counts': {'aa': [[0, 0, 12, ...], ...], 'codons': [[0, 3, 0, ...], ...]}}
+"""
+import gzip
+import json
+import os
+
+from deduper import merge_dicts, dump_with_tally, VariantTally
+
+COUNTS_FORMAT = 'ssm-counts'
+COUNTS_VERSION = 1
+
+
+def write_counts(filename, target, counters, final_dict, codingdna, pileup=None, codon_counts=None):
+    """
+    :param filename: output file (.counts.json.gz)
+    :param target: output of `checkpoint.target_signature`
+    :param counters: output of `SamParser.get_counters()`
+    :param final_dict: variant tally, see `deduper.add_to_dict`
+    :param codingdna: codingdna file written by the same run
+    :param pileup: output of `Pileup.to_dict()` (not written if None)
+    :param codon_counts: output of `CodonCounts.to_dict()` (not written if None)
+    """
+    content = {'format': COUNTS_FORMAT,
+               'version': COUNTS_VERSION,
+               'target': target,
+               'counters': counters,
+               'codingdna': os.path.basename(codingdna)}
+    if pileup is not None:
+        content['pileup'] = pileup
+    if codon_counts is not None:
+        content['codon_counts'] = codon_counts
+    tmp = filename + '.tmp'
+    with gzip.open(tmp, 'wt') as w:
+        dump_with_tally(content, final_dict, w)
+    os.replace(tmp, filename)
+
+
+def read_counts(filename):
+    """
+    :param filename: file written by `write_counts`
+    :return: dictionary (see the module docstring), with 'codingdna' resolved relative to the counts file
+    """
+    with gzip.open(filename, 'rt') as r:
+        counts = json.load(r)
+    if counts.get('format') != COUNTS_FORMAT:
+        raise Exception(f"{filename} is not an SSM counts file")
+    if counts.get('version') != COUNTS_VERSION:
+        raise Exception(f"{filename} has counts version {counts.get('version')}, expected {COUNTS_VERSION}")
+    counts['codingdna'] = os.path.join(os.path.dirname(filename), counts['codingdna'])
+    return counts
+
+
+def merge_counts(counts_list):
+    """
+    Sum the counters and merge the variant tallies of runs over the same target
+
+    :param counts_list: outputs of `read_counts`, in the order the reads should be considered
+        (variants are listed in the order they were first seen)
+
+    :return: target, counters, final_dict
+    """
+    target = counts_list[0]['target']
+    counters = dict()
+    final_dict = VariantTally()
+    for counts in counts_list:
+        if counts['target'] != target:
+            raise Exception(f"Can't merge counts of different targets: {target} and {counts['target']}")
+        for k, v in counts['counters'].items():
+            counters[k] = counters.get(k, 0) + v
+        final_dict = merge_dicts(final_dict, counts['final_dict'])
+    return target, counters, final_dict
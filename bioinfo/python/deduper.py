@@ -1,10 +1,25 @@
+import heapq
+import json
+import os
+import shutil
+import tempfile
+from operator import attrgetter
+
+# Approximate memory taken by one variant of the tally (key tuple, id, record and count)
+RECORD_BYTES = 400
+
+# Annotation of a variant, in the order of the records of `VariantTally.items()`
+FIELDS = ('chr', 'pos', 'ref', 'alt', 'RefAA', 'AltAA', 'RefCodon', 'AltCodon', 'AApos', 'EventType')
+_get_fields = attrgetter(*FIELDS)
+
+
 def add_to_dict(final_dict, strand, mmmc_dict, dna_results_dict=None, chrom=None, read_start=None):
     """
     Create a non-redundant set of annotations
 
     For non-coding variants, the dna_results_dict will be none
 
-    final_dict
+    final_dict: VariantTally
 
     Amino acid-based
     mmmc_dict = {'frameshift': False, 'event_type': 'Missense', 'pos': 8, 'ref': 'A', 'alt': 'H'}
@@ -15,49 +30,254 @@ def add_to_dict(final_dict, strand, mmmc_dict, dna_results_dict=None, chrom=None
     Only present when there is a coding mutation
     dna_results_dict = {'pos_ref_alt': [89, 89, 'T', 'G'], 'RefAA': 'G', 'AltAA': 'G', 'cons': True, 'AApos': 29, 'refDNA': 'GGT', 'altDNA': 'GGG'}
     """
+    final_dict.add(mmmc_dict, dna_results_dict, chrom, read_start)
+    return final_dict
+
+
+def merge_dicts(final_dict, other_dict):
+    """
+    Merge two non-redundant sets of annotations (see `add_to_dict`)
 
-    # Create a dictionary key if it doesn't exist
-    if dna_results_dict is not None:
-        # This is for coding mutations
-        dict_key = str(chrom) + ":" + \
-                   str(dna_results_dict['pos_ref_alt'][0]) + ":" + \
-                   str(dna_results_dict['pos_ref_alt'][2]) + ":" + \
-                   str(dna_results_dict['pos_ref_alt'][3])
-        chr = str(chrom)
-        pos = read_start + int(dna_results_dict['pos_ref_alt'][0])
-        ref = dna_results_dict['pos_ref_alt'][2]
-        alt = dna_results_dict['pos_ref_alt'][3]
-        RefAA = dna_results_dict['RefAA']
-        AltAA = dna_results_dict['AltAA']
-        RefCodon = dna_results_dict['refDNA']
-        AltCodon = dna_results_dict['altDNA']
-        AApos = dna_results_dict['AApos']
-        EventType = mmmc_dict['event_type']
-    else:
-        # This is a non-coding mutation
-        dict_key = str(chrom) + ":" + \
-                   str(mmmc_dict['pos']) + ":" + \
-                   str(mmmc_dict['ref']) + ":" + \
-                   str(mmmc_dict['alt'])
-        chr = str(chrom)
-        pos = read_start + int(mmmc_dict['pos'])
-        ref = mmmc_dict['ref']
-        alt = mmmc_dict['alt']
-        RefAA = '.'
-        AltAA = '.'
-        RefCodon = '.'
-        AltCodon = '.'
-        AApos = '.'
-        EventType = mmmc_dict['event_type']
-
-    if dict_key not in final_dict.keys():
-        final_dict[dict_key] = dict()
-        final_dict[dict_key]['count'] = 0
-
-    new_dict = {'chr': chr, 'pos': pos, 'ref': ref, 'alt': alt,
-                'RefAA': RefAA, 'AltAA': AltAA,
-                'RefCodon': RefCodon, 'AltCodon': AltCodon,
-                'AApos': AApos, 'EventType': EventType, 'count': final_dict[dict_key]['count']}
-    final_dict[dict_key] = new_dict
-    final_dict[dict_key]['count'] += 1
+    Variants of `other_dict` that are already present have their counts summed, new ones are appended in the order
+    they appear in `other_dict`, so merging per-shard tallies in file order gives the same tally as a serial run.
+
+    :param final_dict: VariantTally to merge into
+    :param other_dict: VariantTally, or a dictionary read back from a counts file or a checkpoint
+
+    :return: final_dict
+    """
+    final_dict.merge(other_dict)
     return final_dict
+
+
+class VariantRecord:
+    """
+    Static annotation of a variant, stored once however many reads carry it
+    """
+    __slots__ = FIELDS
+
+    def __init__(self, *values):
+        for field, value in zip(FIELDS, values):
+            setattr(self, field, value)
+
+    def to_dict(self, count):
+        """
+        :return: {'chr': 'chr13', 'pos': 24, ..., 'EventType': 'Missense', 'count': count}
+        """
+        record = dict(zip(FIELDS, _get_fields(self)))
+        record['count'] = count
+        return record
+
+
+class VariantTally:
+    """
+    Variant tally (see `add_to_dict`) that keeps at most `memory_mb` of variants in memory.
+
+    A variant is identified by (chrom, index in the target, ref, alt) and gets an integer id the first time it is
+    seen; its annotation is stored once as a VariantRecord, so every further read only increments `counts[id]`.
+    `items()` gives the usual 'chr17:36:A:G' -> record dictionaries in the order variants were first seen.
+
+    When the budget is reached, the variants in memory are written to disk as a run sorted by position and the tally
+    is emptied. A variant can then have partial counts in several runs and in memory; `items()` merges them back
+    (summing the counts), so `VCFWriter.write`, `merge_dicts` and the counts file see one record per variant. Once
+    runs exist, records come out in coordinate order, which `sorted_items()` always gives.
+
+    Example:
+        final_dict = VariantTally(memory_mb=1024)
+        final_dict = add_to_dict(final_dict, 'F', mmmc_dict, dna_results_dict, chrom='chr17', read_start=56772411)
+        for k, v in final_dict.sorted_items():
+            ...
+        final_dict.close()
+    """
+
+    def __init__(self, memory_mb=0, tmp_dir=None):
+        """
+        :param memory_mb: memory budget of the variants in memory (0 keeps everything in memory)
+        :param tmp_dir: directory for the sorted runs (default: $TMPDIR)
+        """
+        self.max_records = max(int(memory_mb * (1 << 20) // RECORD_BYTES), 1) if memory_mb > 0 else 0
+        self.tmp_dir = tmp_dir
+        self.run_dir = None
+        self.runs = []
+        # (chrom, index, ref, alt) -> id
+        self.ids = dict()
+        # id -> VariantRecord
+        self.records = []
+        # id -> number of reads
+        self.counts = []
+
+    def __len__(self):
+        return self.records.__len__()
+
+    def add(self, mmmc_dict, dna_results_dict=None, chrom=None, read_start=None):
+        """
+        Count a read, see `add_to_dict`
+        """
+        if dna_results_dict is not None:
+            # This is for coding mutations
+            pos_ref_alt = dna_results_dict['pos_ref_alt']
+            key = (chrom, pos_ref_alt[0], pos_ref_alt[2], pos_ref_alt[3])
+        else:
+            # This is a non-coding mutation
+            key = (chrom, mmmc_dict['pos'], mmmc_dict['ref'], mmmc_dict['alt'])
+        i = self.ids.get(key)
+        if i is None:
+            i = self._new(key, self._record(mmmc_dict, dna_results_dict, chrom, read_start))
+        self.counts[i] += 1
+
+    @staticmethod
+    def _record(mmmc_dict, dna_results_dict, chrom, read_start):
+        if dna_results_dict is not None:
+            pos_ref_alt = dna_results_dict['pos_ref_alt']
+            return VariantRecord(str(chrom), read_start + int(pos_ref_alt[0]), pos_ref_alt[2], pos_ref_alt[3],
+                                 dna_results_dict['RefAA'], dna_results_dict['AltAA'],
+                                 dna_results_dict['refDNA'], dna_results_dict['altDNA'],
+                                 dna_results_dict['AApos'], mmmc_dict['event_type'])
+        return VariantRecord(str(chrom), read_start + int(mmmc_dict['pos']), mmmc_dict['ref'], mmmc_dict['alt'],
+                             '.', '.', '.', '.', '.', mmmc_dict['event_type'])
+
+    def _new(self, key, record):
+        """
+        :return: id of a variant that is not in memory yet
+        """
+        if self.max_records and self.records.__len__() >= self.max_records:
+            self.spill()
+        i = self.records.__len__()
+        self.ids[key] = i
+        self.records.append(record)
+        self.counts.append(0)
+        return i
+
+    def merge(self, other):
+        """
+        :param other: VariantTally, a dictionary of 'chr17:36:A:G' -> record (with 'count'), or an iterable of
+            ('chr17:36:A:G', record) items (e.g. `read_rows`), which is merged one variant at a time
+        """
+        if isinstance(other, VariantTally) and other.runs.__len__() == 0:
+            # Same process or a worker that never spilled: no need to go through the dictionaries
+            for key, j in other.ids.items():
+                i = self.ids.get(key)
+                if i is None:
+                    i = self._new(key, other.records[j])
+                self.counts[i] += other.counts[j]
+            return
+        for k, v in (other.items() if hasattr(other, 'items') else other):
+            key = _parse_key(k)
+            i = self.ids.get(key)
+            if i is None:
+                i = self._new(key, VariantRecord(*[v[field] for field in FIELDS]))
+            self.counts[i] += v['count']
+
+    def spill(self):
+        """
+        Write the variants in memory to a sorted run and empty the tally
+        """
+        if self.run_dir is None:
+            self.run_dir = tempfile.mkdtemp(prefix='ssm_tally.', dir=self.tmp_dir)
+        filename = os.path.join(self.run_dir, f'run{self.runs.__len__()}.jsonl')
+        with open(filename, 'w') as w:
+            write_rows(sorted(self._memory_items(), key=_position), w)
+        self.runs.append(filename)
+        self.ids = dict()
+        self.records = []
+        self.counts = []
+
+    def _memory_items(self):
+        for key, i in self.ids.items():
+            yield _format_key(key), self.records[i].to_dict(self.counts[i])
+
+    def items(self):
+        """
+        :return: (key, record) of every variant, with the counts of all runs summed
+        """
+        if self.runs.__len__() == 0:
+            return self._memory_items()
+        return self._merged()
+
+    def sorted_items(self):
+        """
+        :return: same as `items()`, in coordinate order
+        """
+        if self.runs.__len__() == 0:
+            return iter(sorted(self._memory_items(), key=_position))
+        return self._merged()
+
+    def _merged(self):
+        memory = sorted(self._memory_items(), key=_position)
+        last_key = None
+        last = None
+        for k, v in heapq.merge(memory, *[_read_run(r) for r in self.runs], key=_position):
+            if k == last_key:
+                last['count'] += v['count']
+                continue
+            if last is not None:
+                yield last_key, last
+            last_key, last = k, v
+        if last is not None:
+            yield last_key, last
+
+    def close(self):
+        """
+        Remove the runs written to disk
+        """
+        if self.run_dir is not None:
+            shutil.rmtree(self.run_dir, ignore_errors=True)
+        self.run_dir = None
+        self.runs = []
+
+
+def _format_key(key):
+    # (chrom, index, ref, alt) -> 'chr17:36:A:G'
+    return f'{key[0]}:{key[1]}:{key[2]}:{key[3]}'
+
+
+def _parse_key(k):
+    # 'chr17:36:A:G' -> (chrom, index, ref, alt), chromosome names can contain ':'
+    chrom, index, ref, alt = k.rsplit(':', 3)
+    return chrom, int(index), ref, alt
+
+
+def _position(item):
+    # Runs are sorted by position, the key breaks ties between variants starting at the same base
+    return item[1]['pos'], item[0]
+
+
+def _read_run(filename):
+    with open(filename, 'r') as r:
+        yield from read_rows(r)
+
+
+def write_rows(items, w):
+    """
+    Write variants one JSON row at a time, the format of the sorted runs and of checkpoints
+
+    :param items: ('chr17:36:A:G', record) items, e.g. `VariantTally.items()`
+    :param w: text file object
+    """
+    for k, v in items:
+        w.write(json.dumps([k, v]) + '\n')
+
+
+def read_rows(r):
+    """
+    :param r: text file object positioned at the first row written by `write_rows`
+    :return: ('chr17:36:A:G', record) items, read one row at a time
+    """
+    for row in r:
+        k, v = json.loads(row)
+        yield k, v
+
+
+def dump_with_tally(content, final_dict, w):
+    """
+    Write `content` as a JSON object with `final_dict` as its 'final_dict' member, without building a copy of a
+    spilled tally in memory
+
+    :param content: dictionary of the other members
+    :param final_dict: dictionary or VariantTally
+    :param w: text file object
+    """
+    w.write(json.dumps(content)[:-1] + (', ' if content else '') + '"final_dict": {')
+    for i, (k, v) in enumerate(final_dict.items()):
+        w.write((', ' if i else '') + json.dumps(k) + ': ' + json.dumps(v))
+    w.write('}}')
@@ -1,4 +1,4 @@
-from Bio.Seq import Seq
+from translate import translate, translate_rc
 
 
 def get_dna_changes(reference_seq, alt_seq):
@@ -187,12 +187,12 @@ def get_affected_amino_acid(pos_ref_alt, seq, distance_to_change, other_dict, st
 
     # Define the reference amino acid sequence
     if strand == 'F':
-        refAA = Seq(refDNA).transcribe().translate(to_stop=False).__str__()
-        altAA = Seq(altDNA).transcribe().translate(to_stop=False).__str__()
+        refAA = translate(refDNA)
+        altAA = translate(altDNA)
         AApos = (new_start - unc_len - usc_len) // 3
     else:
-        refAA = Seq(refDNA).reverse_complement().transcribe().translate(to_stop=False).__str__()
-        altAA = Seq(altDNA).reverse_complement().transcribe().translate(to_stop=False).__str__()
+        refAA = translate_rc(refDNA)
+        altAA = translate_rc(altDNA)
         AApos = (us_len - new_start - 1) // 3   # Should be 0-based
     return refAA, altAA, refDNA, altDNA, AApos
 
@@ -258,6 +258,18 @@ def position_wrapper(read, target_dict, read_start, other_dict, strand):
     """
     mmc = get_dna_changes(target_dict['seq'], read)
     mmc = remove_expected_changes(mmc, target_dict['mmc'], 0)
+    return position_from_changes(mmc, read, target_dict, read_start, other_dict, strand)
+
+
+def position_from_changes(mmc, read, target_dict, read_start, other_dict, strand):
+    """
+    `position_wrapper` for a read whose unexpected DNA changes are already known
+
+    :param mmc: unexpected DNA changes of the read, see `get_dna_changes` and `remove_expected_changes`
+    :param read: full read from SAM file
+
+    :return: see `position_wrapper`
+    """
     cons = is_consecutive(mmc)
     pos_ref_alt = trim_contig(mmc, target_dict['seq'], read)
     RefAA, AltAA, refDNA, altDNA, AApos = get_affected_amino_acid(pos_ref_alt, target_dict['seq'],
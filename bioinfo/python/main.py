@@ -1,25 +1,67 @@
 """Console script for Site saturation mutagenesis experiments."""
 import argparse
+import glob
 import logging
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 
 sys.path.insert(0, os.path.dirname(__file__))
-from CountReads import CountReads
+from CountReads import CountReads, ReadClassifier
+from target_context import TargetContext
 from parse_cigar import split_cigar, filter_matches
-import dna_functions as dnaf
-from output import VCFWriter, TSVWriter, MetricsWriter
-from deduper import add_to_dict
+from output import VCFWriter, TSVWriter, MetricsWriter, ReadTableWriter
+from deduper import add_to_dict, merge_dicts, VariantTally
+from read_cache import ClassificationCache
+from batch_engine import BatchScanner
+from checkpoint import Checkpoint, input_signature, target_signature, write_json
+from counts_file import write_counts, read_counts, merge_counts
+from outcome_table import build_outcome_table, MAX_SPAN
+from pileup import Pileup
+from codon_counts import CodonCounts
+from profiler import StageProfiler
+from run_metrics import RunStats, write_prometheus
+from sam_io import split_sam, map_sam, skip_header, iter_chunks, open_sam, get_compression, \
+    is_alignment_file, open_alignment_file, count_records, fetch_start_reads, read_contigs
+
+# Read counters kept by SamParser
+COUNTERS = ('total_count', 'off_target', 'cigar_count', 'invalid_count', 'mm_count', 'frameshift_count',
+            'nochange_count', 'synonymous_count', 'missense_count', 'stop_count', 'mixed_count',
+            'multi_synonymous_count', 'noncoding_count')
+
+# Counters in the .metrics.tsv table (after sample_name and total_count), reported with their share of all reads
+METRICS_COUNTERS = ('off_target', 'cigar_count', 'invalid_count', 'mm_count', 'frameshift_count', 'nochange_count',
+                    'synonymous_count', 'missense_count', 'stop_count', 'mixed_count', 'multi_synonymous_count',
+                    'usable_count')
 
 
 # noinspection DuplicatedCode
 def parse_args():
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("-s", "--sam",
-                        dest='samfile',
-                        required=True,
-                        help="SAM file containing reads")
+    samples = parser.add_mutually_exclusive_group(required=True)
+    samples.add_argument("-s", "--sam",
+                         dest='samfile',
+                         help="SAM file containing reads (or a coordinate sorted and indexed BAM/CRAM file). "
+                              "A quoted glob pattern (e.g. 'out/*/*.fastq.gz.sam') processes every matching file")
+
+    samples.add_argument("--sample_sheet",
+                         dest='sample_sheet',
+                         help="File listing one SAM/BAM/CRAM file per line (first tab-separated column, "
+                              "'#' comments), all processed for the same target")
+
+    parser.add_argument("--combined_metrics",
+                        dest='combined_metrics',
+                        default='combined',
+                        help="Prefix of the metrics table collecting every sample of a sample sheet or glob, "
+                             "<combined_metrics>.combined_metrics.txt")
+
+    parser.add_argument("-T", "--reference_fasta",
+                        dest='reference_fasta',
+                        default=None,
+                        help="Reference genome used to decode CRAM input")
 
     parser.add_argument("-c", "--chrom",
                         dest='chrom',
@@ -89,6 +131,89 @@ def parse_args():
                         type=bool,
                         help="Set this flag if you want to require only 1 required base change instead of all")
 
+    parser.add_argument("-w", "--workers",
+                        dest='workers',
+                        default=1,
+                        type=int,
+                        help="Number of processes used to classify reads (the SAM file is split into that many shards, "
+                             "or that many samples are processed at once)")
+
+    parser.add_argument("-t", "--threads",
+                        dest='threads',
+                        default=2,
+                        type=int,
+                        help="Threads used to decompress BGZF input")
+
+    parser.add_argument("--batch_size",
+                        dest='batch_size',
+                        default=65536,
+                        type=int,
+                        help="Number of reads compared with the target at once")
+
+    parser.add_argument("--cache_size",
+                        dest='cache_size',
+                        default=100000,
+                        type=int,
+                        help="Number of distinct read sequences whose classification is kept in memory (0 disables)")
+
+    parser.add_argument("--checkpoint_interval",
+                        dest='checkpoint_interval',
+                        default=600,
+                        type=int,
+                        help="Seconds between checkpoints of a plain SAM file counted by one worker (0 disables)")
+
+    parser.add_argument("--resume",
+                        dest='resume',
+                        action='store_true',
+                        help="Continue from the checkpoint left by an interrupted run of the same SAM file and target")
+
+    parser.add_argument("--tally_memory",
+                        dest='tally_memory',
+                        default=1024,
+                        type=int,
+                        help="MB of variant records kept in memory before sorted runs are spilled to disk (0 disables)")
+
+    parser.add_argument("--tmp_dir",
+                        dest='tmp_dir',
+                        default=None,
+                        help="Directory for spilled variant records (default: $TMPDIR)")
+
+    parser.add_argument("--read_table",
+                        dest='read_table',
+                        default=None,
+                        choices=['parquet', 'arrow'],
+                        help="Also write the classification of every on-target read to <sample>.reads.parquet "
+                             "(or an Arrow IPC stream, <sample>.reads.arrows). Requires pyarrow")
+
+    parser.add_argument("--profile",
+                        dest='profile',
+                        action='store_true',
+                        help="Time every counting stage and write <sample>.profile.json next to the metrics")
+
+    parser.add_argument("--prometheus_dir",
+                        dest='prometheus_dir',
+                        default=None,
+                        help="Also write the counters, throughput and resource usage of every sample as a "
+                             "node_exporter textfile, <prometheus_dir>/<sample>.prom")
+
+    parser.add_argument("--bgzip_vcf",
+                        dest='bgzip_vcf',
+                        action='store_true',
+                        help="Write <sample>.all.vcf.gz (BGZF) with a tabix index instead of <sample>.all.vcf")
+
+    parser.add_argument("--codingdna",
+                        dest='codingdna',
+                        default='rows',
+                        choices=['rows', 'counts', 'counts.gz'],
+                        help="rows: one row per usable read in <sample>.codingdna.tsv. counts: every distinct row once, "
+                             "with a Count column. counts.gz: the same, gzip compressed (<sample>.codingdna.tsv.gz)")
+
+    parser.add_argument("--pileup_by_event",
+                        dest='pileup_by_event',
+                        action='store_true',
+                        help="Also split the base counts of <sample>.pileup.tsv/.npz by read counter (e.g. "
+                             "missense_count, invalid_count)")
+
     parser.add_argument("-V", "--verbose",
                         dest="logLevel",
                         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
@@ -117,24 +242,55 @@ class SamParser:
         self.target_dict = self.build_target_dict(args)
         self.indicator_dict = self.build_indicator_dict(args)
         self.validate_args()
-        self.sample_name = os.path.basename(args['samfile']).replace(".sam", "")
+        # Everything that only depends on the target is computed once and shared by all reads
+        self.context = TargetContext.build(self.target_dict, self.read_start)
+        self.classifier = ReadClassifier(self.context)
+        self.sample_name = input_sample_name(args['samfile'])
         self.set_logger()
-        self.mm_count = 0
-        self.invalid_count = 0
-        self.total_count = 0
-        self.usable_count = 0
-        self.frameshift_count = 0
-        self.nochange_count = 0
-        self.synonymous_count = 0
-        self.missense_count = 0
-        self.stop_count = 0
-        self.cigar_count = 0
-        self.off_target = 0
-        self.mixed_count = 0
-        self.multi_synonymous_count = 0
-        self.noncoding_count = 0
+        self.reset_counters()
         self.cigar_min = args['cigar_min']
         self.strict = args['strict']
+        self.cache = ClassificationCache(maxsize=args.get('cache_size', 100000))
+        self.workers = args.get('workers', 1)
+        self.scanner = BatchScanner(self.context, strict=self.strict)
+        self.batch_size = args.get('batch_size', 65536)
+        self.batch = []
+        self.batch_names = []
+        # ReadTableWriter of the current run, only set with --read_table
+        self.read_table = None
+        # StageProfiler of the current run, only set with --profile
+        self.profiler = None
+        self.cigar_cache = dict()
+        # Nearly all usable reads are one of the designed changes, so classify those up front
+        self.outcome_table = build_outcome_table(self.context, args['bases'], self.classify_read)
+        self.table_hits = 0
+
+    def reset_counters(self):
+        """
+        Zero all read counters (the target, the outcome table and the classification cache are kept)
+        """
+        for k in COUNTERS:
+            setattr(self, k, 0)
+        self.usable_count = 0
+        self.table_hits = 0
+        self.pileup = Pileup(self.context.seq, self.read_start, by_event=self.args.get('pileup_by_event', False))
+        self.codon_counts = CodonCounts(self.context)
+        if hasattr(self, 'cache'):
+            self.cache.hits = 0
+            self.cache.misses = 0
+
+    def set_sample(self, samfile):
+        """
+        Point the parser at another SAM file of the same target, so everything derived from the target is reused
+
+        :param samfile: SAM/BAM/CRAM file
+        """
+        self.args = dict(self.args, samfile=samfile)
+        self.sample_name = input_sample_name(samfile)
+        self.validate_args()
+        self.batch = []
+        self.batch_names = []
+        self.reset_counters()
 
     def validate_args(self):
         assert os.path.exists(self.args['samfile']), "Must provide args.samfile"
@@ -231,6 +387,455 @@ class SamParser:
             del tmpdict
         return indicator_dict
 
+    def classify_read(self, seq):
+        """
+        Classify a read that starts at `read_start` and passed the CIGAR filter
+
+        The read is scanned once: the validity check, the amino acid event and the codingdna annotation all come
+        from the same comparison with the target (see `ReadClassifier.classify`).
+
+        :param seq: SEQ field of the SAM record
+        :return: ReadClassification
+            counter: name of the SamParser counter this read is tallied under (e.g. 'missense_count')
+            mismatches: amino acid (or DNA) mismatch indexes
+            event: the event, see `ReadClassifier.get_mismatch_counts`
+            dna_results: output of `dna_functions.position_wrapper` for usable reads, None otherwise
+        """
+        # Limit the length of the read to the desired target sequence, and if necessary,
+        # skip the required number of bases until you hit the amino acid/frame of interest
+        # (Codon distance parameter) and [Downstream distance parameter]
+        # Remove variants that go beyond the coding sequence
+        # [Upstream distance parameter]
+        return self.classifier.classify(seq, strict=self.strict)
+
+    def count_rows(self, rows, dna_out, final_dict):
+        """
+        Count and classify SAM lines
+
+        :param rows: iterable of SAM lines (header lines are skipped)
+        :param dna_out: TSVWriter receiving a row for every usable read
+        :param final_dict: variant tally, see `deduper.add_to_dict`
+
+        :return: final_dict
+        """
+        for row in rows:
+            # Parse the files, skipping over headers
+            if row.startswith('@'):
+                continue
+            # Now we're counting reads
+            line = row.strip().split('\t')
+            self.total_count += 1
+
+            # Make sure the read starts exactly in the same place that you're expecting one to be
+            if int(line[3]) != self.read_start or line[2] != self.target_dict['chrom']:
+                self.off_target += 1
+                continue
+
+            # Ensure that all elements of the SAM file are present
+            seq = line[9] if line.__len__() >= 10 else None
+            final_dict = self.count_alignment(line[5], seq, dna_out, final_dict, name=line[0])
+        return self.flush_batch(dna_out, final_dict)
+
+    def count_buffer(self, buf, start, end, dna_out, final_dict, checkpoint=None):
+        """
+        Count and classify the SAM lines of a memory-mapped file
+
+        Same as `count_rows`, but works on bytes and only splits a line as far as needed: RNAME and POS are checked
+        first, and CIGAR and SEQ are only split off (and SEQ decoded) for reads that start in the right place. The
+        quality string and tags are never split.
+
+        :param buf: SAM file contents (see `sam_io.map_sam`)
+        :param start: byte offset of the first line
+        :param end: stop before the line starting at this byte offset
+        :param dna_out: TSVWriter receiving a row for every usable read
+        :param final_dict: variant tally, see `deduper.add_to_dict`
+        :param checkpoint: Checkpoint that is saved between chunks when it is due (None to disable)
+
+        :return: final_dict
+        """
+        chrom = self.target_dict['chrom'].encode()
+        read_start = self.read_start
+        # Read names are only kept for the per-read table
+        read_table = self.read_table
+        offset = skip_header(buf, start)
+        for chunk in iter_chunks(buf, offset, end):
+            offset += chunk.__len__()
+            lines = chunk.split(b'\n')
+            if chunk.endswith(b'\n'):
+                lines.pop()
+            self.total_count += lines.__len__()
+            for line in lines:
+                # Make sure the read starts exactly in the same place that you're expecting one to be
+                line = line.split(b'\t', 4)
+                if int(line[3]) != read_start or line[2] != chrom:
+                    self.off_target += 1
+                    continue
+
+                # MAPQ, CIGAR, RNEXT, PNEXT, TLEN, SEQ and the rest of the line
+                rest = line[4].split(b'\t', 6)
+                cigar = rest[1] if rest.__len__() > 2 else rest[1].rstrip()
+                if not self.passes_cigar(cigar):
+                    self.cigar_count += 1
+                    if read_table is not None:
+                        read_table.add(line[0], 'cigar_count')
+                    continue
+
+                # Ensure that all elements of the SAM file are present
+                if rest.__len__() < 6:
+                    continue
+                seq = (rest[5] if rest.__len__() > 6 else rest[5].rstrip()).decode()
+
+                self.batch.append(seq)
+                if read_table is not None:
+                    self.batch_names.append(line[0])
+                if self.batch.__len__() >= self.batch_size:
+                    final_dict = self.flush_batch(dna_out, final_dict)
+
+            if checkpoint is not None and checkpoint.due():
+                final_dict = self.flush_batch(dna_out, final_dict)
+                checkpoint.save(offset, self.get_counters(), final_dict, dna_out, self.pileup.to_dict(),
+                                self.codon_counts.to_dict())
+                self.logger.info(f"Checkpoint at byte {offset} of {end}")
+        return self.flush_batch(dna_out, final_dict)
+
+    def new_tally(self):
+        """
+        :return: empty variant tally with the memory budget of the run
+        """
+        return VariantTally(memory_mb=self.args.get('tally_memory', 0), tmp_dir=self.args.get('tmp_dir'))
+
+    def passes_cigar(self, cigar):
+        """
+        :param cigar: CIGAR string (str or bytes) of a read
+        :return: whether the read passes the CIGAR filter. Libraries only have a handful of distinct CIGAR strings, so
+            the result is remembered for each of them.
+        """
+        passes = self.cigar_cache.get(cigar)
+        if passes is None:
+            text = cigar.decode() if isinstance(cigar, bytes) else cigar
+            passes = filter_matches(split_cigar(text), min_matches=self.cigar_min) is not False
+            self.cigar_cache[cigar] = passes
+        return passes
+
+    def count_alignment(self, cigar, seq, dna_out, final_dict, name=None):
+        """
+        Count and classify a read that starts at `read_start` on the target chromosome
+
+        :param cigar: CIGAR string of the read
+        :param seq: SEQ of the read (None if the SAM line is incomplete)
+        :param dna_out: TSVWriter receiving a row for every usable read
+        :param final_dict: variant tally, see `deduper.add_to_dict`
+        :param name: QNAME of the read (only used for the per-read table)
+
+        :return: final_dict
+        """
+        # Skip if the CIGAR string is messy
+        if not self.passes_cigar(cigar):
+            self.cigar_count += 1
+            if self.read_table is not None:
+                self.read_table.add(name, 'cigar_count')
+            return final_dict
+
+        if seq is None:
+            return final_dict
+
+        self.batch.append(seq)
+        if self.read_table is not None:
+            self.batch_names.append(name)
+        if self.batch.__len__() >= self.batch_size:
+            final_dict = self.flush_batch(dna_out, final_dict)
+        return final_dict
+
+    def flush_batch(self, dna_out, final_dict):
+        """
+        Classify the reads waiting in `self.batch`
+
+        The DNA mismatch scan and the check for the required changes are done for the whole batch at once. Only the
+        reads that have changes besides the expected ones are classified one by one, in their original order.
+
+        :param dna_out: TSVWriter receiving a row for every usable read
+        :param final_dict: variant tally, see `deduper.add_to_dict`
+
+        :return: final_dict
+        """
+        seqs = self.batch
+        if seqs.__len__() == 0:
+            return final_dict
+        self.batch = []
+        scan = self.scanner.scan(seqs)
+        valid = scan['valid']
+        changed = valid & (scan['extra_count'] > 0)
+        # Not all the expected sequences were found
+        self.invalid_count += int((~valid).sum())
+        # Only the expected changes were found
+        self.nochange_count += int((valid & ~changed).sum())
+        first = scan['first'].tolist()
+        last = scan['last'].tolist()
+        table = self.outcome_table
+        classifications = dict()
+        for i in np.flatnonzero(changed).tolist():
+            seq = seqs[i]
+            # Single base changes and codon substitutions are looked up by their mismatch signature
+            classification = None
+            if last[i] - first[i] <= MAX_SPAN:
+                classification = table.get((first[i], seq[first[i]:last[i] + 1]))
+                if classification is not None:
+                    self.table_hits += 1
+            if classification is None:
+                classification = self.classify_cached(seq, self.scanner.read_key(scan, i))
+            classifications[i] = classification
+            final_dict = self.tally_classification(classification, dna_out, final_dict)
+        self.add_pileup(scan, classifications)
+        self.codon_counts.add([c.dna_results for c in classifications.values() if c.dna_results is not None])
+        if self.read_table is not None:
+            self.write_read_table(scan, classifications)
+        if self.profiler is not None:
+            self.profiler.sample(self.total_count)
+        return final_dict
+
+    def add_pileup(self, scan, classifications):
+        """
+        Add the bases of a classified batch to the per-position base counts
+
+        :param scan: output of `BatchScanner.scan` for the batch
+        :param classifications: batch index -> output of `classify_read`, for the reads with unexpected changes
+        """
+        labels = None
+        if self.pileup.by_event:
+            labels = np.where(scan['valid'], 'nochange_count', 'invalid_count').astype(object)
+            for i, classification in classifications.items():
+                labels[i] = classification.counter
+        self.pileup.add(scan['encoded'], labels)
+
+    def write_read_table(self, scan, classifications):
+        """
+        Add the reads of a classified batch to the per-read table, in their original order
+
+        :param scan: output of `BatchScanner.scan` for the batch
+        :param classifications: batch index -> output of `classify_read`, for the reads with unexpected changes
+        """
+        names = self.batch_names
+        self.batch_names = []
+        valid = scan['valid'].tolist()
+        mismatch_count = scan['mismatch_count'].tolist()
+        for i, name in enumerate(names):
+            classification = classifications.get(i)
+            if classification is not None:
+                self.read_table.add(name, classification.counter, mismatch_count[i], classification.event,
+                                    classification.dna_results)
+            elif valid[i]:
+                self.read_table.add(name, 'nochange_count', mismatch_count[i])
+            else:
+                self.read_table.add(name, 'invalid_count', mismatch_count[i])
+
+    def classify_cached(self, seq, key=None):
+        """
+        :param seq: SEQ of the read
+        :param key: mismatch signature of the read (see `BatchScanner.read_key`), SEQ is used if None
+        :return: output of `classify_read`
+        """
+        # Identical reads get identical classifications, so only classify each distinct signature once
+        if key is None:
+            key = seq
+        classification = self.cache.get(key)
+        if classification is None:
+            classification = self.classify_read(seq)
+            self.cache.put(key, classification)
+        return classification
+
+    def tally_classification(self, classification, dna_out, final_dict):
+        """
+        Add a classified read to the counters, the variant tally and the codingdna output
+
+        :param classification: output of `classify_read`
+        :param dna_out: TSVWriter receiving a row for every usable read
+        :param final_dict: variant tally, see `deduper.add_to_dict`
+
+        :return: final_dict
+        """
+        counter = classification.counter
+        mmca_dict = classification.event
+        dna_results_dict = classification.dna_results
+        setattr(self, counter, getattr(self, counter) + 1)
+
+        # Everything below, I need an output for
+        if counter == 'noncoding_count':
+            final_dict = add_to_dict(final_dict,
+                                     self.target_dict['strand'],
+                                     mmca_dict, dna_results_dict=None,
+                                     chrom=self.target_dict['chrom'],
+                                     read_start=self.read_start)
+            return final_dict
+
+        if dna_results_dict is not None:
+            dna_out.write_result(dna_results_dict)
+            final_dict = add_to_dict(final_dict,
+                                     self.target_dict['strand'],
+                                     mmca_dict, dna_results_dict=dna_results_dict,
+                                     chrom=self.target_dict['chrom'],
+                                     read_start=self.read_start)
+        return final_dict
+
+    def start_profile(self, dna_out, vcf_out=None):
+        """
+        Time the counting stages of this run (see `profiler.StageProfiler`)
+
+        Parsing and the off-target check are done inline while lines are split, so they are reported together as
+        'parse'.
+
+        :param dna_out: TSVWriter of the run
+        :param vcf_out: VCFWriter of the run
+        """
+        profiler = StageProfiler()
+        profiler.instrument(self, 'count_buffer', 'parse')
+        profiler.instrument(self, 'count_rows', 'parse')
+        profiler.instrument(self, 'process_alignment_file', 'parse')
+        profiler.instrument(self, 'passes_cigar', 'cigar_filter')
+        profiler.instrument(self, 'flush_batch', 'batch_lookup')
+        profiler.instrument(self.scanner, 'scan', 'dna_mismatch_scan')
+        profiler.instrument(self, 'classify_read', 'classify_read', event=lambda c: c.counter)
+        profiler.instrument(self.classifier, 'classify_changes', 'aa_classification')
+        profiler.instrument(sys.modules['CountReads'], 'position_from_changes', 'position_wrapper')
+        profiler.instrument(self, 'tally_classification', 'tally')
+        profiler.instrument(self, 'add_pileup', 'pileup')
+        profiler.instrument(self.codon_counts, 'add', 'codon_counts')
+        profiler.instrument(sys.modules[__name__], 'add_to_dict', 'add_to_dict')
+        profiler.instrument(sys.modules[__name__], 'write_counts', 'write_counts')
+        profiler.instrument(dna_out, 'write_result', 'write_codingdna')
+        if vcf_out is not None:
+            profiler.instrument(vcf_out, 'write', 'write_vcf')
+        if self.read_table is not None:
+            profiler.instrument(self.read_table, 'add', 'write_read_table')
+        self.profiler = profiler
+
+    def stop_profile(self):
+        """
+        :return: report of the run started with `start_profile`
+        """
+        self.profiler.restore()
+        report = self.profiler.report(self.sample_name, self.total_count)
+        self.profiler = None
+        return report
+
+    def get_counters(self):
+        """
+        :return: dictionary of all read counters (and cache statistics)
+        """
+        counters = {k: getattr(self, k) for k in COUNTERS}
+        counters['cache_hits'] = self.cache.hits
+        counters['cache_misses'] = self.cache.misses
+        counters['table_hits'] = self.table_hits
+        return counters
+
+    def add_counters(self, counters):
+        """
+        Add counters from another SamParser (e.g. a shard processed in another process)
+
+        :param counters: output of `get_counters()`
+        """
+        for k in COUNTERS:
+            setattr(self, k, getattr(self, k) + counters[k])
+        self.cache.hits += counters['cache_hits']
+        self.cache.misses += counters['cache_misses']
+        self.table_hits += counters['table_hits']
+
+    def process_shards(self, sample_name, dna_out):
+        """
+        Classify the SAM file in parallel, one byte range per worker process
+
+        Shards are merged back in file order, so the counters, the variant tally and the codingdna rows are
+        identical to a serial run.
+
+        :param sample_name: prefix for the temporary per-shard codingdna files
+        :param dna_out: TSVWriter receiving the rows of all shards
+
+        :return: final_dict
+        """
+        shards = split_sam(self.args['samfile'], self.workers)
+        self.logger.info(f"Processing {shards.__len__()} shards with {self.workers} workers")
+        final_dict = self.new_tally()
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(process_shard, self.args, start, end, f'{sample_name}.shard{i}')
+                       for i, (start, end) in enumerate(shards)]
+            for future in futures:
+                counters, shard_dict, shard_tsv, shard_reads, shard_profile, shard_pileup, shard_codons = \
+                    future.result()
+                self.add_counters(counters)
+                self.pileup.merge(shard_pileup)
+                self.codon_counts.merge(shard_codons)
+                if shard_profile is not None:
+                    self.profiler.add(shard_profile)
+                final_dict = merge_dicts(final_dict, shard_dict)
+                shard_dict.close()
+                dna_out.append(shard_tsv, header=False)
+                os.remove(shard_tsv)
+                if shard_reads is not None:
+                    self.read_table.append(shard_reads)
+                    os.remove(shard_reads)
+        return final_dict
+
+    def process_mapped(self, dna_out, checkpoint=None, state=None):
+        """
+        Count reads from a plain SAM file in this process, optionally continuing from a checkpoint
+
+        :param dna_out: TSVWriter receiving a row for every usable read
+        :param checkpoint: Checkpoint saved while counting (None to disable)
+        :param state: snapshot returned by `Checkpoint.load()` to resume from (None to start at the beginning)
+
+        :return: final_dict
+        """
+        buf = map_sam(self.args['samfile'])
+        start = 0
+        final_dict = self.new_tally()
+        if state is not None:
+            self.logger.info(f"Resuming {self.args['samfile']} from byte {state['offset']} of {buf.__len__()}")
+            start = state['offset']
+            final_dict = merge_dicts(final_dict, state['final_dict'])
+            self.add_counters(state['counters'])
+            if 'pileup' in state:
+                self.pileup.merge(Pileup.from_dict(self.context.seq, self.read_start, state['pileup']))
+            if 'codon_counts' in state:
+                self.codon_counts.merge(CodonCounts.from_dict(self.context, state['codon_counts']))
+        final_dict = self.count_buffer(buf, start, buf.__len__(), dna_out, final_dict, checkpoint)
+        if hasattr(buf, 'close'):
+            buf.close()
+        return final_dict
+
+    def process_alignment_file(self, dna_out):
+        """
+        Count reads from an indexed BAM/CRAM file
+
+        Only the reads overlapping `read_start` are fetched from the index. Every other record is off target, so the
+        total comes from the index statistics instead of parsing them.
+
+        :param dna_out: TSVWriter receiving a row for every usable read
+
+        :return: final_dict
+        """
+        if self.workers > 1:
+            self.logger.info("--workers is not used for BAM/CRAM input, only the target start is read")
+        final_dict = self.new_tally()
+        with open_alignment_file(self.args['samfile'], self.args.get('reference_fasta')) as af:
+            total_count = count_records(af)
+            on_start = 0
+            for name, cigar, seq in fetch_start_reads(af, self.target_dict['chrom'], self.read_start):
+                on_start += 1
+                final_dict = self.count_alignment(cigar, seq, dna_out, final_dict, name=name)
+            final_dict = self.flush_batch(dna_out, final_dict)
+        self.total_count += total_count
+        self.off_target += total_count - on_start
+        return final_dict
+
+    def vcf_contigs(self):
+        """
+        :return: ##contig lines of the VCF, see `sam_io.read_contigs`. The target chromosome is always included,
+            without a length if neither the reference nor the SAM header has it.
+        """
+        contigs = read_contigs(self.args['samfile'], self.args.get('reference_fasta'))
+        if self.target_dict['chrom'] not in [name for name, _ in contigs]:
+            contigs.append((self.target_dict['chrom'], None))
+        return contigs
+
     # noinspection DuplicatedCode
     def process_sam(self):
         """
@@ -261,167 +866,93 @@ class SamParser:
 
         }
         """
-        sample_name = os.path.basename(self.args['samfile']).replace('.sam', '').replace('.gz', '')
+        stats = RunStats()
+        sample_name = output_prefix(self.args['samfile'])
 
-        dna_out = TSVWriter(sample_name)
-        metrics = MetricsWriter(sample_name)
-        f = VCFWriter(sample_name, style='all')
-        final_dict = dict()
-
-        i = 0
-        with open(self.args['samfile'], 'r') as r:
-            # Put in dummy values as a placeholder
-            read = 'ReadName\tFlag\tChrom\t0\tMAPQ\tCIGAR\tMateChrom\tMatePos\tTLEN\tSEQ\tQuality'.split('\t')
-            Total_CR = CountReads(read, self.indicator_dict, self.target_dict)
-            for row in r:
-                i += 0
-                # Parse the files, skipping over headers
-                if row.startswith('@'):
-                    continue
-                # Now we're counting reads
-                line = row.strip().split('\t')
-                self.total_count += 1
-
-                # Make sure the read starts exactly in the same place that you're expecting one to be
-                if int(line[3]) != self.read_start or line[2] != self.target_dict['chrom']:
-                    self.off_target += 1
-                    continue
-
-                # Skip if the CIGAR string is messy
-                cig = filter_matches(split_cigar(line[5]), min_matches=self.cigar_min)
-                if cig is False:
-                    self.cigar_count += 1
-                    continue
+        plain = not is_alignment_file(self.args['samfile']) and get_compression(self.args['samfile']) is None
+        checkpoint = None
+        state = None
+        # A Parquet/Arrow file can't be truncated back to a checkpoint, so runs writing one are not checkpointed
+        if plain and self.workers <= 1 and self.args.get('checkpoint_interval', 0) > 0 and \
+                not self.args.get('read_table'):
+            checkpoint = Checkpoint(f'{sample_name}.checkpoint.jsonl', self.args['checkpoint_interval'],
+                                    input_signature(self.args))
+            if self.args.get('resume'):
+                state = checkpoint.load()
+        elif self.args.get('resume'):
+            self.logger.info("Checkpoints are only written for plain SAM files counted by one worker without "
+                             "--read_table, starting over")
 
-                # Create the model object for the SAM line
-                CR = CountReads(line, self.indicator_dict, self.target_dict)
+        dna_out = TSVWriter(sample_name, style=self.args.get('codingdna', 'rows'),
+                            resume_at=None if state is None else state.get('codingdna_size'),
+                            resume_rows=None if state is None else state.get('codingdna_rows'))
+        metrics = MetricsWriter(sample_name)
+        f = VCFWriter(sample_name, style='all', contigs=self.vcf_contigs(), bgzip=self.args.get('bgzip_vcf', False))
+        if self.args.get('read_table'):
+            self.read_table = ReadTableWriter(sample_name, style=self.args['read_table'], read_start=self.read_start)
+        if self.args.get('profile'):
+            self.start_profile(dna_out, f)
 
-                # Ensure that all elements of the SAM file are present
-                if CR.validateSAMLine():
-                    # Limit the length of the read to the desired target sequence, and if necessary,
-                    # skip the required number of bases until you hit the amino acid/frame of interest
-                    # (Codon distance parameter) and [Downstream distance parameter]
-                    # Remove variants that go beyond the coding sequence
-                    # [Upstream distance parameter]
-                    # target = CR.trim_to_target()
-                    # Get index positions of DNA mismatches
-                    mmc, _ = CR.get_mismatch_counts(line[9], aa=False)
-
-                    # Make sure all required DNA changes are present
-                    valid = CR.check_validity(mmc, self.target_dict, strict=self.strict)
-                    if not valid:
-                        # Not all the expected sequences were found
-                        self.invalid_count += 1
-                        mmc_len = ','.join(x for x in mmc)
-                        continue
-
-                    # Get amino acid-based results rather than DNA (if coding)
-                    mmca, mmca_dict = CR.get_mismatch_counts(line[9], aa=True)
-
-                    if mmca_dict['frameshift']:
-                        self.frameshift_count += 1
-                        continue
-
-                    if mmca_dict['event_type'] == 'NoChanges':
-                        self.nochange_count += 1
-                        continue
-
-                    if mmca_dict['event_type'] == 'TooMany':
-                        self.mm_count += 1
-                        continue
-
-                    if mmca_dict['event_type'] == 'Mixed':
-                        self.mixed_count += 1
-                        continue
-
-                    if mmca_dict['event_type'] == 'MultipleSynonymous':
-                        self.multi_synonymous_count += 1
-                        continue
-
-                    # Everything below, I need an output for
-                    if mmca_dict['event_type'] in ['UpstreamNoncoding', 'PartialCodingAndUpstreamNoncoding',
-                                                   'PartialCodingUpStream', 'DownstreamNonCoding',
-                                                   'DownstreamNonCodingAndPartialCodingDownstream',
-                                                   'PartialCodingDownStream']:
-                        self.noncoding_count += 1
-                        final_dict = add_to_dict(final_dict,
-                                                 CR.target_dict['strand'],
-                                                 mmca_dict, dna_results_dict=None,
-                                                 chrom=line[2],
-                                                 read_start=self.read_start)
-                        continue
-
-                    if mmca_dict['event_type'] == 'Synonymous':
-                        self.synonymous_count += 1
-                        dna_results_dict = dnaf.position_wrapper(line[9], CR.target_dict, self.read_start, CR.other,
-                                                                 self.args['strand'])
-                        dna_out.write_result(dna_results_dict)
-                        final_dict = add_to_dict(final_dict,
-                                                 CR.target_dict['strand'],
-                                                 mmca_dict, dna_results_dict=dna_results_dict,
-                                                 chrom=line[2],
-                                                 read_start=self.read_start)
-                        continue
-
-                    if mmca_dict['event_type'] == 'Missense':
-                        self.missense_count += 1
-                        dna_results_dict = dnaf.position_wrapper(line[9], CR.target_dict, self.read_start, CR.other,
-                                                                 self.args['strand'])
-                        dna_out.write_result(dna_results_dict)
-                        final_dict = add_to_dict(final_dict,
-                                                 CR.target_dict['strand'],
-                                                 mmca_dict, dna_results_dict=dna_results_dict,
-                                                 chrom=line[2],
-                                                 read_start=self.read_start)
-                        continue
-
-                    if mmca_dict['event_type'] == 'StopGain':
-                        self.stop_count += 1
-                        ##TODO: if AA==2710 print out the read for day 14
-                        dna_results_dict = dnaf.position_wrapper(line[9], CR.target_dict, self.read_start, CR.other,
-                                                                 self.args['strand'])
-                        AA_number=2660 + dna_results_dict['AApos']
-                        if AA_number  == 2710:
-                            print(line[9])
-                            print(mmca_dict, mmca)
-                        dna_out.write_result(dna_results_dict)
-                        final_dict = add_to_dict(final_dict,
-                                                 CR.target_dict['strand'],
-                                                 mmca_dict, dna_results_dict=dna_results_dict,
-                                                 chrom=line[2],
-                                                 read_start=self.read_start)
-                        continue
-
-                    raise Exception(f"This should never be reached.\n"
-                                    f"mmc: {mmc}, mmca: {mmca}, mmca_dict: {mmca_dict},\n"
-                                    f"Line: {line}")
+        # Put in dummy values as a placeholder
+        read = 'ReadName\tFlag\tChrom\t0\tMAPQ\tCIGAR\tMateChrom\tMatePos\tTLEN\tSEQ\tQuality'.split('\t')
+        Total_CR = CountReads(read, self.indicator_dict, self.target_dict)
+        if is_alignment_file(self.args['samfile']):
+            final_dict = self.process_alignment_file(dna_out)
+        elif plain and self.workers > 1:
+            final_dict = self.process_shards(sample_name, dna_out)
+        elif plain:
+            final_dict = self.process_mapped(dna_out, checkpoint, state)
+        else:
+            if self.workers > 1:
+                self.logger.info("Compressed SAM files can't be split into shards, processing them serially")
+            rows = open_sam(self.args['samfile'], threads=self.args.get('threads', 2))
+            final_dict = self.count_rows(rows, dna_out, self.new_tally())
+            if hasattr(rows, 'close'):
+                rows.close()
 
         self.usable_count = self.stop_count + self.missense_count + self.synonymous_count
-        info = f'|{self.sample_name}|{self.total_count}|' \
-               f'{self.off_target} ({self.off_target / self.total_count * 100:.2f}%)|' \
-               f'{self.cigar_count} ({self.cigar_count / self.total_count * 100:.2f}%)|' \
-               f'{self.invalid_count} ({self.invalid_count / self.total_count * 100:.2f}%)|' \
-               f'{self.mm_count} ({self.mm_count / self.total_count * 100:.2f}%)|' \
-               f'{self.frameshift_count} ({self.frameshift_count / self.total_count * 100:.2f}%)|' \
-               f'{self.nochange_count} ({self.nochange_count / self.total_count * 100:.2f}%)|' \
-               f'{self.synonymous_count} ({self.synonymous_count / self.total_count * 100:.2f}%)|' \
-               f'{self.missense_count} ({self.missense_count / self.total_count * 100:.2f}%)|' \
-               f'{self.stop_count} ({self.stop_count / self.total_count * 100:.2f}%)|' \
-               f'{self.mixed_count} ({self.mixed_count / self.total_count * 100:.2f}%)|' \
-               f'{self.multi_synonymous_count} ({self.multi_synonymous_count / self.total_count * 100:.2f}%)|' \
-               f'{self.usable_count} ({self.usable_count / self.total_count * 100:.2f}%)| '
+        info = format_metrics(self.sample_name, self.get_counters())
+        # Bytes before the checkpoint were counted by the interrupted run
+        input_bytes = os.path.getsize(self.args['samfile']) - (0 if state is None else state['offset'])
+        run_metrics = stats.report(self.sample_name, self.args['samfile'], with_usable_count(self.get_counters()),
+                                   input_bytes, self.workers)
         self.logger.info(info)
+        self.logger.info(f"{self.table_hits} reads classified from the {self.outcome_table.__len__()} "
+                         f"precomputed designed changes")
 
         metrics.write(info)
         f.write(final_dict)
+        self.pileup.write(sample_name)
+        self.codon_counts.write(sample_name)
+        Total_CR.results_dict = self.pileup.results_dict()
+        Total_CR.aa_counts = self.codon_counts
+        write_counts(f'{sample_name}.counts.json.gz', target_signature(self.args), self.get_counters(), final_dict,
+                     dna_out.filename, self.pileup.to_dict(), self.codon_counts.to_dict())
 
         f.close()
         dna_out.close()
         metrics.close()
+        final_dict.close()
+        if self.read_table is not None:
+            self.read_table.close()
+            self.read_table = None
+        if self.profiler is not None:
+            report = self.stop_profile()
+            write_json(f'{sample_name}.profile.json', report)
+            self.logger.info(f"Profile written to {sample_name}.profile.json ({report['reads_per_second']} reads/s)")
+        write_json(f'{sample_name}.metrics.json', run_metrics)
+        if self.args.get('prometheus_dir'):
+            write_prometheus(os.path.join(self.args['prometheus_dir'], f'{sample_name}.prom'), [run_metrics])
+        self.logger.info(f"{run_metrics['reads_per_second']} reads/s, {run_metrics['cpu_time']} s CPU, "
+                         f"{run_metrics['peak_rss_mb']} MB peak RSS")
+        if checkpoint is not None:
+            checkpoint.remove()
 
         res = {
             'results': Total_CR,
             'sample_name': self.sample_name,
+            'metrics': info,
+            'run_metrics': run_metrics,
             'total_count': self.total_count,
             'cigar_count': self.cigar_count,
             'mm_count': self.mm_count,
@@ -431,13 +962,296 @@ class SamParser:
             'synonymous_count': self.synonymous_count,
             'missense_count': self.missense_count,
             'stop_count': self.stop_count,
-            'usable_count': self.usable_count
+            'usable_count': self.usable_count,
+            'cache_hits': self.cache.hits,
+            'cache_misses': self.cache.misses,
+            'table_hits': self.table_hits
         }
         return res
 
 
+def process_shard(args, start, end, prefix):
+    """
+    Worker for `SamParser.process_shards`
+
+    :param args: SamParser arguments
+    :param start: byte offset of the first line in the shard
+    :param end: byte offset where the next shard starts
+    :param prefix: prefix of the codingdna file written for this shard
+
+    :return: counters, final_dict, codingdna filename, per-read table filename (None without --read_table),
+        profile report (None without --profile), Pileup, CodonCounts
+    """
+    SP = SamParser(args)
+    # Shards are never compressed, they are appended to the codingdna file of the sample
+    dna_out = TSVWriter(prefix, header=False, style='rows' if args.get('codingdna', 'rows') == 'rows' else 'counts')
+    if args.get('read_table'):
+        SP.read_table = ReadTableWriter(prefix, style=args['read_table'], read_start=SP.read_start)
+    if args.get('profile'):
+        SP.start_profile(dna_out)
+    buf = map_sam(args['samfile'])
+    final_dict = SP.count_buffer(buf, start, end, dna_out, SP.new_tally())
+    if hasattr(buf, 'close'):
+        buf.close()
+    dna_out.close()
+    report = SP.stop_profile() if SP.profiler is not None else None
+    read_table = None
+    if SP.read_table is not None:
+        SP.read_table.close()
+        read_table = SP.read_table.filename
+    return SP.get_counters(), final_dict, dna_out.filename, read_table, report, SP.pileup, SP.codon_counts
+
+
+def with_usable_count(counters):
+    """
+    :param counters: output of `SamParser.get_counters()`
+    :return: copy of the counters with usable_count (synonymous, missense and stop reads)
+    """
+    counters = dict(counters)
+    counters['usable_count'] = counters['stop_count'] + counters['missense_count'] + counters['synonymous_count']
+    return counters
+
+
+def format_metrics(sample_name, counters):
+    """
+    :param sample_name: first column of the metrics table
+    :param counters: output of `SamParser.get_counters()`
+    :return: row of the .metrics.tsv table
+    """
+    counters = with_usable_count(counters)
+    total_count = counters['total_count']
+    info = f'|{sample_name}|{total_count}|'
+    for k in METRICS_COUNTERS:
+        info += f'{counters[k]} ({counters[k] / total_count * 100:.2f}%)|'
+    return info + f"{counters['cache_hits']}|{counters['cache_misses']}| "
+
+
+def parse_merge_args(argv):
+    parser = argparse.ArgumentParser(prog='main.py merge',
+                                     description="Combine the .counts.json.gz files of runs over the same target "
+                                                 "(e.g. lanes or top-up sequencing of a sample) and regenerate the "
+                                                 ".all.vcf, .codingdna.tsv and .metrics.tsv reports")
+
+    parser.add_argument("counts",
+                        nargs='+',
+                        help=".counts.json.gz files, in the order their reads should be reported")
+
+    parser.add_argument("-o", "--output",
+                        dest='output',
+                        required=True,
+                        help="Prefix of the merged reports (e.g. 'A1.fastq')")
+
+    parser.add_argument("--bgzip_vcf",
+                        dest='bgzip_vcf',
+                        action='store_true',
+                        help="Write <output>.all.vcf.gz (BGZF) with a tabix index instead of <output>.all.vcf")
+
+    parser.add_argument("--codingdna",
+                        dest='codingdna',
+                        default='rows',
+                        choices=['rows', 'counts', 'counts.gz'],
+                        help="Style of the merged codingdna file: one row per read, or every distinct row once with "
+                             "a Count column (optionally gzip compressed)")
+
+    parser.add_argument("-V", "--verbose",
+                        dest="logLevel",
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                        default="INFO",
+                        help="Set the logging level")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(stream=sys.stderr, level=args.logLevel,
+                        format='%(name)s (%(levelname)s): %(message)s')
+
+    logger = logging.getLogger(__name__)
+    logger.setLevel(args.logLevel)
+    return args, logger
+
+
+def merge_runs(counts_files, output, logger, bgzip_vcf=False, codingdna='rows'):
+    """
+    Merge the intermediates of several runs and write the reports of the combined reads
+
+    The codingdna rows of the runs are concatenated, so they have to still be next to their .counts.json.gz files.
+    A merged .counts.json.gz is written as well, so merged results can be merged again, and a .metrics.json with the
+    merged counters.
+
+    :param counts_files: .counts.json.gz files
+    :param output: prefix of the merged reports
+    :param logger: logger
+    :param bgzip_vcf: write a BGZF compressed, tabix indexed VCF
+    :param codingdna: style of the merged codingdna file, see `TSVWriter` (the runs can have any style)
+
+    :return: counters, final_dict
+    """
+    stats = RunStats()
+    counts_list = [read_counts(c) for c in counts_files]
+    for counts in counts_list:
+        if not os.path.exists(counts['codingdna']):
+            raise Exception(f"{counts['codingdna']} is needed to merge the codingdna rows")
+    target, counters, final_dict = merge_counts(counts_list)
+
+    dna_out = TSVWriter(output, style=codingdna)
+    for counts in counts_list:
+        dna_out.append(counts['codingdna'])
+    dna_out.close()
+
+    info = format_metrics(os.path.basename(output), counters)
+    logger.info(info)
+    metrics = MetricsWriter(output)
+    metrics.write(info)
+    metrics.close()
+
+    f = VCFWriter(output, style='all', contigs=[(target['chrom'], None)], bgzip=bgzip_vcf)
+    f.write(final_dict)
+    f.close()
+
+    # Runs counted before base and codon counts were kept don't have them, so they are only merged when every run does
+    pileup = None
+    if all(['pileup' in counts for counts in counts_list]):
+        pileup = Pileup(target['seq'], target['read_start'])
+        for counts in counts_list:
+            pileup.merge(Pileup.from_dict(target['seq'], target['read_start'], counts['pileup']))
+        pileup.write(output)
+    codon_counts = None
+    if all(['codon_counts' in counts for counts in counts_list]):
+        context = TargetContext.build(SamParser.build_target_dict(target), target['read_start'])
+        codon_counts = CodonCounts(context)
+        for counts in counts_list:
+            codon_counts.merge(CodonCounts.from_dict(context, counts['codon_counts']))
+        codon_counts.write(output)
+
+    write_counts(f'{output}.counts.json.gz', target, counters, final_dict, dna_out.filename,
+                 None if pileup is None else pileup.to_dict(), None if codon_counts is None else codon_counts.to_dict())
+    # The time, resource usage and input bytes are those of the merge itself
+    run_metrics = stats.report(os.path.basename(output), None, with_usable_count(counters),
+                               sum([os.path.getsize(c) for c in counts_files]))
+    run_metrics['merged_from'] = [os.path.abspath(c) for c in counts_files]
+    write_json(f'{output}.metrics.json', run_metrics)
+    logger.info(f"Merged {counts_list.__len__()} runs with {counters['total_count']} reads into {output}")
+    return counters, final_dict
+
+
+def input_sample_name(samfile):
+    """
+    :param samfile: SAM/BAM/CRAM file
+    :return: sample name of the metrics, e.g. 'sample.fastq.gz' for 'out/sample.fastq.gz.sam' or 'sample' for
+        'out/sample.bam'
+    """
+    return os.path.basename(samfile).replace('.sam', '').replace('.bam', '').replace('.cram', '')
+
+
+def output_prefix(samfile):
+    """
+    :param samfile: SAM/BAM/CRAM file
+    :return: prefix of the output files of a sample, e.g. 'sample.fastq' for 'out/sample.fastq.gz.sam'
+    """
+    return os.path.basename(samfile).replace('.sam', '').replace('.bam', '').replace('.cram', '') \
+        .replace('.gz', '').replace('.zst', '')
+
+
+def read_sample_sheet(filename):
+    """
+    :param filename: sample sheet, one SAM/BAM/CRAM file per line in the first tab-separated column. Blank lines and
+        lines starting with '#' are skipped, relative paths are relative to the sample sheet.
+    :return: list of files
+    """
+    samfiles = []
+    with open(filename, 'r') as r:
+        for row in r:
+            if row.strip() == '' or row.startswith('#'):
+                continue
+            samfiles.append(os.path.join(os.path.dirname(filename), row.rstrip('\n').split('\t')[0].strip()))
+    return samfiles
+
+
+def get_samfiles(args):
+    """
+    :param args: command line arguments
+    :return: list of SAM/BAM/CRAM files to process, from the sample sheet or the (glob) pattern given with -s
+    """
+    if args.get('sample_sheet'):
+        return read_sample_sheet(args['sample_sheet'])
+    if glob.has_magic(args['samfile']):
+        return sorted(glob.glob(args['samfile']))
+    return [args['samfile']]
+
+
+_sample_parser = None
+
+
+def init_sample_worker(args):
+    """
+    Build the target once per worker process of `process_samples`
+    """
+    global _sample_parser
+    _sample_parser = SamParser(args)
+
+
+def process_sample(samfile):
+    """
+    Worker for `process_samples`
+
+    :param samfile: SAM/BAM/CRAM file
+    :return: output of `SamParser.process_sam()` without the CountReads object
+    """
+    _sample_parser.set_sample(samfile)
+    res = _sample_parser.process_sam()
+    res.pop('results')
+    return res
+
+
+def process_samples(args, samfiles, logger):
+    """
+    Process several SAM files of the same target in one invocation
+
+    Each sample gets its own .all.vcf, .codingdna.tsv and .metrics.tsv, like a run of a single file, and one metrics
+    table for all of them (`<combined_metrics>.combined_metrics.txt`) is written in sample order. Samples are processed
+    `workers` at a time, each worker process only builds the target once.
+
+    :param args: command line arguments
+    :param samfiles: list of SAM/BAM/CRAM files
+    :param logger: logger
+
+    :return: list of `process_sample` results, in sample order
+    """
+    names = [output_prefix(s) for s in samfiles]
+    duplicates = sorted(set([n for n in names if names.count(n) > 1]))
+    if duplicates.__len__() > 0:
+        raise Exception(f"Samples with the same file name would overwrite each other's output: {duplicates}")
+
+    workers = args.get('workers', 1)
+    args = dict(args, samfile=samfiles[0], workers=1)
+    logger.info(f"Processing {samfiles.__len__()} samples with {workers} workers")
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_sample_worker, initargs=(args,)) as pool:
+            results = list(pool.map(process_sample, samfiles))
+    else:
+        init_sample_worker(args)
+        results = [process_sample(samfile) for samfile in samfiles]
+
+    # Not named .metrics.tsv: EventPlots.codonSpliceAI.Rmd reads every *metrics.tsv file as the table of one sample
+    metrics = MetricsWriter(args['combined_metrics'], suffix='.combined_metrics.txt')
+    for res in results:
+        metrics.write(res['metrics'])
+    metrics.close()
+    write_json(f"{args['combined_metrics']}.combined_metrics.json", {'samples': [res['run_metrics'] for res in results]})
+    return results
+
+
 if __name__ == "__main__":
+    if sys.argv.__len__() > 1 and sys.argv[1] == 'merge':
+        merge_args, logger = parse_merge_args(sys.argv[2:])
+        merge_runs(merge_args.counts, merge_args.output, logger, merge_args.bgzip_vcf, merge_args.codingdna)
+        sys.exit(0)
     args, logger = parse_args()
     args = args.__dict__
-    SP = SamParser(args)
-    res = SP.process_sam()
+    samfiles = get_samfiles(args)
+    if samfiles.__len__() == 0:
+        logger.error(f"No SAM files found for {args['samfile'] or args['sample_sheet']}")
+        sys.exit(1)
+    if args.get('sample_sheet') or samfiles.__len__() > 1 or samfiles[0] != args['samfile']:
+        res = process_samples(args, samfiles, logger)
+    else:
+        SP = SamParser(args)
+        res = SP.process_sam()
@@ -0,0 +1,101 @@
+"""
+Precomputed classifications for the designed mutation space of a saturation library.
+
+Apart from the expected (required) changes, a read's classification only depends on the read between its first and
+last unexpected mismatch, so (first mismatch index, read[first:last + 1]) is used as its signature. Every single
+base change and every codon substitution of the target is classified once at startup; reads whose signature is in
+the table are then classified with one dictionary lookup.
+
+The `dna_mismatches` of a table entry are those of the designed read: they can differ from a matching read's at
+the expected positions (and with strict=False, only some of them have to be present).
+
+Example (expected change at index 50):
+    {(36, 'G'): ReadClassification(counter='synonymous_count', valid=True, ...,
+                                   event={'event_type': 'Synonymous', ...},
+                                   dna_results={'pos_ref_alt': [36, 36, 'A', 'G'], ...}),
+     (41, 'TCG'): ReadClassification(counter='missense_count', ...),
+     ...}
+"""
+
+from translate import BASES
+
+# Longest signature span (last - first) in the table: a codon substitution
+MAX_SPAN = 2
+
+
+def expected_read(context, bases):
+    """
+    :param context: TargetContext
+    :param bases: required alternate base for each expected position
+    :return: target sequence carrying only the expected changes
+    """
+    read = list(context.seq)
+    for x, b in zip(context.mmc, bases):
+        if 0 <= x < read.__len__():
+            read[x] = b
+    return ''.join(read)
+
+
+def signature(read, reference, expected):
+    """
+    :param read: read sequence
+    :param reference: target sequence
+    :param expected: set of expected mismatch indexes
+    :return: (first, read[first:last + 1]) over the unexpected mismatches, None if there are none
+    """
+    mismatches = [i for i in range(min(read.__len__(), reference.__len__()))
+                  if read[i] != reference[i] and i not in expected]
+    if mismatches.__len__() == 0:
+        return None
+    return mismatches[0], read[mismatches[0]:mismatches[-1] + 1]
+
+
+def designed_reads(context, base_read):
+    """
+    Every single base change (A, C, G, T or N) of the target and every codon substitution of the coding region
+
+    Expected positions are left untouched: changes there are removed before classification anyway.
+
+    :return: generator of read sequences
+    """
+    expected = set(context.mmc)
+    for i in range(base_read.__len__()):
+        if i in expected:
+            continue
+        for b in BASES + 'N':
+            if b != base_read[i]:
+                yield base_read[:i] + b + base_read[i + 1:]
+    for c in range(context.fro, min(context.to, base_read.__len__() - 2), 3):
+        for a in BASES:
+            for b in BASES:
+                for d in BASES:
+                    alt = [x if c + j not in expected else base_read[c + j] for j, x in enumerate(a + b + d)]
+                    yield base_read[:c] + ''.join(alt) + base_read[c + 3:]
+
+
+def build_outcome_table(context, bases, classify):
+    """
+    Classify the designed mutation space of the target
+
+    :param context: TargetContext
+    :param bases: required alternate base for each expected position
+    :param classify: function classifying a read sequence (`SamParser.classify_read`)
+
+    :return: dictionary of signature -> classification
+    """
+    base_read = expected_read(context, bases)
+    expected = set(context.mmc)
+    table = dict()
+    for read in designed_reads(context, base_read):
+        key = signature(read, context.seq, expected)
+        if key is None or key in table or key[1].__len__() > MAX_SPAN + 1:
+            continue
+        try:
+            classification = classify(read)
+        except Exception:
+            # Leave reads that can't be classified to the regular path, which reports them
+            continue
+        if classification.counter == 'invalid_count':
+            continue
+        table[key] = classification
+    return table
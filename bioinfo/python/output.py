@@ -1,15 +1,51 @@
+import gzip
 import logging
+import os
+import shutil
+
+from bgzf import BgzfWriter, TabixIndex
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Rows buffered before a row group (Parquet) or record batch (Arrow) is written
+ROW_GROUP_SIZE = 1 << 20
+
+# codingdna rows buffered before they are written
+BUFFER_ROWS = 1 << 14
+# Distinct classifications whose codingdna row is kept formatted
+FORMATTED_ROWS = 1 << 16
+
+CODINGDNA_HEADER = 'Start\tEnd\tRef_DNA\tAltDNA\tRefAA\tAltAA\tConsecutive\tAApos\tAltAA_length\trefDNACodons\taltDNACodons'
 
 
 class VCFWriter:
 
-    def __init__(self, filename, style='all'):
+    def __init__(self, filename, style='all', contigs=None, bgzip=False):
+        """
+        :param filename: prefix of the VCF
+        :param style: written as <filename>.<style>.vcf
+        :param contigs: list of (name, length) for the ##contig lines (length can be None), see
+            `sam_io.read_contigs`
+        :param bgzip: write a BGZF compressed <filename>.<style>.vcf.gz with a tabix index (.tbi) instead
+        """
         self.filename = filename + '.' + style + '.vcf'
+        self.contigs = contigs if contigs is not None else []
+        self.index = None
+        if bgzip:
+            self.filename += '.gz'
+            self.index = TabixIndex()
         self.fo = self._create_file()
         self.style = style
 
     def close(self):
         self.fo.close()
+        if self.index is not None:
+            self.index.write(self.filename + '.tbi')
 
     def _create_file(self):
         """
@@ -17,7 +53,7 @@ class VCFWriter:
 
         :return: file object
         """
-        f = open(self.filename, 'w')
+        f = BgzfWriter(self.filename) if self.index is not None else open(self.filename, 'w')
         f.write('##fileformat=VCFv4.3\n')
         f.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Placeholder ofr a dummy genotype value">\n')
         f.write('##INFO=<ID=EventType,Number=1,Type=String,Description="Type of event">\n')
@@ -27,36 +63,15 @@ class VCFWriter:
         f.write('##INFO=<ID=AApos,Number=1,Type=Integer,Description="Amino Acid Position events">\n')
         f.write('##INFO=<ID=RefAA,Number=1,Type=String,Description="Reference amino acid">\n')
         f.write('##INFO=<ID=AltAA,Number=1,Type=String,Description="Alternate Amino Acid">\n')
-        f.write("##contig=<ID=chr1,length=248956422>\n")
-        f.write("##contig=<ID=chr2,length=242193529>\n")
-        f.write("##contig=<ID=chr3,length=198295559>\n")
-        f.write("##contig=<ID=chr4,length=190214555>\n")
-        f.write("##contig=<ID=chr5,length=181538259>\n")
-        f.write("##contig=<ID=chr6,length=170805979>\n")
-        f.write("##contig=<ID=chr7,length=159345973>\n")
-        f.write("##contig=<ID=chr8,length=145138636>\n")
-        f.write("##contig=<ID=chr9,length=138394717>\n")
-        f.write("##contig=<ID=chr10,length=133797422>\n")
-        f.write("##contig=<ID=chr11,length=135086622>\n")
-        f.write("##contig=<ID=chr12,length=133275309>\n")
-        f.write("##contig=<ID=chr13,length=114364328>\n")
-        f.write("##contig=<ID=chr14,length=107043718>\n")
-        f.write("##contig=<ID=chr15,length=101991189>\n")
-        f.write("##contig=<ID=chr16,length=90338345>\n")
-        f.write("##contig=<ID=chr17,length=83257441>\n")
-        f.write("##contig=<ID=chr18,length=80373285>\n")
-        f.write("##contig=<ID=chr19,length=58617616>\n")
-        f.write("##contig=<ID=chr20,length=64444167>\n")
-        f.write("##contig=<ID=chr21,length=46709983>\n")
-        f.write("##contig=<ID=chr22,length=50818468>\n")
-        f.write("##contig=<ID=chrX,length=156040895>\n")
+        for name, length in self.contigs:
+            f.write(f"##contig=<ID={name},length={length}>\n" if length is not None else f"##contig=<ID={name}>\n")
         f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n')
         return f
 
     def write(self, final_dict):
         """
-        Write a VCF output
-        :param final_dict:
+        Write a VCF output, in coordinate order
+        :param final_dict: VariantTally, whose records look like
             {'chr13:24:GCT:CAC':
             {'chr': 'chr13', 'pos': 24, 'ref': 'GCT', 'alt': 'CAC', 'RefAA': 'A', 'AltAA': 'H',
             'RefCodon': 'GCT', 'AltCodon': 'CAC', 'AApos': 8, 'EventType': 'Missense', 'count': 1}
@@ -64,7 +79,7 @@ class VCFWriter:
         :return:
         """
 
-        for k, v in final_dict.items():
+        for k, v in final_dict.sorted_items():
             chrom = v['chr']
             pos = v['pos']
             _id = '.'
@@ -83,7 +98,12 @@ class VCFWriter:
             format = 'GT'
             sample = '0/1'
             line = '\t'.join([str(x) for x in [chrom, pos, _id, ref, alt, qual, _filter, info, format, sample]])
+            if self.index is None:
+                self.fo.write(line + '\n')
+                continue
+            start = self.fo.tell()
             self.fo.write(line + '\n')
+            self.index.add(chrom, pos - 1, pos - 1 + ref.__len__(), start, self.fo.tell())
 
     def write_noncoding(self, input_dict, target_dict):
         """
@@ -120,24 +140,95 @@ class VCFWriter:
 
 
 class TSVWriter:
+    """
+    Writer of <filename>.codingdna.tsv
+
+    With style 'rows' every usable read is a row, as before; rows are formatted once per distinct classification
+    and written in blocks of BUFFER_ROWS. With 'counts' (or 'counts.gz', gzip compressed) every distinct row is
+    written once, when the writer is closed, with the number of reads in an extra Count column.
+    """
 
-    def __init__(self, filename):
+    def __init__(self, filename, header=True, resume_at=None, style='rows', resume_rows=None):
+        """
+        :param filename: prefix of the file
+        :param header: write the header line
+        :param resume_at: ('rows') size of the file written by an interrupted run, everything after it is dropped
+        :param style: 'rows', 'counts' or 'counts.gz'
+        :param resume_rows: ('counts') rows and counts of an interrupted run, see `snapshot`
+        """
         self.filename = filename + '.codingdna.tsv'
-        self.fo = self._create_file()
+        if style == 'counts.gz':
+            self.filename += '.gz'
+        self.header = header
+        self.resume_at = resume_at
+        self.aggregate = style != 'rows'
+        self.buffer = []
+        # row -> number of reads ('counts')
+        self.counts = dict(resume_rows) if resume_rows else dict()
+        # id of a dna_results dictionary -> (dictionary, row). Identical reads share their classification, so most
+        # rows are found here; keeping the dictionary makes sure its id isn't reused while it is cached
+        self._formatted = dict()
+        self.fo = None if self.aggregate else self._create_file()
 
     def _create_file(self):
         """
-        Write header
+        Write header, or reopen the file written by an interrupted run and drop everything after `resume_at` bytes
 
         :return: file object
         """
+        if self.resume_at is not None:
+            f = open(self.filename, 'r+')
+            f.truncate(self.resume_at)
+            f.seek(self.resume_at)
+            return f
         f = open(self.filename, 'w')
-        f.write(
-            'Start\tEnd\tRef_DNA\tAltDNA\tRefAA\tAltAA\tConsecutive\tAApos\tAltAA_length\trefDNACodons\taltDNACodons\n')
+        if not self.header:
+            return f
+        f.write(CODINGDNA_HEADER + '\n')
         return f
 
+    def flush(self):
+        """
+        Write the buffered rows ('rows')
+        """
+        if self.buffer:
+            self.buffer.append('')
+            self.fo.write('\n'.join(self.buffer))
+            self.buffer = []
+
     def close(self):
-        self.fo.close()
+        if not self.aggregate:
+            self.flush()
+            self.fo.close()
+            return
+        opener = gzip.open if self.filename.endswith('.gz') else open
+        with opener(self.filename, 'wt') as w:
+            if self.header:
+                w.write(CODINGDNA_HEADER + '\tCount\n')
+            w.writelines([f"{row}\t{count}\n" for row, count in self.counts.items()])
+
+    def snapshot(self):
+        """
+        Flush the rows to disk for a checkpoint
+
+        :return: {'codingdna_size': bytes written} ('rows') or {'codingdna_rows': [[row, count], ...]} ('counts')
+        """
+        if self.aggregate:
+            return {'codingdna_rows': [[row, count] for row, count in self.counts.items()]}
+        self.flush()
+        self.fo.flush()
+        os.fsync(self.fo.fileno())
+        return {'codingdna_size': self.fo.tell()}
+
+    @staticmethod
+    def format_row(input_dict):
+        """
+        :param input_dict: see `write_result`
+        :return: row without the line break
+        """
+        return '\t'.join([str(x) for x in input_dict['pos_ref_alt']] +
+                         [input_dict['RefAA'], input_dict['AltAA'], str(input_dict['cons']), str(input_dict['AApos']),
+                          str(input_dict['AltAA'].__len__()), str(input_dict['refDNA']), str(input_dict['altDNA'])])
 
     def write_result(self, input_dict):
         """
@@ -151,21 +242,57 @@ class TSVWriter:
 
         :return: None
         """
-        self.fo.write('\t'.join([str(x) for x in input_dict['pos_ref_alt']]))
-        self.fo.write('\t' + input_dict['RefAA'])
-        self.fo.write('\t' + input_dict['AltAA'])
-        self.fo.write('\t' + input_dict['cons'].__str__())
-        self.fo.write('\t' + input_dict['AApos'].__str__())
-        self.fo.write('\t' + input_dict['AltAA'].__len__().__str__())
-        self.fo.write('\t' + input_dict['refDNA'].__str__())
-        self.fo.write('\t' + input_dict['altDNA'].__str__())
-        self.fo.write('\n')
+        formatted = self._formatted.get(id(input_dict))
+        if formatted is None:
+            if self._formatted.__len__() >= FORMATTED_ROWS:
+                self._formatted.clear()
+            formatted = self._formatted[id(input_dict)] = (input_dict, self.format_row(input_dict))
+        if self.aggregate:
+            self.counts[formatted[1]] = self.counts.get(formatted[1], 0) + 1
+            return
+        self.buffer.append(formatted[1])
+        if self.buffer.__len__() >= BUFFER_ROWS:
+            self.flush()
+
+    def append(self, filename, header=True):
+        """
+        Add the rows of another codingdna file (of a shard or of another run)
+
+        :param filename: codingdna file, in either style (detected from the header; without a header, the style of
+            this writer is assumed)
+        :param header: whether the file starts with a header line
+        """
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(filename, 'rt') as r:
+            counted = self.aggregate
+            if header:
+                counted = r.readline().rstrip('\n').endswith('\tCount')
+            if not counted and not self.aggregate:
+                self.flush()
+                shutil.copyfileobj(r, self.fo)
+                return
+            for line in r:
+                row = line.rstrip('\n')
+                count = 1
+                if counted:
+                    row, count = row.rsplit('\t', 1)
+                    count = int(count)
+                if self.aggregate:
+                    self.counts[row] = self.counts.get(row, 0) + count
+                    continue
+                self.buffer.extend([row] * count)
+                if self.buffer.__len__() >= BUFFER_ROWS:
+                    self.flush()
 
 
 class MetricsWriter:
 
-    def __init__(self, filename):
-        self.filename = filename + '.metrics.tsv'
+    def __init__(self, filename, suffix='.metrics.tsv'):
+        """
+        :param filename: prefix of the table
+        :param suffix: written as <filename><suffix>
+        """
+        self.filename = filename + suffix
         self.fo = self._create_file()
 
     def close(self):
@@ -178,10 +305,10 @@ class MetricsWriter:
         :return: file object
         """
         w = open(self.filename, 'w')
-        info = '|sample_name    |total_count|off_target       |cigar_count        |invalid_count    |mm_count     |frameshift_count |nochange_count   |synonymous_count |missense_count   |stop_count   |mixed_count  |multi_syn  |usable_count   |'
+        info = '|sample_name    |total_count|off_target       |cigar_count        |invalid_count    |mm_count     |frameshift_count |nochange_count   |synonymous_count |missense_count   |stop_count   |mixed_count  |multi_syn  |usable_count   |cache_hits |cache_misses |'
         logging.info(f"{info}")
         w.write(info + '\n')
-        info = '|---------------|-----------|-----------------|-------------------|-----------------|-------------|-----------------|-----------------|-----------------|-----------------|-------------|-------------|-----------|---------------|'
+        info = '|---------------|-----------|-----------------|-------------------|-----------------|-------------|-----------------|-----------------|-----------------|-----------------|-------------|-------------|-----------|---------------|-----------|-------------|'
         logging.info(f"{info}")
         w.write(info + '\n')
         return w
@@ -191,3 +318,118 @@ class MetricsWriter:
 
     def write(self, info):
         self.fo.write(info + '\n')
+
+
+class ReadTableWriter:
+    """
+    Columnar per-read classification table.
+
+    One row per read that starts at `read_start` on the target chromosome (off-target reads are only counted), written
+    in row groups as Parquet (`<prefix>.reads.parquet`) or as an Arrow IPC stream (`<prefix>.reads.arrows`). The
+    low-cardinality string columns are dictionary encoded, and Parquet keeps min/max statistics for every row group,
+    so readers can filter on event type, position or reject reason without scanning the whole file:
+
+        pq.read_table('A1.fastq.reads.parquet', filters=[('event_type', '=', 'Missense'), ('AApos', '=', 29)])
+
+    Columns:
+        read_name: QNAME of the read
+        event_type: event of the classified read (e.g. 'Missense', 'Frameshift'), null for reads rejected before
+            the amino acid comparison (cigar_count, invalid_count, nochange_count)
+        pos: position of the first changed base (VCF POS), for usable and non-coding reads
+        AApos, ref_dna, alt_dna, ref_aa, alt_aa: the codingdna.tsv/VCF annotation of usable reads
+            (ref_dna and alt_dna are also set for non-coding reads)
+        mismatch_count: number of DNA mismatches with the target, including the expected changes
+            (null for reads failing the CIGAR filter)
+        reject_reason: SamParser counter of an unusable read (e.g. 'invalid_count'), null for usable reads
+    """
+
+    def __init__(self, filename, style='parquet', read_start=0, row_group_size=ROW_GROUP_SIZE):
+        if pa is None:
+            raise ImportError("pyarrow is required to write the per-read table")
+        self.filename = filename + ('.reads.parquet' if style == 'parquet' else '.reads.arrows')
+        self.style = style
+        self.read_start = read_start
+        self.row_group_size = row_group_size
+        self.schema = self._schema()
+        self.columns = {k: [] for k in self.schema.names}
+        self.fo = self._create_file()
+
+    @staticmethod
+    def _schema():
+        category = pa.dictionary(pa.int32(), pa.string())
+        return pa.schema([('read_name', pa.string()),
+                          ('event_type', category),
+                          ('pos', pa.int64()),
+                          ('AApos', pa.int32()),
+                          ('ref_dna', category),
+                          ('alt_dna', category),
+                          ('ref_aa', category),
+                          ('alt_aa', category),
+                          ('mismatch_count', pa.int32()),
+                          ('reject_reason', category)])
+
+    def _create_file(self):
+        if self.style == 'parquet':
+            return pq.ParquetWriter(self.filename, self.schema)
+        # The stream format (unlike the IPC file format) allows every batch to have its own dictionaries
+        return pa.ipc.new_stream(self.filename, self.schema)
+
+    def add(self, name, counter, mismatch_count=None, event=None, dna_results_dict=None):
+        """
+        :param name: QNAME of the read (str or bytes)
+        :param counter: SamParser counter the read was tallied under
+        :param mismatch_count: number of DNA mismatches with the target
+        :param event: event of the read, see `ReadClassifier.get_mismatch_counts` (None if it was not classified)
+        :param dna_results_dict: output of `dna_functions.position_wrapper` for usable reads, None otherwise
+        """
+        c = self.columns
+        c['read_name'].append(name.decode() if isinstance(name, bytes) else name)
+        c['event_type'].append(None if event is None else event['event_type'])
+        c['mismatch_count'].append(None if mismatch_count is None else int(mismatch_count))
+        if dna_results_dict is not None:
+            pos_ref_alt = dna_results_dict['pos_ref_alt']
+            c['pos'].append(self.read_start + int(pos_ref_alt[0]))
+            c['AApos'].append(dna_results_dict['AApos'])
+            c['ref_dna'].append(pos_ref_alt[2])
+            c['alt_dna'].append(pos_ref_alt[3])
+            c['ref_aa'].append(dna_results_dict['RefAA'])
+            c['alt_aa'].append(dna_results_dict['AltAA'])
+            c['reject_reason'].append(None)
+        else:
+            noncoding = counter == 'noncoding_count'
+            c['pos'].append(self.read_start + int(event['pos']) if noncoding else None)
+            c['AApos'].append(None)
+            c['ref_dna'].append(event['ref'] if noncoding else None)
+            c['alt_dna'].append(event['alt'] if noncoding else None)
+            c['ref_aa'].append(None)
+            c['alt_aa'].append(None)
+            c['reject_reason'].append(counter)
+        if c['read_name'].__len__() >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered rows as one row group
+        """
+        if self.columns['read_name'].__len__() == 0:
+            return
+        self.fo.write_table(pa.Table.from_pydict(self.columns, schema=self.schema))
+        self.columns = {k: [] for k in self.schema.names}
+
+    def append(self, filename):
+        """
+        Copy the rows of another table of the same style (e.g. written by a shard) after the rows added so far
+
+        :param filename: file written by a ReadTableWriter
+        """
+        self.flush()
+        if self.style == 'parquet':
+            batches = pq.ParquetFile(filename).iter_batches(batch_size=self.row_group_size)
+        else:
+            batches = pa.ipc.open_stream(filename)
+        for batch in batches:
+            self.fo.write_table(pa.Table.from_batches([batch], schema=self.schema))
+
+    def close(self):
+        self.flush()
+        self.fo.close()
@@ -0,0 +1,126 @@
+"""
+Per-position base counts of the reads counted against a target.
+
+Every read that starts at `read_start` and passes the CIGAR filter is added, a whole batch at a time, from the uint8
+matrix of `BatchScanner.scan` into a (positions x 5) integer array of A, C, G, T and N counts. Optionally, the reads
+are also split by the SamParser counter they were tallied under, which gives per-event coverage and error profiles.
+
+Example:
+    pileup = Pileup(context.seq, read_start=56772411, by_event=True)
+    pileup.add(scan['encoded'], labels)     # labels: counter of every read of the batch
+    pileup.counts[41]                       -> array([    3, 10234,     1,     0,    12])
+    pileup.events['missense_count'][41]     -> array([    0,  4100,     0,     0,     3])
+"""
+import numpy as np
+
+from batch_engine import PAD
+
+BASES = 'ACGTN'
+
+# ASCII codes of the A, C, G and T columns, every other base (N, IUPAC codes) is counted as N
+_CODES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+
+class Pileup:
+
+    def __init__(self, seq, read_start, by_event=False):
+        """
+        :param seq: target sequence
+        :param read_start: position of the first base of `seq`
+        :param by_event: also keep the counts of every SamParser counter
+        """
+        self.seq = seq
+        self.read_start = read_start
+        self.by_event = by_event
+        self.counts = np.zeros((seq.__len__(), BASES.__len__()), dtype=np.int64)
+        self.events = dict()
+
+    @staticmethod
+    def count(encoded):
+        """
+        :param encoded: uint8 matrix of reads (see `BatchScanner.encode`)
+        :return: (positions x 5) counts of the reads
+        """
+        # One comparison per base is faster than a lookup table followed by np.add.at or np.bincount
+        acgt = [(encoded == c).sum(axis=0, dtype=np.int64) for c in _CODES]
+        other = (encoded != PAD).sum(axis=0, dtype=np.int64) - sum(acgt)
+        return np.stack(acgt + [other], axis=1)
+
+    def add(self, encoded, labels=None):
+        """
+        :param encoded: uint8 matrix of a batch of reads (see `BatchScanner.encode`)
+        :param labels: array with the SamParser counter of every read (only used with `by_event`)
+        """
+        if encoded.shape[0] == 0:
+            return
+        self.counts += self.count(encoded)
+        if not self.by_event or labels is None:
+            return
+        for label in np.unique(labels).tolist():
+            counts = self.count(encoded[labels == label])
+            if label in self.events:
+                self.events[label] += counts
+            else:
+                self.events[label] = counts
+
+    def merge(self, other):
+        """
+        Add the counts of another Pileup of the same target (e.g. of a shard counted in another process)
+        """
+        self.counts += other.counts
+        for label, counts in other.events.items():
+            if label in self.events:
+                self.events[label] += counts
+            else:
+                self.events[label] = counts.copy()
+
+    def to_dict(self):
+        """
+        :return: JSON serializable counts (for checkpoints and counts files)
+        """
+        return {'total': self.counts.tolist(), 'events': {k: v.tolist() for k, v in self.events.items()}}
+
+    @classmethod
+    def from_dict(cls, seq, read_start, content, by_event=False):
+        """
+        :param content: output of `to_dict`
+        """
+        pileup = cls(seq, read_start, by_event=by_event)
+        pileup.counts += np.array(content['total'], dtype=np.int64)
+        pileup.events = {k: np.array(v, dtype=np.int64) for k, v in content['events'].items()}
+        return pileup
+
+    def results_dict(self):
+        """
+        :return: counts in the format of `CountReads.results_dict`
+            {'41': {'POS': 56772452, 'REF': 'C', 'A': 3, 'G': 1, 'T': 0, 'C': 10234, 'N': 12}, ...}
+        """
+        res = dict()
+        for i, row in enumerate(self.counts.tolist()):
+            res[str(i)] = {'POS': self.read_start + i, 'REF': self.seq[i]}
+            res[str(i)].update(zip(BASES, row))
+        return res
+
+    def write(self, prefix):
+        """
+        Write `<prefix>.pileup.tsv` and `<prefix>.pileup.npz`
+
+        The TSV has one row per position for all reads (Event '.') and, with `by_event`, one per position and
+        counter. Depth and Mismatch (reads with a base other than REF) are included for convenience.
+        """
+        tables = [('.', self.counts)] + sorted(self.events.items())
+        with open(prefix + '.pileup.tsv', 'w') as w:
+            w.write('Event\tPOS\tREF\t' + '\t'.join(BASES) + '\tDepth\tMismatch\n')
+            for label, counts in tables:
+                for i, row in enumerate(counts.tolist()):
+                    ref = BASES.find(self.seq[i])
+                    depth = sum(row)
+                    mismatch = depth - (row[ref] if ref >= 0 else 0)
+                    w.write(f"{label}\t{self.read_start + i}\t{self.seq[i]}\t" +
+                            '\t'.join([str(x) for x in row]) + f"\t{depth}\t{mismatch}\n")
+        np.savez_compressed(prefix + '.pileup.npz',
+                            pos=np.arange(self.seq.__len__()) + self.read_start,
+                            ref=np.array(list(self.seq)),
+                            bases=np.array(list(BASES)),
+                            counts=self.counts,
+                            **{'counts_' + k: v for k, v in self.events.items()})
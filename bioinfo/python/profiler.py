@@ -0,0 +1,143 @@
+"""
+Opt-in per-stage profiling of `SamParser.process_sam` (`--profile`).
+
+Stages are timed by wrapping the functions that implement them for the duration of a run, so nothing is timed (and
+nothing costs anything) when profiling is off. Stages nest: the time of a stage excludes the stages it calls, so
+the exclusive times add up to the run time.
+
+Example (<sample>.profile.json):
+    {'sample_name': 'A1.fastq', 'wall_time': 812.4, 'total_count': 3500000, 'reads_per_second': 4308.2,
+     'stages': {'parse': {'calls': 1, 'time': 95.1, 'inclusive': 790.3},
+                'dna_mismatch_scan': {'calls': 54, 'time': 41.7, 'inclusive': 41.7}, ...},
+     'event_latency': {'missense_count': {'calls': 9120, 'time': 3.8, 'mean_us': 416.7, 'max_us': 2210.5}, ...},
+     'throughput': [{'time': 10.0, 'reads': 43210, 'reads_per_second': 4321.0}, ...]}
+"""
+import time
+
+# Seconds between two throughput samples
+SAMPLE_INTERVAL = 10
+
+
+class StageProfiler:
+
+    def __init__(self, sample_interval=SAMPLE_INTERVAL):
+        self.sample_interval = sample_interval
+        self.start = time.perf_counter()
+        self.last_sample = self.start
+        self.last_reads = 0
+        # name -> [calls, inclusive time, exclusive time]
+        self.stages = dict()
+        # counter -> [calls, time, max time]
+        self.events = dict()
+        self.throughput = []
+        self._stack = []
+        self._patched = []
+
+    def wrap(self, name, fn, event=None):
+        """
+        :param name: stage name
+        :param fn: function implementing the stage
+        :param event: function mapping the result of `fn` to an event type, whose latency is recorded separately
+        :return: timed version of `fn`
+        """
+        stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+        stack = self._stack
+        events = self.events
+        clock = time.perf_counter
+
+        def timed(*args, **kwargs):
+            stack.append(0.0)
+            start = clock()
+            try:
+                result = fn(*args, **kwargs)
+            finally:
+                elapsed = clock() - start
+                stage[0] += 1
+                stage[1] += elapsed
+                stage[2] += elapsed - stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+            if event is not None:
+                latency = events.setdefault(event(result), [0, 0.0, 0.0])
+                latency[0] += 1
+                latency[1] += elapsed
+                latency[2] = max(latency[2], elapsed)
+            return result
+
+        return timed
+
+    def instrument(self, owner, attr, name, event=None):
+        """
+        Replace `owner.attr` (a method of an instance or a function of a module) by its timed version until `restore`
+
+        :param owner: object or module
+        :param attr: name of the function
+        :param name: stage name
+        :param event: see `wrap`
+        """
+        original = owner.__dict__.get(attr) if hasattr(owner, '__dict__') else None
+        self._patched.append((owner, attr, original))
+        setattr(owner, attr, self.wrap(name, getattr(owner, attr), event))
+
+    def restore(self):
+        """
+        Undo every `instrument`, in reverse order
+        """
+        for owner, attr, original in reversed(self._patched):
+            if original is None:
+                delattr(owner, attr)
+            else:
+                setattr(owner, attr, original)
+        self._patched = []
+
+    def sample(self, reads):
+        """
+        Record the throughput if the last sample is more than `sample_interval` seconds old
+
+        :param reads: number of reads counted so far
+        """
+        now = time.perf_counter()
+        if now - self.last_sample < self.sample_interval:
+            return
+        self.throughput.append({'time': round(now - self.start, 3),
+                                'reads': reads,
+                                'reads_per_second': round((reads - self.last_reads) / (now - self.last_sample), 1)})
+        self.last_sample = now
+        self.last_reads = reads
+
+    def add(self, report):
+        """
+        Add the stages and event latencies of another report (e.g. of a shard counted in another process)
+
+        :param report: output of `report()`
+        """
+        for name, s in report['stages'].items():
+            stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+            stage[0] += s['calls']
+            stage[1] += s['inclusive']
+            stage[2] += s['time']
+        for name, e in report['event_latency'].items():
+            latency = self.events.setdefault(name, [0, 0.0, 0.0])
+            latency[0] += e['calls']
+            latency[1] += e['time']
+            latency[2] = max(latency[2], e['max_us'] / 1e6)
+
+    def report(self, sample_name=None, total_count=0):
+        """
+        :param sample_name: name of the sample
+        :param total_count: number of reads in the sample
+        :return: dictionary, see the module docstring
+        """
+        wall_time = time.perf_counter() - self.start
+        return {'sample_name': sample_name,
+                'wall_time': round(wall_time, 3),
+                'total_count': total_count,
+                'reads_per_second': round(total_count / wall_time, 1) if wall_time > 0 else 0,
+                'stages': {name: {'calls': s[0], 'time': round(s[2], 6), 'inclusive': round(s[1], 6)}
+                           for name, s in sorted(self.stages.items(), key=lambda x: -x[1][2])},
+                'event_latency': {name: {'calls': e[0],
+                                         'time': round(e[1], 6),
+                                         'mean_us': round(e[1] / e[0] * 1e6, 1) if e[0] else 0,
+                                         'max_us': round(e[2] * 1e6, 1)}
+                                  for name, e in sorted(self.events.items())},
+                'throughput': self.throughput}
@@ -0,0 +1,52 @@
+from collections import OrderedDict
+
+
+class ClassificationCache:
+    """
+    Bounded least-recently-used cache of read classifications.
+
+    SGE amplicon libraries are heavily redundant, so the same on-target SEQ shows up thousands of times. Only reads
+    that already start at `read_start` and pass the CIGAR filter are looked up, so the read's mismatch signature
+    (see `BatchScanner.read_key`) identifies the classification. Reads that only differ after the end of the target
+    share a signature.
+
+    Example:
+        cache = ClassificationCache(maxsize=100000)
+        res = cache.get(key)
+        if res is None:
+            res = classify(seq)
+            cache.put(key, res)
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._store = OrderedDict()
+
+    def __len__(self):
+        return self._store.__len__()
+
+    def get(self, key):
+        """
+        :param key: mismatch signature (or SEQ) of the read
+        :return: cached classification, or None if it has not been seen (or was evicted)
+        """
+        try:
+            value = self._store[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._store.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._store[key] = value
+        if self._store.__len__() > self.maxsize:
+            self._store.popitem(last=False)
+
+    def clear(self):
+        self._store.clear()
@@ -0,0 +1,133 @@
+"""
+Machine-readable metrics of a run: every read counter plus throughput and resource usage.
+
+`<sample>.metrics.json` is written next to the .metrics.tsv table, and with `--prometheus_dir` the same numbers are
+written as a node_exporter textfile (`<dir>/<sample>.prom`), so runs can be monitored without parsing the table.
+
+Example (<sample>.metrics.json):
+    {'sample_name': 'A1.fastq', 'samfile': '/data/A1.fastq.sam',
+     'counters': {'total_count': 3500000, 'off_target': 410000, ..., 'noncoding_count': 1200, 'usable_count': 2100000,
+                  'cache_hits': 3011000, 'cache_misses': 79000, 'table_hits': 2600000},
+     'input_bytes': 1932735283, 'wall_time': 812.4, 'cpu_time': 1604.9, 'reads_per_second': 4308.2,
+     'peak_rss_mb': 812.7, 'workers': 2}
+"""
+import os
+import resource
+import time
+
+# Prefix of the Prometheus metric names: SGE (saturation genome editing) read counting
+PROMETHEUS_PREFIX = 'sge_countreads'
+# Counters of `SamParser.get_counters()` that count classification lookups rather than reads
+LOOKUP_COUNTERS = ('cache_hits', 'cache_misses', 'table_hits')
+# Metrics of every run besides the counters: metric name, type, report key, description
+PROMETHEUS_METRICS = (('input_bytes_total', 'counter', 'input_bytes', 'Bytes of the input file counted'),
+                      ('wall_seconds_total', 'counter', 'wall_time', 'Wall time of the run'),
+                      ('cpu_seconds_total', 'counter', 'cpu_time', 'CPU time of the run, including worker processes'),
+                      ('reads_per_second', 'gauge', 'reads_per_second', 'Reads counted per second of wall time'),
+                      ('peak_rss_bytes', 'gauge', 'peak_rss_mb', 'Peak resident set size'),
+                      ('workers', 'gauge', 'workers', 'Worker processes'))
+
+def cpu_time():
+    """
+    :return: user + system seconds of this process and of its finished child processes (e.g. shard workers)
+    """
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum([u.ru_utime + u.ru_stime for u in usage])
+
+
+def peak_rss_mb():
+    """
+    :return: largest resident set size of this process or of one of its finished child processes, in MB
+    """
+    return max([resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]) / 1024
+
+
+class RunStats:
+    """
+    Wall and CPU time of a run, measured from its creation
+
+    The peak RSS is that of the whole process: in a worker counting several samples, it is the peak of all the samples
+    it counted so far.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.start_cpu = cpu_time()
+
+    def report(self, sample_name, samfile, counters, input_bytes, workers=1):
+        """
+        :param sample_name: sample name
+        :param samfile: input file
+        :param counters: output of `SamParser.get_counters()`, with usable_count
+        :param input_bytes: bytes of the input file counted by this run
+        :param workers: number of worker processes
+        :return: content of <sample>.metrics.json (see the module docstring)
+        """
+        wall = time.perf_counter() - self.start
+        return {'sample_name': sample_name,
+                'samfile': os.path.abspath(samfile) if samfile is not None else None,
+                'counters': counters,
+                'input_bytes': input_bytes,
+                'wall_time': round(wall, 3),
+                'cpu_time': round(cpu_time() - self.start_cpu, 3),
+                'reads_per_second': round(counters['total_count'] / wall, 1) if wall > 0 else 0,
+                'peak_rss_mb': round(peak_rss_mb(), 1),
+                'workers': workers}
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _family(name, _type, description):
+    return [f'# HELP {PROMETHEUS_PREFIX}_{name} {description}', f'# TYPE {PROMETHEUS_PREFIX}_{name} {_type}']
+
+
+def format_prometheus(reports):
+    """
+    :param reports: list of `RunStats.report` outputs
+    :return: Prometheus text exposition of the reports, one metric family at a time, e.g.
+        sge_countreads_reads_total{sample="A1.fastq",counter="missense_count"} 1203000
+        sge_countreads_cache_lookups_total{sample="A1.fastq",result="hit"} 3011000
+        sge_countreads_reads_per_second{sample="A1.fastq"} 4308.2
+    """
+    samples = [f'sample="{_label(r["sample_name"])}"' for r in reports]
+    lines = _family('reads_total', 'counter', 'Reads per SamParser counter (total_count and usable_count include '
+                                              'the reads of other counters)')
+    for sample, report in zip(samples, reports):
+        for counter, value in report['counters'].items():
+            if counter not in LOOKUP_COUNTERS:
+                lines.append(f'{PROMETHEUS_PREFIX}_reads_total{{{sample},counter="{_label(counter)}"}} {value}')
+    lines += _family('cache_lookups_total', 'counter', 'Lookups of the read classification cache')
+    for sample, report in zip(samples, reports):
+        for result, counter in (('hit', 'cache_hits'), ('miss', 'cache_misses')):
+            if counter in report['counters']:
+                lines.append(f'{PROMETHEUS_PREFIX}_cache_lookups_total{{{sample},result="{result}"}} '
+                             f'{report["counters"][counter]}')
+    lines += _family('outcome_table_hits_total', 'counter', 'Reads classified from the table of designed changes')
+    for sample, report in zip(samples, reports):
+        if 'table_hits' in report['counters']:
+            lines.append(f'{PROMETHEUS_PREFIX}_outcome_table_hits_total{{{sample}}} {report["counters"]["table_hits"]}')
+    for name, _type, key, description in PROMETHEUS_METRICS:
+        lines += _family(name, _type, description)
+        for sample, report in zip(samples, reports):
+            value = report[key]
+            if value is None:
+                continue
+            if name == 'peak_rss_bytes':
+                value = int(value * 1024 * 1024)
+            lines.append(f'{PROMETHEUS_PREFIX}_{name}{{{sample}}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(filename, reports):
+    """
+    Write a node_exporter textfile atomically (the collector must never read a partial file)
+
+    :param filename: output file, ending in .prom
+    :param reports: list of `RunStats.report` outputs
+    """
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as w:
+        w.write(format_prometheus(reports))
+    os.replace(tmp, filename)
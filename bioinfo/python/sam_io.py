@@ -0,0 +1,349 @@
+import gzip
+import io
+import mmap
+import os
+import queue
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+CHUNK_SIZE = 1 << 20
+BGZF_BATCH = 64
+
+
+def split_sam(filename, shards):
+    """
+    Split a SAM file into byte ranges that start and end on line boundaries
+
+    :param filename: plain-text SAM file
+    :param shards: number of ranges wanted
+
+    :return: list of [start, end) byte offsets, in file order. Fewer ranges than requested are returned for files
+        with fewer lines than shards.
+
+    Example:
+        split_sam('sample.sam', 4) -> [(0, 2611), (2611, 5220), (5220, 7835), (7835, 10440)]
+    """
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as fh:
+        for i in range(1, shards):
+            fh.seek(size * i // shards)
+            if fh.tell() > 0:
+                # Move to the start of the next full line
+                fh.seek(fh.tell() - 1)
+                fh.readline()
+            offset = fh.tell()
+            if offset > bounds[-1] and offset < size:
+                bounds.append(offset)
+    bounds.append(size)
+    return [(bounds[i], bounds[i + 1]) for i in range(bounds.__len__() - 1)]
+
+
+def map_sam(filename):
+    """
+    Memory-map a plain-text SAM file
+
+    :param filename: plain-text SAM file
+
+    :return: read-only mmap of the file (empty bytes for an empty file, which can't be mapped)
+    """
+    with open(filename, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def skip_header(buf, start=0):
+    """
+    :param buf: SAM file contents (bytes or mmap)
+    :param start: byte offset of a line
+    :return: byte offset of the first line at or after `start` that is not a header ('@') line
+    """
+    while buf[start:start + 1] == b'@':
+        eol = buf.find(b'\n', start)
+        start = buf.__len__() if eol < 0 else eol + 1
+    return start
+
+
+def iter_chunks(buf, start, end, size=CHUNK_SIZE):
+    """
+    Split a byte range of a SAM file into chunks of whole lines
+
+    :param buf: SAM file contents (bytes or mmap)
+    :param start: byte offset of the first line
+    :param end: byte offset where the range ends (at a line boundary or the end of the file)
+    :param size: approximate size of the chunks
+
+    :return: generator of bytes
+    """
+    while start < end:
+        stop = buf.find(b'\n', min(start + size, end) - 1, end)
+        stop = end if stop < 0 else stop + 1
+        yield buf[start:stop]
+        start = stop
+
+
+def get_compression(filename):
+    """
+    Detect the compression of a file from its magic bytes
+
+    :return: None (plain text), 'bgzf', 'gzip' or 'zstd'
+    """
+    with open(filename, 'rb') as fh:
+        magic = fh.read(16)
+    if magic.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    if magic.startswith(GZIP_MAGIC):
+        # BGZF is gzip with an extra field (FLG.FEXTRA) holding the 'BC' block size subfield
+        if magic.__len__() >= 14 and magic[3] & 4 and magic[12:14] == b'BC':
+            return 'bgzf'
+        return 'gzip'
+    return None
+
+
+def open_sam(filename, threads=1):
+    """
+    Iterate over the lines of a plain, gzip, BGZF or zstd compressed SAM file
+
+    Compressed input is decompressed by a background thread that feeds the caller, so decompression overlaps with
+    parsing. BGZF blocks are independent, so they are inflated by `threads` threads at a time.
+
+    :param filename: SAM file
+    :param threads: number of threads used to inflate BGZF blocks
+
+    :return: iterable of lines
+    """
+    compression = get_compression(filename)
+    if compression is None:
+        return open(filename, 'r')
+    if compression == 'bgzf':
+        return _lines_from_chunks(_background(_bgzf_chunks, filename, threads))
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstandard is required to read zstd compressed input")
+        return _lines_from_chunks(_background(_zstd_chunks, filename))
+    return _lines_from_chunks(_background(_gzip_chunks, filename))
+
+
+def _gzip_chunks(filename):
+    with gzip.open(filename, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+            yield chunk
+
+
+def _zstd_chunks(filename):
+    with open(filename, 'rb') as fh:
+        reader = zstandard.ZstdDecompressor().stream_reader(fh, read_size=CHUNK_SIZE)
+        for chunk in iter(lambda: reader.read(CHUNK_SIZE), b''):
+            yield chunk
+
+
+def _bgzf_blocks(fh):
+    """
+    Read the raw BGZF blocks of a file without inflating them
+
+    :return: generator of (deflated data, CRC32, uncompressed size)
+    """
+    while True:
+        header = fh.read(12)
+        if header.__len__() == 0:
+            return
+        if header.__len__() < 12 or header[:2] != GZIP_MAGIC:
+            raise ValueError(f"Invalid BGZF block header at offset {fh.tell() - header.__len__()}")
+        xlen = struct.unpack('<H', header[10:12])[0]
+        extra = fh.read(xlen)
+        bsize = None
+        i = 0
+        while i + 4 <= xlen:
+            slen = struct.unpack('<H', extra[i + 2:i + 4])[0]
+            if extra[i:i + 2] == b'BC':
+                bsize = struct.unpack('<H', extra[i + 4:i + 6])[0]
+            i += 4 + slen
+        if bsize is None:
+            raise ValueError("gzip member without a BGZF block size")
+        rest = fh.read(bsize + 1 - 12 - xlen)
+        crc, isize = struct.unpack('<II', rest[-8:])
+        yield rest[:-8], crc, isize
+
+
+def _inflate(block):
+    data, crc, isize = block
+    inflated = zlib.decompress(data, -15)
+    if inflated.__len__() != isize or zlib.crc32(inflated) != crc:
+        raise ValueError("Corrupt BGZF block")
+    return inflated
+
+
+def _bgzf_chunks(filename, threads=1):
+    with open(filename, 'rb') as fh, ThreadPoolExecutor(max_workers=max(threads, 1)) as pool:
+        batch = []
+        for block in _bgzf_blocks(fh):
+            batch.append(block)
+            if batch.__len__() == BGZF_BATCH:
+                # zlib releases the GIL, so the blocks of a batch are inflated in parallel
+                yield b''.join(pool.map(_inflate, batch))
+                batch = []
+        if batch:
+            yield b''.join(pool.map(_inflate, batch))
+
+
+def _background(producer, *args, prefetch=8):
+    """
+    Run a chunk generator in a background thread
+
+    :param producer: generator function yielding chunks of bytes
+    :param prefetch: number of chunks that can be read ahead of the consumer
+
+    :return: generator of chunks
+    """
+    chunks = queue.Queue(maxsize=prefetch)
+    done = object()
+
+    def run():
+        try:
+            for chunk in producer(*args):
+                chunks.put(chunk)
+        except Exception as e:
+            chunks.put(e)
+        chunks.put(done)
+
+    threading.Thread(target=run, daemon=True).start()
+    while True:
+        chunk = chunks.get()
+        if chunk is done:
+            return
+        if isinstance(chunk, Exception):
+            raise chunk
+        yield chunk
+
+
+def _lines_from_chunks(chunks):
+    """
+    Split chunks of decompressed bytes into lines
+
+    :return: generator of decoded lines (without the trailing newline)
+    """
+    remainder = ''
+    for chunk in chunks:
+        lines = (remainder + chunk.decode()).split('\n')
+        remainder = lines.pop()
+        yield from lines
+    if remainder:
+        yield remainder
+
+
+def is_alignment_file(filename):
+    """
+    :return: True for BAM/CRAM input, which is read through its index instead of line by line
+    """
+    return filename.endswith('.bam') or filename.endswith('.cram')
+
+
+def open_alignment_file(filename, reference=None):
+    """
+    Open a BAM or CRAM file with pysam
+
+    :param filename: coordinate sorted and indexed BAM/CRAM file
+    :param reference: reference FASTA (only needed for CRAM)
+
+    :return: pysam.AlignmentFile
+    """
+    if pysam is None:
+        raise ImportError("pysam is required to read BAM/CRAM input")
+    mode = 'rc' if filename.endswith('.cram') else 'rb'
+    return pysam.AlignmentFile(filename, mode, reference_filename=reference)
+
+
+def count_records(alignment_file):
+    """
+    Count all records (mapped, unmapped and without coordinates) in an alignment file
+
+    Uses the BAM index statistics. CRAM indexes don't store them, so CRAM files are read through once.
+
+    :param alignment_file: pysam.AlignmentFile
+
+    :return: int
+    """
+    if not alignment_file.is_cram:
+        try:
+            return alignment_file.mapped + alignment_file.unmapped
+        except ValueError:
+            # No index statistics available
+            pass
+    total_count = 0
+    for _ in alignment_file.fetch(until_eof=True):
+        total_count += 1
+    return total_count
+
+
+def fetch_start_reads(alignment_file, chrom, read_start):
+    """
+    Fetch the reads that start exactly at `read_start`
+
+    :param alignment_file: pysam.AlignmentFile
+    :param chrom: chromosome of the target
+    :param read_start: 1-based position where the reads begin
+
+    :return: generator of (QNAME, CIGAR, SEQ), with '*' for missing values like in a SAM file
+    """
+    if chrom not in alignment_file.references:
+        return
+    for aln in alignment_file.fetch(chrom, read_start - 1, read_start):
+        if aln.reference_start != read_start - 1:
+            continue
+        yield aln.query_name, aln.cigarstring or '*', aln.query_sequence or '*'
+
+
+def read_contigs(filename, reference=None):
+    """
+    Names and lengths of the reference sequences, for the ##contig lines of the VCF
+
+    :param filename: SAM/BAM/CRAM file
+    :param reference: reference FASTA, its .fai is used when there is one
+
+    :return: list of (name, length), from the .fai of `reference` or else from the @SQ header lines of `filename`
+        (empty if neither has any)
+    """
+    if reference is not None and os.path.exists(reference + '.fai'):
+        with open(reference + '.fai', 'r') as r:
+            return [(row.split('\t')[0], int(row.split('\t')[1])) for row in r if row.strip()]
+    if is_alignment_file(filename):
+        with open_alignment_file(filename, reference) as af:
+            return list(zip(af.references, af.lengths))
+    contigs = []
+    with _open_text(filename) as r:
+        for line in r:
+            if not line.startswith('@'):
+                break
+            if not line.startswith('@SQ'):
+                continue
+            fields = dict([f.split(':', 1) for f in line.rstrip('\n').split('\t')[1:] if ':' in f])
+            if 'SN' in fields:
+                contigs.append((fields['SN'], int(fields['LN']) if 'LN' in fields else None))
+    return contigs
+
+
+def _open_text(filename):
+    # Only the header is read, so the file is decompressed in this thread (BGZF is valid gzip)
+    compression = get_compression(filename)
+    if compression is None:
+        return open(filename, 'r')
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstandard is required to read zstd compressed input")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb')))
+    return gzip.open(filename, 'rt')
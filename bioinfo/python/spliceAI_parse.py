@@ -14,7 +14,9 @@ DP_AL Delta position (acceptor loss)
 DP_DG Delta position (donor gain)
 DP_DL Delta position (donor loss)
 
-#New Annotation keys
+#New Annotation keys (one value per ALT allele)
+SpliceAI_ALLELE
+SpliceAI_GENE
 SpliceAI_DS_AG
 SpliceAI_DS_AL
 SpliceAI_DS_DG
@@ -23,113 +25,211 @@ SpliceAI_DP_AG
 SpliceAI_DP_AL
 SpliceAI_DP_DG
 SpliceAI_DP_DL
+SpliceAI_DS_MAX (largest of the four delta scores)
 
+When SpliceAI annotated an allele for several genes, the gene with the largest delta score is kept.
+Records are parsed as text, one line at a time. With -w, a bgzip compressed and tabix indexed VCF is split into
+regions that are parsed in parallel (this requires cyvcf2).
 """
 
 import argparse
-
-from cyvcf2 import VCF
+import gzip
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from bgzf import BgzfWriter, read_tabix_extents
+
+try:
+    from cyvcf2 import VCF
+except ImportError:
+    VCF = None
+
+# Fields of a SpliceAI annotation: ALLELE|SYMBOL|DS_AG|DS_AL|DS_DG|DS_DL|DP_AG|DP_AL|DP_DG|DP_DL
+SPLICEAI_FIELDS = ('ALLELE', 'GENE', 'DS_AG', 'DS_AL', 'DS_DG', 'DS_DL', 'DP_AG', 'DP_AL', 'DP_DG', 'DP_DL')
+
+# INFO keys replacing the SpliceAI key: ID, Type, Description
+NEW_INFO = (('SpliceAI_ALLELE', 'String', 'SpliceAI Allele'),
+            ('SpliceAI_GENE', 'String', 'SpliceAI Gene'),
+            ('SpliceAI_DS_AG', 'Float', 'SpliceAI Delta score (acceptor gain)'),
+            ('SpliceAI_DS_AL', 'Float', 'SpliceAI Delta score (acceptor loss)'),
+            ('SpliceAI_DS_DG', 'Float', 'SpliceAI Delta score (donor gain)'),
+            ('SpliceAI_DS_DL', 'Float', 'SpliceAI Delta score (donor loss)'),
+            ('SpliceAI_DP_AG', 'Integer', 'SpliceAI Delta position (acceptor gain)'),
+            ('SpliceAI_DP_AL', 'Integer', 'SpliceAI Delta position (acceptor loss)'),
+            ('SpliceAI_DP_DG', 'Integer', 'SpliceAI Delta position (donor gain)'),
+            ('SpliceAI_DP_DL', 'Integer', 'SpliceAI Delta position (donor loss)'),
+            ('SpliceAI_DS_MAX', 'Float', 'SpliceAI maximum delta score (of DS_AG, DS_AL, DS_DG and DS_DL)'))
+
+# INFO of an annotated allele, filled with the values of NEW_INFO
+INFO_TEMPLATE = ';'.join([key + '={}' for key, _type, description in NEW_INFO])
+# Values of an ALT allele without annotation
+MISSING = ['.'] * NEW_INFO.__len__()
+
+# Parsed records written at once
+WRITE_BATCH = 10000
+# Regions per worker process, so that one dense region doesn't hold up the others
+REGIONS_PER_WORKER = 4
 
 
 def main():
     args = parse_args()
-    splice_parse(args.vcf_file, args.out_file)
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='%(name)s (%(levelname)s): %(message)s')
+    splice_parse(args.vcf_file, args.out_file, args.workers)
 
 
 def parse_args():
-    parser = argparse.ArgumentParser(description=__doc__)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('-v', dest='vcf_file', required=True,
                         help="input vcf file")
     parser.add_argument('-o', dest='out_file', default=None,
-                        help="output vcf file")
+                        help="output vcf file (bgzip compressed if it ends with .gz)")
+    parser.add_argument('-w', dest='workers', type=int, default=1,
+                        help="worker processes for a bgzip compressed, tabix indexed input")
     args = parser.parse_args()
     return args
 
 
-def splice_parse(vcf_file, out_file):
+def parse_header(lines):
     """
-    using cyvcf2 parse spliceAI fields into ; separated info fields
-    INPUT: VCF file with spliceAI annotations
-    OUTPUT: VCF file to stdout
+    :param lines: header lines of the input, ending with #CHROM
+    :return: header lines of the output: the SpliceAI INFO line is replaced by the NEW_INFO lines
     """
-    # Read vcf with cyvcf2
-    vcf = VCF(vcf_file)
+    res = [line for line in lines if not line.startswith('##INFO=<ID=SpliceAI,')]
+    new = [f'##INFO=<ID={key},Number=A,Type={_type},Description="{description}">\n'
+           for key, _type, description in NEW_INFO]
+    return res[:-1] + new + res[-1:]
 
-    # Add info fields to vcf header
-    vcf.add_info_to_header({'ID': "SpliceAI_ALLELE", 'Description': 'SpliceAI Allele',
-                            'Type': 'String', 'Number': '1'})
-    vcf.add_info_to_header({'ID': "SpliceAI_GENE", 'Description': 'SpliceAI Gene',
-                            'Type': 'String', 'Number': '1'})
-    vcf.add_info_to_header({'ID': "SpliceAI_DS_AG", 'Description': 'SpliceAI Delta score (acceptor gain)',
-                            'Type': 'Float', 'Number': '1'})
-    vcf.add_info_to_header({'ID': "SpliceAI_DS_AL", 'Description': 'SpliceAI Delta score (acceptor loss)',
-                            'Type': 'Float', 'Number': '1'})
-    vcf.add_info_to_header({'ID': "SpliceAI_DS_DG", 'Description': 'SpliceAI Delta score (donor gain)',
-                            'Type': 'Float', 'Number': '1'})
-    vcf.add_info_to_header({'ID': "SpliceAI_DS_DL", 'Description': 'SpliceAI Delta score (donor loss)',
-                            'Type': 'Float', 'Number': '1'})
-    vcf.add_info_to_header({'ID': "SpliceAI_DP_AG", 'Description': 'SpliceAI Delta position (acceptor gain)',
-                            'Type': 'Integer', 'Number': '1'})
-    vcf.add_info_to_header({'ID': "SpliceAI_DP_AL", 'Description': 'SpliceAI Delta position (acceptor loss)',
-                            'Type': 'Integer', 'Number': '1'})
-    vcf.add_info_to_header({'ID': "SpliceAI_DP_DG", 'Description': 'SpliceAI Delta position (donor gain)',
-                            'Type': 'Integer', 'Number': '1'})
-    vcf.add_info_to_header({'ID': "SpliceAI_DP_DL", 'Description': 'SpliceAI Delta position (donor loss)',
-                            'Type': 'Integer', 'Number': '1'})
-
-    # remove existing spliceAI info field in header
-    header_list = vcf.raw_header.split('\n')
-    new_header_list = [i if not i.startswith('##INFO=<ID=SpliceAI,Number=.,') else False for n, i in
-                       enumerate(header_list)]
-
-    # print out new header
-    if out_file:
-        o = open(out_file, 'w')
+
+def best_annotations(spliceai):
+    """
+    :param spliceai: value of the SpliceAI INFO key, one annotation per allele and gene separated by ','
+    :return: dictionary allele -> values of NEW_INFO, from the annotation of the allele with the largest delta score
+    """
+    res = dict()
+    best = dict()
+    for annotation in spliceai.split(','):
+        values = annotation.split('|')
+        if values.__len__() != SPLICEAI_FIELDS.__len__():
+            continue
+        # Masked annotations have '.' scores, they are only kept when the allele has no other one
+        try:
+            top = max(values[2:6], key=float)
+            score = float(top)
+        except ValueError:
+            top = '.'
+            score = -1.0
+        if values[0] not in res or score > best[values[0]]:
+            values.append(top)
+            res[values[0]] = values
+            best[values[0]] = score
+    return res
+
+
+def parse_record(line):
+    """
+    :param line: VCF record
+    :return: the record with the SpliceAI INFO key replaced by the NEW_INFO keys (one value per ALT, '.' for alleles
+        without an annotation). Records without a SpliceAI key are returned unchanged.
+    """
+    start = line.find('SpliceAI=')
+    if start < 0:
+        return line
+    fields = line.rstrip('\n').split('\t', 8)
+    info = fields[7].split(';')
+    for i, item in enumerate(info):
+        if item.startswith('SpliceAI='):
+            annotations = best_annotations(info.pop(i)[9:])
+            break
     else:
-        o = open(vcf_file.replace(".vcf", ".parsed.vcf"), 'w')
+        return line
+    alts = fields[4].split(',')
+    if alts.__len__() == 1:
+        alleles = annotations.get(alts[0])
+    else:
+        alleles = [annotations.get(alt, MISSING) for alt in alts]
+        alleles = None if all([a is MISSING for a in alleles]) else [','.join(v) for v in zip(*alleles)]
+    if alleles is not None:
+        info.append(INFO_TEMPLATE.format(*alleles))
+    fields[7] = ';'.join(info) if info else '.'
+    return '\t'.join(fields) + '\n'
 
-    for i in new_header_list:
-        if i:
-            o.write(str(i) + '\n')
 
-    # iterating through each vcf record and separting the sliceAI INFO field into separate info annotations
-    for variant in vcf:
-        info_gen = variant.INFO
-        variant_info_list = [i[0] for i in info_gen if "SpliceAI" not in i]
-        try:
-            value = variant.INFO.get('SpliceAI').split("|")
-            ALLEL = "SpliceAI_ALLELE" + "=" + value[0]
-            GENE = "SpliceAI_GENE" + "=" + value[1]
-            DS_AG = "SpliceAI_DS_AG" + "=" + value[2]
-            DS_AL = "SpliceAI_DS_AL" + "=" + value[3]
-            DS_DG = "SpliceAI_DS_DG" + "=" + value[4]
-            DS_DL = "SpliceAI_DS_DL" + "=" + value[5]
-            DP_AG = "SpliceAI_DP_AG" + "=" + value[6]
-            DP_AL = "SpliceAI_DP_AL" + "=" + value[7]
-            DP_DG = "SpliceAI_DP_DG" + "=" + value[8]
-            DP_DL = "SpliceAI_DP_DL" + "=" + value[9]
-            out = ";".join(str(i) for i in [ALLEL,
-                                            GENE,
-                                            DS_AG,
-                                            DS_AL,
-                                            DS_DG,
-                                            DS_DL,
-                                            DP_AG,
-                                            DP_AL,
-                                            DP_DG,
-                                            DP_DL])
-            info_fields = ";".join(
-                str(i) for i in [x + "=" + str(variant.INFO.get(x)) for x in variant_info_list] + [out])
-            vcf_out = str(variant).strip('\n').split('\t')[:7] + [info_fields] + str(variant).strip('\n').split('\t')[
-                                                                                 8:]
-            vcf_out = "\t".join(str(i) for i in vcf_out)
-            o.write(vcf_out + '\n')
-
-        except AttributeError:
-            # If SpliceAI did not provide an annotation
-            vcf_out = str(variant).strip('\n').split('\t')[:7] + ['.'] + str(variant).strip('\n').split('\t')[8:]
-            vcf_out = "\t".join(str(i) for i in vcf_out)
-            o.write(vcf_out + '\n')
+def split_regions(vcf_file, workers):
+    """
+    :param vcf_file: bgzip compressed VCF with a tabix index
+    :param workers: number of worker processes
+    :return: list of (sequence, start, end) regions (1-based, inclusive) covering every record, in file order
+    """
+    extents = read_tabix_extents(vcf_file + '.tbi')
+    total = sum([end - start for name, start, end in extents])
+    size = max(1, -(-total // (workers * REGIONS_PER_WORKER)))
+    regions = []
+    for name, start, end in extents:
+        for s in range(start, end, size):
+            regions.append((name, s + 1, min(s + size, end)))
+    return regions
+
+
+def parse_region(vcf_file, region):
+    """
+    Worker of `splice_parse`
+
+    :param region: (sequence, start, end), only the records starting in the region are parsed, so that records
+        overlapping two regions are parsed once
+    :return: parsed records
+    """
+    name, start, end = region
+    vcf = VCF(vcf_file)
+    res = [parse_record(str(variant)) for variant in vcf(f'{name}:{start}-{end}') if start <= variant.POS <= end]
+    vcf.close()
+    return ''.join(res)
+
+
+def splice_parse(vcf_file, out_file, workers=1):
+    """
+    parse spliceAI fields into ; separated info fields
+    INPUT: VCF file with spliceAI annotations
+    OUTPUT: VCF file (<vcf_file>.parsed.vcf by default)
+    """
+    logger = logging.getLogger(__name__)
+    if not out_file:
+        out_file = vcf_file.replace(".vcf", ".parsed.vcf")
+    o = BgzfWriter(out_file) if out_file.endswith('.gz') else open(out_file, 'w')
+
+    indexed = vcf_file.endswith('.gz') and os.path.exists(vcf_file + '.tbi')
+    if workers > 1 and not indexed:
+        logger.info(f"{vcf_file} has no tabix index, parsing it in one process")
+    if workers > 1 and indexed:
+        if VCF is None:
+            raise ImportError("cyvcf2 is required to parse regions of an indexed VCF in parallel")
+        header = VCF(vcf_file).raw_header
+        o.write(''.join(parse_header([line + '\n' for line in header.rstrip('\n').split('\n')])))
+        regions = split_regions(vcf_file, workers)
+        logger.info(f"Parsing {regions.__len__()} regions with {workers} workers")
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for records in pool.map(parse_region, [vcf_file] * regions.__len__(), regions):
+                o.write(records)
+        o.close()
+        return
+
+    # Plain or gzip/bgzip compressed text, streamed
+    with (gzip.open(vcf_file, 'rt') if vcf_file.endswith('.gz') else open(vcf_file, 'r')) as r:
+        header = []
+        for line in r:
+            header.append(line)
+            if line.startswith('#CHROM'):
+                break
+        o.write(''.join(parse_header(header)))
+        batch = []
+        for line in r:
+            batch.append(parse_record(line))
+            if batch.__len__() >= WRITE_BATCH:
+                o.write(''.join(batch))
+                batch = []
+        o.write(''.join(batch))
+    o.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,113 @@
+from typing import NamedTuple
+
+from translate import translate, reverse_complement
+
+AMINO_ACID_CODES = ('A', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'K', 'L', 'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'V',
+                    'W', 'Y', 'X')
+
+
+class TargetContext(NamedTuple):
+    """
+    Everything about the target that does not depend on an individual read.
+
+    Built once per run from `SamParser.build_target_dict()` and shared (read-only) by every read that gets
+    classified, so the per-read work only has to deal with the read itself.
+
+    Example (F strand, read_start=56772411):
+        target_dict = {'chrom': 'chr17', 'from': 56772431, 'to': 56772538, 'seq': 'CTTCTG...', 'mmc': [41],
+                       'codon_distance_up': 2, 'codon_distance_down': 1, 'strand': 'F'}
+        fro = 20, to = 128                      -> read[fro:to] is the full-codon coding sequence
+        other = {'upstream_noncoding_seq': '...', 'cds_up_seq': 'TG', 'reference_seq_fstrand': '...',
+                 'cds_down_seq': 'A', 'downstream_noncoding_seq': '...'}
+    """
+    target_dict: dict
+    read_start: int
+    strand: str
+    seq: str
+    mmc: tuple
+    fro: int
+    to: int
+    reference_dna: str
+    reference_dna_rc: str
+    reference_aa: str
+    other: dict
+    unc_len: int
+    usc_len: int
+    seq_len: int
+    dsc_len: int
+    dnc_len: int
+    aa_codes: tuple
+
+    @classmethod
+    def build(cls, target_dict, read_start):
+        """
+        Slice the target sequence into its non-coding, partial codon and full codon regions and translate it
+
+        :param target_dict: dictionary from `SamParser.build_target_dict()`
+        :param read_start: where the read begins (relative to the forward strand)
+
+        :return: TargetContext
+        """
+        read_start = int(read_start)
+        strand = target_dict.get('strand')
+        cds_full_start = int(target_dict['from']) - read_start
+        cds_full_stop = int(target_dict['to']) - read_start
+        reference = target_dict.get('seq')
+
+        # Get all upstream sequences (Left side)
+        """
+        Examples:
+            Assumption1:    upstream_seq = 'ATTTGTCCAG',            cds_up = 0
+                Results:    upstream_noncoding_seq = 'ATTTGTCCAG',  cds_up_seq = ''
+            Assumption2:    upstream_seq = 'ATTTGTCCAG',            cds_up = 1
+                Results:    upstream_noncoding_seq = 'ATTTGTCCA',  cds_up_seq = 'G'
+        """
+        cds_up = target_dict['codon_distance_up']
+        upstream_seq = reference[:cds_full_start]
+        upstream_noncoding_seq = upstream_seq[:upstream_seq.__len__() - cds_up]  # All non-coding
+        cds_up_seq = upstream_seq[upstream_seq.__len__() - cds_up:]  # Partial coding regions
+
+        # Get all downstream sequences (Right side)
+        """
+        Examples:
+            Assumption1:    downstream_seq = ''GTATGATGTAT'',         cds_down = 0
+                Results:    downstream_noncoding_seq = 'GTATGATGTAT', cds_down_seq = ''
+            Assumption2:    downstream_seq = 'GTATGATGTAT',           cds_down = 1
+                Results:    downstream_noncoding_seq = 'GTATGATGTAT', cds_down_seq = 'G'
+        """
+        cds_down = target_dict['codon_distance_down']
+        cds_down_seq = reference[cds_full_stop:cds_full_stop + cds_down]  # Partial coding regions
+        downstream_noncoding_seq = reference[cds_full_stop + cds_down + 1:]  # All non-coding
+
+        reference = reference[cds_full_start:cds_full_stop + 1]
+        if reference.__len__() % 3 != 0:
+            raise Exception(f"reference: ({reference}) is not divisible by 3 ({reference.__len__() % 3})")
+        reference_rc = reverse_complement(reference)
+        if strand == 'R':
+            reference_aa = translate(reference_rc)
+        else:
+            reference_aa = translate(reference)
+
+        other = {'downstream_noncoding_seq': downstream_noncoding_seq,
+                 'cds_down_seq': cds_down_seq,
+                 'reference_seq_fstrand': reference,
+                 'cds_up_seq': cds_up_seq,
+                 'upstream_noncoding_seq': upstream_noncoding_seq
+                 }
+        return cls(target_dict=target_dict,
+                   read_start=read_start,
+                   strand=strand,
+                   seq=target_dict['seq'],
+                   mmc=tuple(target_dict['mmc']),
+                   fro=cds_full_start,
+                   to=cds_full_stop + 1,
+                   reference_dna=reference.upper(),
+                   reference_dna_rc=reference_rc.upper(),
+                   reference_aa=reference_aa,
+                   other=other,
+                   unc_len=upstream_noncoding_seq.__len__(),
+                   usc_len=cds_up_seq.__len__(),
+                   seq_len=reference.__len__(),
+                   dsc_len=cds_down_seq.__len__(),
+                   dnc_len=downstream_noncoding_seq.__len__(),
+                   aa_codes=AMINO_ACID_CODES)
@@ -0,0 +1,87 @@
+"""
+Table-driven DNA translation for the read classification hot path.
+
+Matches `Bio.Seq.Seq(dna).transcribe().translate()` with the standard genetic code (including '*' for stops,
+and trailing partial codons being dropped), without building a `Seq` object for every read.
+
+Example:
+    translate('ATGGCTTAA')          -> 'MA*'
+    translate_rc('TTAAGCCAT')       -> 'MA*'
+    codon_index('ATG')              -> 46
+    CODON_TABLE[codon_index('ATG')] -> 'M'
+"""
+
+# Integer encoding of the bases; codons are encoded as 16 * first + 4 * second + third
+BASES = 'TCAG'
+# NCBI standard table (transl_table=1) in TTT, TTC, TTA, TTG, TCT, ... GGG order
+CODON_TABLE = 'FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG'
+
+_COMPLEMENT = str.maketrans('ACGTUMRWSYKVHDBNacgtumrwsykvhdbn',
+                            'TGCAAKYWSRMBDHVNtgcaakywsrmbdhvn')
+
+# codon -> amino acid, for every codon of A, C, G, T and N
+CODONS = dict()
+for _i, _aa in enumerate(CODON_TABLE):
+    CODONS[BASES[_i // 16] + BASES[_i // 4 % 4] + BASES[_i % 4]] = _aa
+
+
+def _resolve_n(codon):
+    # An N is translated when every base it could be gives the same amino acid
+    if 'N' not in codon:
+        return CODONS[codon]
+    i = codon.index('N')
+    aas = set(_resolve_n(codon[:i] + b + codon[i + 1:]) for b in BASES)
+    return aas.pop() if aas.__len__() == 1 else 'X'
+
+
+for _a in BASES + 'N':
+    for _b in BASES + 'N':
+        for _c in BASES + 'N':
+            if 'N' in _a + _b + _c:
+                CODONS[_a + _b + _c] = _resolve_n(_a + _b + _c)
+
+
+def _lookup(codon):
+    """
+    Translate a codon that is not in the table (lower case, U or IUPAC ambiguity codes) and remember it
+    """
+    aa = CODONS.get(codon.upper().replace('U', 'T'))
+    if aa is None:
+        # Rare ambiguity codes (e.g. 'RAY' -> 'B'): defer to Biopython, which is only imported if this ever happens
+        from Bio.Seq import Seq
+        aa = Seq(codon).translate().__str__()
+    CODONS[codon] = aa
+    return aa
+
+
+def translate(dna):
+    """
+    :param dna: DNA sequence (forward strand of the coding sequence)
+    :return: amino acid sequence
+    """
+    codons = CODONS
+    return ''.join([codons.get(dna[i:i + 3]) or _lookup(dna[i:i + 3])
+                    for i in range(0, dna.__len__() - dna.__len__() % 3, 3)])
+
+
+def reverse_complement(dna):
+    return dna.translate(_COMPLEMENT)[::-1]
+
+
+def translate_rc(dna):
+    """
+    :param dna: DNA sequence on the forward strand of a reverse strand coding sequence
+    :return: amino acid sequence
+    """
+    return translate(reverse_complement(dna))
+
+
+def codon_index(codon):
+    """
+    :param codon: codon of A, C, G and T
+    :return: integer encoding of the codon (index into CODON_TABLE), -1 for anything else
+    """
+    try:
+        return 16 * BASES.index(codon[0]) + 4 * BASES.index(codon[1]) + BASES.index(codon[2])
+    except (ValueError, IndexError):
+        return -1
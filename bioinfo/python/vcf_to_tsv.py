@@ -20,7 +20,7 @@ def parse_args():
                         default={'RefAA', 'AltAA', 'AApos', 'RefCodon', 'AltCodon', 'AltCodon', 'EventCount',
                                  'EventType', 'SpliceAI_ALLELE', 'SpliceAI_GENE', 'SpliceAI_DS_AG', 'SpliceAI_DS_AL',
                                  'SpliceAI_DS_DG', 'SpliceAI_DS_DL', 'SpliceAI_DP_AG', 'SpliceAI_DP_AL',
-                                 'SpliceAI_DP_DG', 'SpliceAI_DP_DL'},
+                                 'SpliceAI_DP_DG', 'SpliceAI_DP_DL', 'SpliceAI_DS_MAX'},
                         help="INFO fields to extract from VCF file")
 
     parser.add_argument("-o", "--out",